@@ -0,0 +1,307 @@
+"""
+Benchmarks for the scheduling hot paths.
+
+Each benchmark builds a synthetic configuration of :code:`--size` schedules and groups,
+and times a single operation on it. The best time of several runs is reported, and
+compared to a stored baseline::
+
+    python benchmarks/run.py --save        # Store the results as the baseline
+    python benchmarks/run.py               # Compare to the baseline
+
+A benchmark is flagged as a regression if it is more than :code:`--threshold` times
+slower than the baseline with the same size, and the exit status is then 1. Baselines
+are only comparable on the same machine, so they are not committed.
+
+The apps are run with :class:`ad_scheduler.simulation.SimulatedScheduler`, so AppDaemon
+and Home Assistant are not needed.
+"""
+from typing import Any, Callable, Dict, List, Optional
+
+from contextlib import ExitStack
+import argparse
+import datetime
+import fnmatch
+import io
+import json
+from pathlib import Path
+import sys
+import tempfile
+import timeit
+
+from ad_scheduler.const import EntityKind
+from ad_scheduler.entities import EntityGroup
+from ad_scheduler.schedule import Entry, Schedule
+from ad_scheduler.storage import JsonStorage
+from ad_scheduler.simulation import SimulatedScheduler, VirtualClock
+from ad_scheduler.writers import GroupsWriter, ScheduleWriter
+
+BASELINE = Path(__file__).with_name("baseline.json")
+START = datetime.datetime(2021, 11, 1)  # Monday
+
+# A benchmark is set up for a size, and returns the operation to time. Resources that
+# must be released afterwards are registered on the exit stack.
+Benchmark = Callable[[int, ExitStack], Callable[[], Any]]
+BENCHMARKS: Dict[str, Benchmark] = {}
+
+
+def benchmark(fn: Benchmark) -> Benchmark:
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def entries(i: int) -> List[Entry]:
+    """Four entries on different days and times, varying with i"""
+    minute = i % 60
+    return [
+        Entry("on", 6, minute, ["mon", "tue", "wed", "thu", "fri"]),
+        Entry("off", 8, minute, ["mon", "tue", "wed", "thu", "fri"]),
+        Entry("on", 17, minute),
+        Entry("off", 23, minute),
+    ]
+
+
+def schedule_dicts(size: int) -> List[Dict]:
+    return [
+        {
+            "name": f"s{i}",
+            "kind": EntityKind.ON_OFF,
+            "entries": [ScheduleWriter.entry_to_dict(e) for e in entries(i)],
+        }
+        for i in range(size)
+    ]
+
+
+def group_dicts(size: int) -> List[Dict]:
+    return [
+        {
+            "name": f"g{i}",
+            "kind": EntityKind.ON_OFF,
+            "active": True,
+            "schedule_name": f"s{i}",
+            "entities": [f"light.l{i}_{j}" for j in range(3)],
+        }
+        for i in range(size)
+    ]
+
+
+def write_root(size: int, stack: ExitStack) -> str:
+    """A root directory with schedule and group files for size schedules"""
+    root = stack.enter_context(tempfile.TemporaryDirectory())
+    JsonStorage(Path(root)).write(
+        {d["name"]: d for d in schedule_dicts(size)}, group_dicts(size)
+    )
+    return root
+
+
+def app(size: int, stack: ExitStack, **args) -> SimulatedScheduler:
+    """A simulated app loaded with size schedules and groups"""
+    scheduler = SimulatedScheduler(
+        {"root_dir": write_root(size, stack), **args}, clock=VirtualClock(START)
+    )
+    stack.callback(scheduler.close)
+    return scheduler
+
+
+def minutes(size: int) -> List[datetime.datetime]:
+    """Times spread over a week, each in a different minute"""
+    week = 7 * 24 * 60
+    return [START + datetime.timedelta(minutes=i * 37 % week) for i in range(size)]
+
+
+@benchmark
+def entry_next_datetime(size, stack):
+    entry = entries(0)[0]
+    times = minutes(size)
+
+    def run():
+        for now in times:
+            entry.next_after(now)
+            entry.previous_before(now)
+
+    return run
+
+
+@benchmark
+def schedule_update_state(size, stack):
+    scheduler = app(0, stack)
+    schedule = Schedule("s", EntityKind.ON_OFF, scheduler)
+    schedule.add_entries(e for i in range(24) for e in entries(i)[2:3])
+    schedule.add_entries(entries(30)[:2])
+    times = minutes(size)
+
+    def run():
+        for now in times:
+            schedule.update_state(now)
+
+    return run
+
+
+@benchmark
+def schedule_add_entry(size, stack):
+    scheduler = app(0, stack)
+    new_entries = [entries(i) for i in range(size)]
+
+    def run():
+        for i, es in enumerate(new_entries):
+            schedule = Schedule(f"s{i}", EntityKind.ON_OFF, scheduler, armed=False)
+            for e in es:
+                schedule.add_entry(e)
+
+    return run
+
+
+@benchmark
+def group_fan_out(size, stack):
+    scheduler = app(0, stack)
+    schedule = Schedule("s", EntityKind.ON_OFF, scheduler, armed=False)
+    for i in range(size):
+        group = EntityGroup(
+            f"g{i}",
+            EntityKind.ON_OFF,
+            scheduler,
+            f"light.a{i}",
+            f"light.b{i}",
+            applied=scheduler.applied,
+        )
+        group.assign_schedule(schedule)
+    on, off = entries(0)[:2]
+    state = {"entry": on}
+
+    def run():
+        # Alternate, so the applied state cache does not skip the calls
+        state["entry"] = off if state["entry"] is on else on
+        schedule.set_subscribers(state["entry"])
+
+    return run
+
+
+@benchmark
+def set_own_state_all(size, stack):
+    scheduler = app(size, stack)
+    objects = [*scheduler.schedules.values(), *scheduler.groups.values()]
+
+    def run():
+        scheduler._dirty.update(objects)
+        scheduler.set_own_state()
+
+    return run
+
+
+@benchmark
+def set_own_state_one(size, stack):
+    scheduler = app(size, stack)
+    schedule = scheduler.schedules["s0"]
+
+    def run():
+        scheduler._dirty.add(schedule)
+        scheduler.set_own_state()
+
+    return run
+
+
+@benchmark
+def writers_round_trip(size, stack):
+    scheduler = app(0, stack)
+    schedules = [
+        ScheduleWriter.schedule_from_dict(d, scheduler, armed=False)
+        for d in schedule_dicts(size)
+    ]
+    by_name = {s.name: s for s in schedules}
+    groups, _ = GroupsWriter.groups_from_dicts(group_dicts(size), scheduler, by_name)
+
+    def run():
+        for schedule in schedules:
+            fp = io.StringIO()
+            ScheduleWriter.write_schedule(fp, schedule)
+            fp.seek(0)
+            # Read unarmed, so no triggers pile up between runs
+            ScheduleWriter.schedule_from_dict(json.load(fp), scheduler, armed=False)
+        fp = io.StringIO()
+        GroupsWriter.write_groups(fp, groups)
+        fp.seek(0)
+        GroupsWriter.read_groups(fp, scheduler, by_name)
+
+    return run
+
+
+def startup(storage: str) -> Benchmark:
+    def setup(size, stack):
+        root = write_root(size, stack)
+        # Let the backend import the JSON files before timing
+        SimulatedScheduler(
+            {"root_dir": root, "storage": storage}, clock=VirtualClock(START)
+        ).close()
+
+        def run():
+            SimulatedScheduler(
+                {"root_dir": root, "storage": storage}, clock=VirtualClock(START)
+            ).close()
+
+        return run
+
+    return setup
+
+
+for _storage in ["json", "sqlite", "journal"]:
+    BENCHMARKS[f"initialize_{_storage}"] = startup(_storage)
+
+
+def measure(setup: Benchmark, size: int, repeat: int) -> float:
+    """The best time in seconds of a single run of a benchmark"""
+    with ExitStack() as stack:
+        timer = timeit.Timer(setup(size, stack))
+        number, _ = timer.autorange()
+        return min(timer.repeat(repeat, number)) / number
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--size", type=int, default=1000, help="Number of schedules")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each benchmark")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Slowdown compared to the baseline flagged as a regression",
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="Store as the baseline")
+    parser.add_argument("benchmarks", nargs="*", help="Name patterns to run")
+    args = parser.parse_args(argv)
+
+    baseline: Dict[str, Dict] = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    results: Dict[str, Dict] = {}
+    regressions = []
+    print(f"{'benchmark':<24}{'size':>8}{'seconds':>14}{'baseline':>14}{'ratio':>8}")
+    for name, setup in BENCHMARKS.items():
+        if args.benchmarks and not any(
+            fnmatch.fnmatch(name, p) for p in args.benchmarks
+        ):
+            continue
+        seconds = measure(setup, args.size, args.repeat)
+        results[name] = {"size": args.size, "seconds": seconds}
+
+        base = baseline.get(name)
+        line = f"{name:<24}{args.size:>8}{seconds:>14.6f}"
+        if base is not None and base["size"] == args.size:
+            ratio = seconds / base["seconds"]
+            line += f"{base['seconds']:>14.6f}{ratio:>8.2f}"
+            if ratio > args.threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line, flush=True)
+
+    if args.save:
+        args.baseline.write_text(json.dumps({**baseline, **results}, indent=2))
+        print(f"Baseline saved to {args.baseline}")
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
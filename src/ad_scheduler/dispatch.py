@@ -0,0 +1,492 @@
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+import asyncio
+import inspect
+import itertools
+import logging
+import threading
+import time
+
+from .metrics import Metrics, service_name
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Tokens are added continuously at :attr:`rate` per second, up to :attr:`burst`.
+
+    Attributes:
+        rate (float): Tokens added per second
+        burst (float): The maximum number of tokens
+    """
+
+    def __init__(
+        self, rate: float, burst: Optional[float] = None, now: Optional[float] = None
+    ):
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive: {rate}")
+        self.rate = rate
+        self.burst = max(burst if burst is not None else rate, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """Seconds until :code:`cost` tokens are available, 0 if they are now"""
+        self._refill(now)
+        return max(0.0, (min(cost, self.burst) - self._tokens) / self.rate)
+
+    def take(self, cost: float, now: float):
+        self._refill(now)
+        self._tokens -= min(cost, self.burst)
+
+
+class Command:
+    """
+    A call to Home Assistant sent through a :class:`Dispatcher`.
+
+    Attributes:
+        domain (str): The domain of the entities the command changes
+        cost (int): The number of entities the command changes
+        fn (Callable): The function making the call
+        on_drop (Optional[Callable]): Called if the command is dropped from a full
+            queue, or fails
+        on_done (Optional[Callable]): Called once the command has been made, failed or
+            been dropped
+    """
+
+    __slots__ = ("domain", "cost", "fn", "args", "kwargs", "on_drop", "on_done", "seq")
+
+    def __init__(
+        self,
+        domain: str,
+        cost: int,
+        fn: Callable,
+        args: tuple,
+        kwargs: Dict[str, Any],
+        on_drop: Optional[Callable[[], Any]] = None,
+        on_done: Optional[Callable[[], Any]] = None,
+    ):
+        self.domain = domain
+        self.cost = cost
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.on_drop = on_drop
+        self.on_done = on_done
+        self.seq = 0
+
+    def done(self):
+        if self.on_done is not None:
+            self.on_done()
+
+
+class Dispatcher(ABC):
+    """
+    Sends the calls to Home Assistant made by entity groups.
+
+    Calls are submitted with the domain and number of entities they change, so a
+    dispatcher can limit or reorder them.
+
+    Attributes:
+        metrics (Optional[Metrics]): If set, the calls that are made and the calls
+            that fail are counted in it
+    """
+
+    metrics: Optional[Metrics] = None
+
+    def chunks(self, domain: str, entities: List[str]) -> Iterable[List[str]]:
+        """Split entities of one domain into lists small enough for one call"""
+        return [entities]
+
+    def now(self) -> float:
+        """The time in seconds used to measure how long submitted calls take"""
+        return time.perf_counter()
+
+    @abstractmethod
+    def submit(
+        self,
+        domain: str,
+        cost: int,
+        fn: Callable,
+        args: tuple = (),
+        kwargs: Optional[Dict[str, Any]] = None,
+        on_drop: Optional[Callable[[], Any]] = None,
+        on_done: Optional[Callable[[], Any]] = None,
+    ):
+        """
+        Send a call.
+
+        Parameters:
+            domain: The domain of the entities the call changes
+            cost: The number of entities the call changes
+            fn: The function to call with :code:`args` and :code:`kwargs`
+            on_drop: Called if the call is not made, or fails
+            on_done: Called once the call has been made, failed or been dropped,
+                which may be long after :code:`submit` returns
+        """
+
+    def close(self):
+        pass
+
+
+class DispatchQueue(Dispatcher):
+    """
+    Rate limited queue of calls to Home Assistant.
+
+    Every command takes one token from a shared bucket, limiting the rate of calls,
+    and one token per entity it changes from the bucket of its domain, if the domain
+    is limited. Commands are sent right away while tokens are available. Otherwise
+    they are queued per domain, and sent from an AppDaemon timer as tokens become
+    available, taking turns between domains, so a slow domain does not hold back the
+    others.
+
+    The backlog is bounded. When it is full, the oldest command is dropped to make
+    room, since a newer command is more likely to reflect the current schedule.
+
+    Attributes:
+        app (hass.Hass): The app used to run timers
+        bucket (TokenBucket): Limits the rate of all commands
+        domain_buckets (Dict[str, TokenBucket]): Limits the rate of entity changes in
+            single domains
+        max_backlog (int): The maximum number of queued commands
+        dropped (int): The number of commands dropped from the full queue
+        on_backlog (Optional[Callable[[int], Any]]): Called with the backlog depth
+            when commands start being queued, when the queue is empty again, and at
+            most every :attr:`report_interval` seconds in between
+        report_interval (float): Seconds between reports of the backlog depth
+        clock (Optional[Callable[[], float]]): The source of the time in seconds used
+            to refill the buckets, :code:`time.monotonic` if not given
+    """
+
+    def __init__(
+        self,
+        app: "hass.Hass",
+        rate: float,
+        burst: Optional[float] = None,
+        domain_rates: Optional[Dict[str, float]] = None,
+        max_backlog: int = 1000,
+        on_backlog: Optional[Callable[[int], Any]] = None,
+        report_interval: float = 1,
+        clock: Optional[Callable[[], float]] = None,
+    ):
+        self.app = app
+        self.clock = clock
+        now = self._now()
+        self.bucket = TokenBucket(rate, burst, now)
+        self.domain_buckets: Dict[str, TokenBucket] = {
+            domain: TokenBucket(r, now=now)
+            for domain, r in (domain_rates or {}).items()
+        }
+        self.max_backlog = max_backlog
+        self.dropped = 0
+        self.on_backlog = on_backlog
+        self.report_interval = report_interval
+        self._reported: Optional[int] = None
+        self._reported_at = 0.0
+        self._queues: Dict[str, Deque[Command]] = {}
+        self._depth = 0
+        self._counter = itertools.count()
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._depth
+
+    def _now(self) -> float:
+        return time.monotonic() if self.clock is None else self.clock()
+
+    def now(self) -> float:
+        return self._now()
+
+    def backlog(self) -> Dict[str, int]:
+        """The number of queued commands for each domain"""
+        with self._lock:
+            return {d: len(q) for d, q in self._queues.items() if q}
+
+    def chunk_size(self, domain: str) -> int:
+        """The largest number of entities a single command in a domain should change"""
+        bucket = self.domain_buckets.get(domain)
+        return int(bucket.burst) if bucket is not None else 0
+
+    def chunks(self, domain: str, entities: List[str]) -> Iterable[List[str]]:
+        size = self.chunk_size(domain)
+        if not size:
+            return [entities]
+        return [entities[i : i + size] for i in range(0, len(entities), size)]
+
+    def submit(
+        self,
+        domain: str,
+        cost: int,
+        fn: Callable,
+        args: tuple = (),
+        kwargs: Optional[Dict[str, Any]] = None,
+        on_drop: Optional[Callable[[], Any]] = None,
+        on_done: Optional[Callable[[], Any]] = None,
+    ):
+        """
+        Send a command now if the rate allows, or queue it.
+
+        Parameters:
+            domain: The domain of the entities the command changes
+            cost: The number of entities the command changes
+            fn: The function to call with :code:`args` and :code:`kwargs`
+            on_drop: Called if the command is dropped because the queue is full, or
+                fails
+            on_done: Called once the command has been sent, failed or been dropped
+        """
+        command = Command(domain, cost, fn, args, kwargs or {}, on_drop, on_done)
+        with self._lock:
+            if not self._queues.get(domain) and self._wait_time(command) == 0:
+                self._take(command)
+                send = True
+            else:
+                self._enqueue(command)
+                send = False
+        if send:
+            self._send(command)
+        else:
+            self._report()
+            self._arm()
+
+    def _wait_time(self, command: Command) -> float:
+        now = self._now()
+        wait = self.bucket.wait_time(1, now)
+        bucket = self.domain_buckets.get(command.domain)
+        if bucket is not None:
+            wait = max(wait, bucket.wait_time(command.cost, now))
+        return wait
+
+    def _take(self, command: Command):
+        now = self._now()
+        self.bucket.take(1, now)
+        bucket = self.domain_buckets.get(command.domain)
+        if bucket is not None:
+            bucket.take(command.cost, now)
+
+    def _enqueue(self, command: Command):
+        if self._depth >= self.max_backlog:
+            self._drop_oldest()
+        command.seq = next(self._counter)
+        self._queues.setdefault(command.domain, deque()).append(command)
+        self._depth += 1
+
+    def _drop_oldest(self):
+        queue = min((q for q in self._queues.values() if q), key=lambda q: q[0].seq)
+        dropped = queue.popleft()
+        self._depth -= 1
+        self.dropped += 1
+        logger.warning(
+            "Dispatch backlog full, dropping command for domain %s", dropped.domain
+        )
+        if dropped.on_drop is not None:
+            dropped.on_drop()
+        dropped.done()
+
+    def _arm(self):
+        with self._lock:
+            if self._timer is not None or not self._depth:
+                return
+            wait = min(self._wait_time(q[0]) for q in self._queues.values() if q)
+            self._timer = self.app.run_in(self._drain, wait)
+
+    def _drain(self, kwargs):
+        """Send queued commands while tokens are available"""
+        with self._lock:
+            self._timer = None
+        while True:
+            with self._lock:
+                command = self._next_ready()
+                if command is None:
+                    break
+            self._send(command)
+        self._report()
+        self._arm()
+
+    def _next_ready(self) -> Optional[Command]:
+        for domain in list(self._queues):
+            queue = self._queues[domain]
+            if queue and self._wait_time(queue[0]) == 0:
+                command = queue.popleft()
+                self._depth -= 1
+                self._take(command)
+                # Move the domain last, so the domains take turns
+                del self._queues[domain]
+                if queue:
+                    self._queues[domain] = queue
+                return command
+        return None
+
+    def _send(self, command: Command):
+        try:
+            if self.metrics is None:
+                command.fn(*command.args, **command.kwargs)
+            else:
+                self.metrics.call(command.fn, command.args, command.kwargs)
+        except Exception:
+            logger.exception("Dispatching to %s failed", command.domain)
+            if command.on_drop is not None:
+                command.on_drop()
+        command.done()
+
+    def _report(self):
+        if self.on_backlog is None:
+            return
+        with self._lock:
+            depth = self._depth
+            now = self._now()
+            changed = (depth == 0) != (self._reported in (None, 0))
+            if depth == self._reported or (
+                not changed and now - self._reported_at < self.report_interval
+            ):
+                return
+            self._reported = depth
+            self._reported_at = now
+        self.on_backlog(depth)
+
+    def close(self):
+        """Stop sending queued commands"""
+        with self._lock:
+            if self._timer is not None:
+                self.app.cancel_timer(self._timer)
+                self._timer = None
+
+
+class AsyncDispatcher(Dispatcher):
+    """
+    Sends calls concurrently on the AppDaemon event loop.
+
+    Calls submitted within :meth:`collect` are gathered, and sent together when the
+    outermost block ends, so all calls for a transition run concurrently and the
+    transition takes about as long as its slowest call. At most :attr:`limit` calls
+    are in flight at once, and each call is cancelled after :attr:`timeout` seconds.
+    Calls submitted outside :meth:`collect` are sent right away.
+
+    The API methods of AppDaemon return a task when called from the event loop, which
+    is awaited here. The thread collecting the calls waits until they are done.
+
+    Attributes:
+        app (hass.Hass): The app whose event loop runs the calls
+        limit (int): The maximum number of concurrent calls
+        timeout (float): Seconds before a call is cancelled
+        failures (Deque[Dict]): The most recent failed calls, with the domain, the
+            service called and the error
+        failed (int): The total number of failed calls
+    """
+
+    def __init__(self, app: "hass.Hass", limit: int = 10, timeout: float = 10):
+        if limit < 1:
+            raise ValueError(f"Limit must be positive: {limit}")
+        self.app = app
+        self.limit = limit
+        self.timeout = timeout
+        self.failures: Deque[Dict] = deque(maxlen=100)
+        self.failed = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def collect(self):
+        """Gather the calls submitted by this thread within the block"""
+        local = self._local
+        if getattr(local, "depth", 0) == 0:
+            local.calls = []
+        local.depth = getattr(local, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            local.depth -= 1
+            if local.depth == 0:
+                calls, local.calls = local.calls, []
+                if calls:
+                    self.run(calls)
+
+    def submit(
+        self,
+        domain: str,
+        cost: int,
+        fn: Callable,
+        args: tuple = (),
+        kwargs: Optional[Dict[str, Any]] = None,
+        on_drop: Optional[Callable[[], Any]] = None,
+        on_done: Optional[Callable[[], Any]] = None,
+    ):
+        command = Command(domain, cost, fn, args, kwargs or {}, on_drop, on_done)
+        if getattr(self._local, "depth", 0):
+            self._local.calls.append(command)
+        else:
+            self.run([command])
+
+    def run(self, calls: List[Command]) -> List[Dict]:
+        """
+        Send calls concurrently, and wait for them to finish.
+
+        When called from the event loop itself, the calls are started without waiting.
+
+        Returns:
+            The failed calls
+        """
+        loop = self.app.AD.loop
+        coro = self._run_all(calls)
+        if self.app.AD.main_thread_id == threading.current_thread().ident:
+            loop.create_task(coro)
+            return []
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    async def _run_all(self, calls: List[Command]) -> List[Dict]:
+        semaphore = asyncio.Semaphore(self.limit)
+        results = await asyncio.gather(*(self._run(c, semaphore) for c in calls))
+        failures = [f for f in results if f is not None]
+        if failures:
+            self.failed += len(failures)
+            self.failures.extend(failures)
+            logger.warning(
+                "%d of %d calls failed, first: %s",
+                len(failures),
+                len(calls),
+                failures[0],
+            )
+        return failures
+
+    async def _run(
+        self, command: Command, semaphore: asyncio.Semaphore
+    ) -> Optional[Dict]:
+        try:
+            return await self._call(command, semaphore)
+        finally:
+            command.done()
+
+    async def _call(
+        self, command: Command, semaphore: asyncio.Semaphore
+    ) -> Optional[Dict]:
+        service = service_name(command.fn, command.args)
+        if self.metrics is not None:
+            self.metrics.called(service)
+        async with semaphore:
+            try:
+                result = command.fn(*command.args, **command.kwargs)
+                if inspect.isawaitable(result):
+                    await asyncio.wait_for(result, self.timeout)
+                return None
+            except asyncio.TimeoutError:
+                error = f"Timed out after {self.timeout} s"
+            except Exception as e:
+                error = repr(e)
+        if self.metrics is not None:
+            self.metrics.failed(service)
+        if command.on_drop is not None:
+            command.on_drop()
+        return {
+            "domain": command.domain,
+            "call": service,
+            "error": error,
+        }
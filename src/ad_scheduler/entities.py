@@ -1,9 +1,163 @@
-from typing import Iterable, Set, Optional, Union
+from typing import Any, Callable, Dict, Iterable, List, Set, Optional, Tuple, Union
 from datetime import datetime, timedelta
+from functools import partial
+import hashlib
+import threading
+import time
 
+from .dispatch import Dispatcher
+from .metrics import Metrics
 from .schedule import Entry, Schedule
 from .const import EntityKind
 
+# Services used to batch entries with the values "on", "off" and "toggle"
+SWITCH_SERVICES = {
+    "on": "homeassistant/turn_on",
+    "off": "homeassistant/turn_off",
+    "toggle": "homeassistant/toggle",
+}
+
+
+def domain_of(entity_id: str) -> str:
+    """The domain of an entity id, like :code:`light` for :code:`light.kitchen`"""
+    return entity_id.split(".", 1)[0]
+
+
+class AppliedStateCache:
+    """
+    Cache of the last entry applied to each entity, used to skip redundant updates.
+
+    The cache is only used when the current entry of a schedule is applied again, like
+    when a group is activated or assigned, its entities change, or the app restarts.
+    Transitions of a schedule are always sent, since the entities may have been changed
+    by others since the entry was last applied. Service entries are never cached, since
+    calling a service again may not be a no-op.
+
+    The cache can be shared between groups, so an entity that is in several groups is
+    tracked correctly.
+
+    Attributes:
+        verify (bool): If set, the state in Home Assistant is checked as well. A cached
+            entry is only trusted while the entity is still in the expected state, and
+            an entity that is already in the expected state is not updated even if it
+            is not cached.
+    """
+
+    def __init__(self, verify: bool = False):
+        self.verify = verify
+        self._applied: Dict[str, Tuple] = {}
+
+    @staticmethod
+    def signature(entry: Entry) -> Optional[Tuple]:
+        """Key describing what applying an entry does, or :code:`None` if it can not be skipped"""
+        if entry.is_service or (
+            isinstance(entry.value, str) and entry.value.lower() == "toggle"
+        ):
+            return None
+        return (entry.value, entry.additional_attrs)
+
+    @staticmethod
+    def expected_state(entry: Entry) -> str:
+        """The state an entity has in Home Assistant after applying an entry"""
+        if isinstance(entry.value, str) and entry.value.lower() in ("on", "off"):
+            return entry.value.lower()
+        return str(entry.value)
+
+    def pending(
+        self, api: "hass.Hass", entities: Iterable[str], entry: Entry
+    ) -> List[str]:
+        """
+        Get the entities that need to be updated to apply an entry.
+
+        Parameters:
+            api: The app used to look up states when :attr:`verify` is set
+            entities: The entity ids to check
+            entry: The entry to apply
+        """
+        sig = self.signature(entry)
+        if sig is None:
+            return list(entities)
+        if not self.verify:
+            return [e for e in entities if self._applied.get(e) != sig]
+
+        expected = self.expected_state(entry)
+        pending = []
+        for entity in entities:
+            cached = self._applied.get(entity) == sig
+            if self._has_state(api, entity, entry, expected, cached):
+                self._applied[entity] = sig
+            else:
+                pending.append(entity)
+        return pending
+
+    @staticmethod
+    def _has_state(api, entity: str, entry: Entry, expected: str, cached: bool) -> bool:
+        state: Any = api.get_state(entity, attribute="all")
+        if not isinstance(state, dict) or state.get("state") != expected:
+            return False
+        if cached or not entry.additional_attrs:
+            return True
+        if expected in ("on", "off") or not isinstance(entry.additional_attrs, dict):
+            # Service attributes like brightness do not map directly to state attributes
+            return False
+        attributes = state.get("attributes", {})
+        return all(attributes.get(k) == v for k, v in entry.additional_attrs.items())
+
+    def record(self, entities: Iterable[str], entry: Entry):
+        """Record that an entry has been applied to the given entities"""
+        sig = self.signature(entry)
+        for entity in entities:
+            if sig is None:
+                self._applied.pop(entity, None)
+            else:
+                self._applied[entity] = sig
+
+    def forget(self, entities: Iterable[str]):
+        """Forget the applied state of the given entities, so they are updated next time"""
+        for entity in entities:
+            self._applied.pop(entity, None)
+
+
+class FanOut:
+    """
+    Measures the fan-out of a group, until the last call it submitted is done.
+
+    A dispatcher may queue the calls, or make them concurrently after they are
+    submitted, so the fan-out only ends when the dispatcher reports the last call as
+    done, see :meth:`Dispatcher.submit`.
+
+    Attributes:
+        group (str): The name of the group
+        metrics (Metrics): The metrics the fan-out is recorded in
+        dispatcher (Dispatcher): The dispatcher whose clock is used
+    """
+
+    def __init__(self, group: str, metrics: Metrics, dispatcher: Dispatcher):
+        self.group = group
+        self.metrics = metrics
+        self.dispatcher = dispatcher
+        self._start = dispatcher.now()
+        # Calls not done yet, plus one until all calls are submitted
+        self._pending = 1
+        self._lock = threading.Lock()
+
+    def call(self) -> Callable[[], Any]:
+        """Count a call to be submitted, returning its :code:`on_done` callback"""
+        with self._lock:
+            self._pending += 1
+        return self._done
+
+    def submitted(self):
+        """Mark all calls as submitted"""
+        self._done()
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+            finished = self._pending == 0
+        if finished:
+            self.metrics.fan_out(self.group, self.dispatcher.now() - self._start)
+
 
 class EntityGroup:
     """
@@ -13,10 +167,32 @@ class EntityGroup:
         kind (str): The kind of devices, one of the values defined in :class:`EntityKind`
         entities (Set[str]): List of entity_ids of the entities in the group
         active (bool): Wether or not entities should be updated on schedule triggers
+        activate_at (Optional[datetime]): When the group is activated again, if it was
+            deactivated for a while
         schedule (Schedule): The schedule this group is currently assigned to
+        applied (AppliedStateCache): The last entries applied to the entities. Entities
+            already set to the current entry are not updated again when it is
+            re-applied, but always on transitions.
+        dispatcher (Optional[Dispatcher]): If set, calls to Home Assistant are sent
+            through it, to rate limit them or make them concurrently, instead of being
+            made one at a time
+        offset (float): Seconds the group is updated after its schedule triggers
+        jitter (float): Size of a window after the offset, in seconds, to spread out
+            groups sharing a schedule. See :meth:`set_stagger`.
+        metrics (Optional[Metrics]): If set, the time spent sending the calls for
+            an entry, and the calls made without a dispatcher, are recorded in it
     """
 
-    def __init__(self, name: str, kind: str, scheduler: "Scheduler", *entities: str):
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        scheduler: "Scheduler",
+        *entities: str,
+        applied: Optional[AppliedStateCache] = None,
+        dispatcher: Optional[Dispatcher] = None,
+        metrics: Optional[Metrics] = None,
+    ):
         if kind not in EntityKind.__all__:
             raise ValueError(f"Illegal group kind: {kind}")
 
@@ -26,7 +202,14 @@ class EntityGroup:
         self.active: bool = True
         self.schedule: Optional[Schedule] = None
         self.activation_timer = None
+        self.activate_at: Optional[datetime] = None
         self.scheduler = scheduler
+        self.applied = applied if applied is not None else AppliedStateCache()
+        self.dispatcher = dispatcher
+        self.offset: float = 0
+        self.jitter: float = 0
+        self.stagger_trigger = None
+        self.metrics = metrics
 
     def set_entities(self, entities: Iterable[str]):
         """
@@ -39,20 +222,197 @@ class EntityGroup:
         """
         self.entities = set(entities)
         if self.active and self.schedule is not None:
-            for entity in self.entities:
-                self.set_entity(entity, self.schedule.current_entry)
+            self.dispatch(self.entities, self.schedule.current_entry)
 
-    def schedule_changed(self, entry: Entry):
+    def schedule_changed(self, entry: Entry, transition: bool = False):
         """
         Method to call when a schedule triggers or changes.
 
         Parameters:
             entry: The current entry containing the new state
+            transition: Whether the schedule triggered. Transitions are delayed by
+                :meth:`stagger_delay`, other changes are applied right away.
         """
         if not self.active:
             return
-        for entity_id in self.entities:
-            self.set_entity(entity_id, entry)
+        delay = self.stagger_delay() if transition else 0
+        if delay <= 0:
+            self.dispatch(self.entities, entry, transition=transition)
+            return
+
+        if self.stagger_trigger is not None:
+            self.scheduler.triggers.cancel_timer(self.stagger_trigger)
+        self.stagger_trigger = self.scheduler.triggers.run_at(
+            self._staggered,
+            self.scheduler.get_now() + timedelta(seconds=delay),
+            entry=entry,
+        )
+
+    def _staggered(self, kwargs):
+        self.stagger_trigger = None
+        entry = kwargs["entry"]
+        # Anything changing the schedule in the meantime has already updated the group
+        if self.active and self.schedule and self.schedule.current_entry is entry:
+            self.dispatch(self.entities, entry, transition=True)
+
+    def set_stagger(self, offset: float = 0, jitter: float = 0):
+        """
+        Set how long transitions of the schedule are delayed for this group.
+
+        Parameters:
+            offset: Seconds to delay every transition
+            jitter: Size of a window after the offset, in seconds. The group is
+                delayed by a fixed part of the window, derived from its name.
+
+        Raises:
+            ValueError: If the offset or jitter is negative
+        """
+        if offset < 0 or jitter < 0:
+            raise ValueError("Offset and jitter can not be negative")
+        self.offset = offset
+        self.jitter = jitter
+
+    def stagger_delay(self) -> float:
+        """Seconds from a transition of the schedule until this group is updated"""
+        if not self.jitter:
+            return self.offset
+        digest = hashlib.sha1(self.name.encode("utf-8")).digest()
+        fraction = int.from_bytes(digest[:8], "big") / 2 ** 64
+        return self.offset + fraction * self.jitter
+
+    def dispatch(
+        self, entities: Iterable[str], entry: Optional[Entry], transition: bool = False
+    ):
+        """
+        Set the state of several entities.
+
+        Unless the schedule transitioned, entities that already have the entry applied
+        are skipped. Service entries and entries with the values "on", "off" and
+        "toggle" are sent as a single service call with all the remaining entities.
+        Other entries are set with :meth:`set_entity` for each entity, since
+        :code:`set_state` only accepts one. If the group has a :attr:`dispatcher`, the
+        calls are sent through it, and entities whose call is dropped or fails are
+        updated next time.
+
+        Parameters:
+            entities: The entity ids to set
+            entry: The entry to get the new state from
+            transition: Whether the schedule triggered, so all entities are set
+        """
+        if entry is None or not entities:
+            return
+
+        if transition:
+            entities = list(entities)
+        else:
+            entities = self.applied.pending(self.scheduler, entities, entry)
+        if not entities:
+            return
+
+        # Entities whose call was dropped or failed, which are updated next time
+        failed: Set[str] = set()
+
+        def on_drop(dropped: List[str]):
+            failed.update(dropped)
+            self.applied.forget(dropped)
+
+        if self.dispatcher is None or self.metrics is None:
+            start = time.perf_counter()
+            try:
+                self._send(entities, entry, on_drop)
+            finally:
+                if self.metrics is not None:
+                    self.metrics.fan_out(self.name, time.perf_counter() - start)
+        else:
+            fan_out = FanOut(self.name, self.metrics, self.dispatcher)
+            try:
+                self._send(entities, entry, on_drop, fan_out)
+            finally:
+                fan_out.submitted()
+        # Calls that are queued or in flight are recorded as applied, and forgotten
+        # again by on_drop if they fail
+        self.applied.record((e for e in entities if e not in failed), entry)
+
+    def _send(
+        self,
+        entities: List[str],
+        entry: Entry,
+        on_drop: Callable[[List[str]], Any],
+        fan_out: Optional[FanOut] = None,
+    ):
+        if entry.is_service:
+            self._call_service(
+                entities,
+                entry.value,
+                entry.additional_attrs,
+                entry.entity_identifier,
+                on_drop,
+                fan_out,
+            )
+            return
+
+        if isinstance(entry.value, str) and entry.value.lower() in SWITCH_SERVICES:
+            self._call_service(
+                entities,
+                SWITCH_SERVICES[entry.value.lower()],
+                entry.additional_attrs,
+                "entity_id",
+                on_drop,
+                fan_out,
+            )
+            return
+
+        for entity_id in entities:
+            if self.dispatcher is None:
+                self.set_entity(entity_id, entry)
+            else:
+                fn, args, kwargs = self.entity_call(entity_id, entry)
+                self.dispatcher.submit(
+                    domain_of(entity_id),
+                    1,
+                    fn,
+                    args,
+                    kwargs,
+                    on_drop=partial(on_drop, [entity_id]),
+                    on_done=fan_out.call() if fan_out is not None else None,
+                )
+
+    def _call_service(
+        self,
+        entities: Iterable[str],
+        service: str,
+        attrs: Dict,
+        identifier: str,
+        on_drop: Callable[[List[str]], Any],
+        fan_out: Optional[FanOut] = None,
+    ):
+        """
+        Call a service for several entities at once.
+
+        With a dispatcher, one call is queued for each domain, split so each call
+        changes no more entities than the domain allows at once.
+        """
+        api = self.schedule.scheduler
+        if self.dispatcher is None:
+            self._call(
+                api.call_service, (service,), {**attrs, identifier: sorted(entities)}
+            )
+            return
+
+        by_domain: Dict[str, List[str]] = {}
+        for entity in sorted(entities):
+            by_domain.setdefault(domain_of(entity), []).append(entity)
+        for domain, domain_entities in by_domain.items():
+            for chunk in self.dispatcher.chunks(domain, domain_entities):
+                self.dispatcher.submit(
+                    domain,
+                    len(chunk),
+                    api.call_service,
+                    (service,),
+                    {**attrs, identifier: chunk},
+                    on_drop=partial(on_drop, chunk),
+                    on_done=fan_out.call() if fan_out is not None else None,
+                )
 
     def set_entity(self, entity: str, entry: Entry):
         """
@@ -62,27 +422,42 @@ class EntityGroup:
             entity: The entity id to set
             entry: The entry to get the new state from
         """
+        self._call(*self.entity_call(entity, entry))
+
+    def _call(self, fn: Callable, args: tuple, kwargs: Dict):
+        if self.metrics is None:
+            fn(*args, **kwargs)
+        else:
+            self.metrics.call(fn, args, kwargs)
+
+    def entity_call(self, entity: str, entry: Entry) -> Tuple[Callable, tuple, Dict]:
+        """
+        Get the API call setting the state of a single entity.
+
+        Returns:
+            The API method, and the positional and keyword arguments to call it with
+        """
+        api = self.schedule.scheduler
         if entry.is_service:
-            self.schedule.scheduler.call_service(
-                entry.value,
-                **entry.additional_attrs,
-                **{entry.entity_identifier: entity},
+            return (
+                api.call_service,
+                (entry.value,),
+                {**entry.additional_attrs, entry.entity_identifier: entity},
             )
 
-        elif isinstance(entry.value, str):
+        if isinstance(entry.value, str):
             val = entry.value.lower()
             if val == "on":
-                self.schedule.scheduler.turn_on(entity, **entry.additional_attrs)
-                return
+                return api.turn_on, (entity,), dict(entry.additional_attrs)
             elif val == "off":
-                self.schedule.scheduler.turn_off(entity, **entry.additional_attrs)
-                return
+                return api.turn_off, (entity,), dict(entry.additional_attrs)
             elif val == "toggle":
-                self.schedule.scheduler.toggle(entity, **entry.additional_attrs)
-                return
+                return api.toggle, (entity,), dict(entry.additional_attrs)
 
-        self.schedule.scheduler.set_state(
-            entity, state=entry.value, attributes=entry.additional_attrs
+        return (
+            api.set_state,
+            (entity,),
+            {"state": entry.value, "attributes": entry.additional_attrs},
         )
 
     def remove_schedule(self):
@@ -91,8 +466,17 @@ class EntityGroup:
         """
         if self.schedule is not None:
             self.schedule.subscribers.remove(self)
+            self.schedule.subscribers_changed()
             self.schedule = None
 
+    def close(self):
+        """Remove the schedule and cancel all timers, when the group is dropped"""
+        self.remove_schedule()
+        if self.stagger_trigger is not None:
+            self.scheduler.triggers.cancel_timer(self.stagger_trigger)
+            self.stagger_trigger = None
+        self._cancel_activation()
+
     def assign_schedule(self, schedule: Schedule):
         """
         Assign a new schedule to this group.
@@ -100,7 +484,8 @@ class EntityGroup:
         The method first removes the current schedule, then sets the new one and adds
         itself to the subscribers of the schedule.
 
-        Finally, all entities are set to the current state of the schedule.
+        Finally, the schedule is armed if this group is active, and all entities are
+        set to its current state.
 
         Parameters:
             schedule: The new schedule to assign
@@ -113,17 +498,59 @@ class EntityGroup:
 
         self.schedule = schedule
         self.schedule.subscribers.append(self)
+        self.schedule.subscribers_changed()
         self.schedule_changed(self.schedule.current_entry)
 
     def deactivate_for(self, delay: Optional[Union[int, timedelta]] = None):
+        """
+        Stop updating the entities on schedule triggers.
+
+        Parameters:
+            delay: Seconds until the group is activated again, which is stored in
+                :attr:`activate_at`. Without a delay, the group stays inactive until
+                it is activated.
+        """
         self.active = False
+        self._cancel_activation()
+        # The entities may be changed by others while deactivated
+        self.applied.forget(self.entities)
+        if self.schedule:
+            self.schedule.subscribers_changed()
 
         if delay is not None:
             if isinstance(delay, timedelta):
                 delay = delay.total_seconds()
+            self.activate_at = self.scheduler.get_now() + timedelta(seconds=delay)
             self.activation_timer = self.scheduler.run_in(self.activate, delay)
 
+    def deactivate_until(self, activate_at: datetime):
+        """Deactivate the group until a time, or activate it if the time has passed"""
+        now = self.scheduler.get_now()
+        if activate_at.tzinfo is None:
+            activate_at = activate_at.replace(tzinfo=now.tzinfo)
+        remaining = (activate_at - now).total_seconds()
+        if remaining > 0:
+            self.deactivate_for(remaining)
+            self.activate_at = activate_at
+        else:
+            self.activate()
+
+    def _cancel_activation(self):
+        if self.activation_timer is not None:
+            self.scheduler.cancel_timer(self.activation_timer)
+            self.activation_timer = None
+        self.activate_at = None
+
     def activate(self, kwargs=None):
+        if kwargs is None:
+            self._cancel_activation()
+        else:
+            self.activation_timer = None
+            self.activate_at = None
         self.active = True
         if self.schedule:
+            self.schedule.subscribers_changed()
             self.schedule_changed(self.schedule.current_entry)
+        if kwargs is not None:
+            # Activated by the timer set in deactivate_for, so publish the change
+            self.scheduler.state_changed(self)
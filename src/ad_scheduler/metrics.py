@@ -0,0 +1,200 @@
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+from collections import Counter, deque
+import bisect
+import math
+import threading
+
+# Upper bounds in seconds of the histogram buckets, for delays from a millisecond to a
+# minute
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def service_name(fn: Callable, args: tuple) -> str:
+    """The service called by an API call, like :code:`light/turn_on` or :code:`set_state`"""
+    name = getattr(fn, "__name__", str(fn))
+    if name == "call_service" and args:
+        return str(args[0])
+    return name
+
+
+class Histogram:
+    """
+    Histogram of observed values, with quantiles of the most recent ones.
+
+    The bucket counts, the sum and the count cover all observations, like a Prometheus
+    histogram. The quantiles and maximum in :meth:`summary` only cover the last
+    :code:`window` observations, so they follow the current behavior.
+
+    Attributes:
+        buckets (Tuple[float, ...]): The upper bounds of the buckets, ascending
+        counts (List[int]): The number of observations in each bucket, with an extra
+            last bucket for values above the largest bound
+        count (int): The total number of observations
+        total (float): The sum of all observations
+    """
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS, window: int = 1000):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def summary(self) -> Dict[str, Any]:
+        """The count and sum of all observations, and quantiles of the recent ones"""
+        values = sorted(self.recent)
+        n = len(values)
+
+        def q(p):
+            return values[min(n - 1, max(0, math.ceil(p * n) - 1))] if n else None
+
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "recent": n,
+            "p50": q(0.5),
+            "p90": q(0.9),
+            "p99": q(0.99),
+            "max": values[-1] if n else None,
+        }
+
+
+class Metrics:
+    """
+    Timing and call metrics of a scheduler.
+
+    Attributes:
+        histograms (Dict[str, Histogram]): Histograms in seconds by name. Schedules
+            record :code:`trigger_lateness`, the time from when a transition was due
+            until it ran, and :code:`update_state`, the time spent finding the next
+            transition. Groups record :code:`fan_out`, the time from sending the
+            first call of a transition until the last one is done. With a
+            dispatcher, this includes the time calls wait in its queue or are in
+            flight.
+        groups (Dict[str, Histogram]): The fan-out durations of each group
+        calls (Counter): The number of calls to Home Assistant by service
+        failures (Counter): The number of failed calls by service
+    """
+
+    def __init__(self, window: int = 1000, group_window: int = 100):
+        self.window = window
+        self.group_window = group_window
+        self.histograms: Dict[str, Histogram] = {
+            name: Histogram(window=window)
+            for name in ("trigger_lateness", "update_state", "fan_out")
+        }
+        self.groups: Dict[str, Histogram] = {}
+        self.calls: Counter = Counter()
+        self.failures: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(window=self.window)
+            histogram.observe(seconds)
+
+    def fan_out(self, group: str, seconds: float):
+        """Record the time until the last call of a transition of a group was done"""
+        with self._lock:
+            self.histograms["fan_out"].observe(seconds)
+            histogram = self.groups.get(group)
+            if histogram is None:
+                histogram = self.groups[group] = Histogram(window=self.group_window)
+            histogram.observe(seconds)
+
+    def remove_group(self, group: str):
+        with self._lock:
+            self.groups.pop(group, None)
+
+    def called(self, service: str):
+        with self._lock:
+            self.calls[service] += 1
+
+    def failed(self, service: str):
+        with self._lock:
+            self.failures[service] += 1
+
+    def call(self, fn: Callable, args: tuple = (), kwargs: Optional[Dict] = None):
+        """Make an API call, counting it, and counting it as failed if it raises"""
+        service = service_name(fn, args)
+        self.called(service)
+        try:
+            return fn(*args, **(kwargs or {}))
+        except Exception:
+            self.failed(service)
+            raise
+
+    def summary(self, top: int = 20) -> Dict[str, Any]:
+        """
+        The metrics as a JSON serializable dict.
+
+        Parameters:
+            top: The number of groups to include, those with the slowest recent
+                fan-out first
+        """
+        with self._lock:
+            groups = sorted(
+                ((name, h.summary()) for name, h in self.groups.items()),
+                key=lambda g: g[1]["max"] or 0,
+                reverse=True,
+            )
+            return {
+                **{name: h.summary() for name, h in self.histograms.items()},
+                "calls": dict(self.calls),
+                "failures": dict(self.failures),
+                "slowest_groups": [{"name": n, **s} for n, s in groups[:top]],
+            }
+
+    def prometheus(self, labels: Optional[Dict[str, str]] = None) -> str:
+        """The metrics in the Prometheus text exposition format"""
+        base = dict(labels or {})
+
+        def fmt(extra: Optional[Dict[str, Any]] = None) -> str:
+            all_labels = {**base, **(extra or {})}
+            if not all_labels:
+                return ""
+            inner = ",".join(
+                f'{k}="{_escape(str(v))}"' for k, v in sorted(all_labels.items())
+            )
+            return "{" + inner + "}"
+
+        lines: List[str] = []
+        with self._lock:
+            for name, h in sorted(self.histograms.items()):
+                metric = f"ad_scheduler_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip((*h.buckets, math.inf), h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f"{metric}_bucket{fmt({'le': le})} {cumulative}")
+                lines.append(f"{metric}_sum{fmt()} {h.total!r}")
+                lines.append(f"{metric}_count{fmt()} {h.count}")
+
+            for metric, counter in (
+                ("ad_scheduler_calls_total", self.calls),
+                ("ad_scheduler_call_failures_total", self.failures),
+            ):
+                lines.append(f"# TYPE {metric} counter")
+                for service, count in sorted(counter.items()):
+                    lines.append(f"{metric}{fmt({'service': service})} {count}")
+
+            metric = "ad_scheduler_group_fan_out_seconds_max"
+            lines.append(f"# TYPE {metric} gauge")
+            for group, h in sorted(self.groups.items()):
+                if h.recent:
+                    lines.append(f"{metric}{fmt({'group': group})} {max(h.recent)!r}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,148 @@
+from typing import Callable, Dict, Iterable, List, Optional
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+import threading
+
+from .entities import EntityGroup
+from .schedule import Schedule
+from .storage import Storage
+from .writers import GroupsWriter, ScheduleWriter
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindStore:
+    """
+    Write-behind persistence of schedules and groups to a storage backend.
+
+    Changes are only marked when they happen. A short delay after the first change,
+    the changed objects are serialized on the AppDaemon thread, and written to the
+    storage on a single background thread, so they are written in order. Any number
+    of changes to an object within the delay results in a single write.
+
+    Attributes:
+        app (hass.Hass): The app used to schedule flushes
+        storage (Storage): The backend the changes are written to
+        delay (float): Seconds to wait after the first change before flushing
+    """
+
+    def __init__(self, app: "hass.Hass", storage: Storage, delay: float = 1):
+        self.app = app
+        self.storage = storage
+        self.delay = delay
+        # Schedule name to the schedule to write, or None if the file should be deleted
+        self._schedules: Dict[str, Optional[Schedule]] = {}
+        self._groups: Optional[Iterable[EntityGroup]] = None
+        # Groups moved to another app, written once along with the groups
+        self._handed: List[Dict] = []
+        self._pending = False
+        self._held = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ad_scheduler_store"
+        )
+
+    def schedule_changed(self, schedule: Schedule):
+        """Mark a schedule to be written"""
+        with self._lock:
+            self._schedules[schedule.name] = schedule
+        self._request_flush()
+
+    def schedule_removed(self, name: str):
+        """Mark the file of a schedule to be deleted"""
+        with self._lock:
+            self._schedules[name] = None
+        self._request_flush()
+
+    def groups_changed(self, groups: Iterable[EntityGroup]):
+        """Mark the groups to be written. The groups are read when flushing."""
+        with self._lock:
+            self._groups = groups
+        self._request_flush()
+
+    def group_handed_off(self, groups: Iterable[EntityGroup], data: Dict):
+        """
+        Mark the groups to be written, along with a group that moved to another app.
+
+        The moved group is written once, as stored by :class:`GroupsWriter`, and is
+        then in the partition of the other app.
+        """
+        with self._lock:
+            self._groups = groups
+            self._handed.append(data)
+        self._request_flush()
+
+    @contextmanager
+    def hold(self):
+        """Only mark changes within the block, and request a single flush at the end"""
+        with self._lock:
+            self._held += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held -= 1
+                changed = self._schedules or self._groups is not None
+            if changed:
+                self._request_flush()
+
+    def _request_flush(self):
+        with self._lock:
+            if self._pending or self._held:
+                return
+            self._pending = True
+        self.app.run_in(self._flush_callback, self.delay)
+
+    def _flush_callback(self, kwargs):
+        if not self._closed:
+            self.flush()
+
+    def flush(self) -> Future:
+        """
+        Serialize all changed objects and queue them for writing.
+
+        Returns:
+            A future that completes when the changes have been written
+        """
+        with self._lock:
+            schedules, self._schedules = self._schedules, {}
+            groups, self._groups = self._groups, None
+            handed, self._handed = self._handed, []
+            self._pending = False
+
+        writes = {
+            name: ScheduleWriter.schedule_to_dict(s) if s is not None else None
+            for name, s in schedules.items()
+        }
+        group_data = (
+            [GroupsWriter.group_to_dict(g) for g in groups] + handed
+            if groups is not None
+            else None
+        )
+        return self._executor.submit(self._write, writes, group_data)
+
+    def after_flush(self, fn: Callable, *args) -> Future:
+        """
+        Flush, and call a function on the background thread once the flushed changes
+        have been written.
+        """
+        self.flush()
+        return self._executor.submit(fn, *args)
+
+    def _write(self, schedules: Dict[str, Optional[Dict]], groups: Optional[list]):
+        try:
+            self.storage.write(schedules, groups)
+        except Exception:
+            logger.exception("Failed to store changes")
+
+    def close(self):
+        """Write all pending changes, stop the background thread and close the storage"""
+        if self._closed:
+            return
+        self.flush().result()
+        self._closed = True
+        self._executor.shutdown(wait=True)
+        self.storage.close()
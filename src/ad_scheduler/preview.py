@@ -0,0 +1,77 @@
+from typing import Any, Dict, Iterable, List, Tuple
+
+from bisect import bisect_left
+import datetime
+
+from .schedule import Entry, MINUTES_PER_WEEK, Schedule
+
+# A single transition: the time it happens, the entry becoming current and its value
+Row = Tuple[datetime.datetime, Entry, Any]
+
+
+def expand(
+    schedule: Schedule,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    initial: bool = False,
+) -> List[Row]:
+    """
+    Expand a schedule into all its transitions between two times.
+
+    The transitions are generated from the weekly transition table of the schedule,
+    without stepping a clock or queuing any triggers, so it can be used for
+    schedules that are not armed.
+
+    Parameters:
+        schedule: The schedule to expand
+        start: The first time included
+        end: The first time not included
+        initial: Whether to start with a row at :code:`start` for the entry that is
+            current then, so the value is known for the whole range
+
+    Returns:
+        A list of :code:`(timestamp, entry, value)` rows in ascending order
+    """
+    minutes, entries = schedule.transitions()
+    if not minutes or end <= start:
+        return []
+
+    # Midnight at the start of the monday in the week of start
+    week = start.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(
+        days=start.weekday()
+    )
+    offsets = [datetime.timedelta(minutes=m) for m in minutes]
+    one_week = datetime.timedelta(minutes=MINUTES_PER_WEEK)
+
+    # Skip the transitions of the first week that are before start
+    idx = bisect_left(offsets, start - week)
+    rows: List[Row] = []
+    if initial and (idx == len(offsets) or week + offsets[idx] != start):
+        # Index -1 wraps around to the last transition of the previous week
+        entry = entries[idx - 1]
+        rows.append((start, entry, entry.value))
+
+    while week < end:
+        for offset, entry in zip(offsets[idx:], entries[idx:]):
+            ts = week + offset
+            if ts >= end:
+                return rows
+            rows.append((ts, entry, entry.value))
+        idx = 0
+        week += one_week
+    return rows
+
+
+def expand_schedules(
+    schedules: Iterable[Schedule],
+    start: datetime.datetime,
+    end: datetime.datetime,
+    initial: bool = False,
+) -> Dict[str, List[Row]]:
+    """
+    Expand several schedules between two times, see :func:`expand`.
+
+    Returns:
+        A dict from schedule name to the rows of that schedule
+    """
+    return {s.name: expand(s, start, end, initial) for s in schedules}
@@ -0,0 +1,214 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from contextlib import contextmanager
+import cProfile
+import datetime
+import functools
+import logging
+from pathlib import Path
+import pstats
+import threading
+
+logger = logging.getLogger(__name__)
+
+TARGETS = ("triggers", "endpoints")
+
+
+class Profiler:
+    """
+    Profiles the next few triggers or endpoint calls of a running app with cProfile.
+
+    Each profiled call gets its own profile, since cProfile only follows the thread
+    it is enabled in, and the profiles are merged. When the requested number of
+    calls has been profiled, the merged stats are written to a file that can be
+    loaded with :code:`pstats`, and a summary of the slowest functions is kept in
+    :attr:`last`. Calls that are not profiled only pay for a check of a counter.
+
+    Attributes:
+        directory (Path): The directory the stats files are written to
+        prefix (str): The start of the names of the stats files
+        remaining (int): The number of calls still to be profiled
+        targets (Set[str]): The kinds of calls being profiled, see :data:`TARGETS`
+        top (int): The number of functions in the summary
+        sort (str): The :code:`pstats` sort key of the summary
+        last (Optional[Dict]): The result of the last finished profile
+    """
+
+    def __init__(self, directory: Path, prefix: str):
+        self.directory = directory
+        self.prefix = prefix
+        self.remaining = 0
+        self.targets: Set[str] = set()
+        self.top = 20
+        self.sort = "cumulative"
+        self.last: Optional[Dict[str, Any]] = None
+        self._stats: Optional[pstats.Stats] = None
+        self._profiled = 0
+        self._running = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def start(
+        self,
+        count: int,
+        targets: Iterable[str] = TARGETS,
+        top: int = 20,
+        sort: str = "cumulative",
+    ):
+        """
+        Profile the next calls, discarding any profile that is still running.
+
+        Parameters:
+            count: The number of calls to profile
+            targets: The kinds of calls to profile, from :data:`TARGETS`
+            top: The number of functions in the summary
+            sort: The :code:`pstats` sort key of the summary, like
+                :code:`cumulative` or :code:`tottime`
+
+        Raises:
+            ValueError: If the count is not positive, or the targets or sort key are
+                unknown
+        """
+        targets = set(targets)
+        if count < 1:
+            raise ValueError(f"Count must be positive: {count}")
+        if not targets or not targets <= set(TARGETS):
+            raise ValueError(f"Targets must be some of {', '.join(TARGETS)}")
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise ValueError(f"Unknown sort key: {sort}")
+        with self._lock:
+            self._generation += 1
+            self.remaining = count
+            self.targets = targets
+            self.top = top
+            self.sort = sort
+            self._stats = None
+            self._profiled = 0
+            self._running = 0
+
+    @property
+    def running(self) -> bool:
+        return self.remaining > 0 or self._running > 0
+
+    @contextmanager
+    def section(self, target: str):
+        """Profile the block if calls of the given kind are being profiled"""
+        if self.remaining <= 0:
+            yield
+            return
+        with self._lock:
+            profiled = self.remaining > 0 and target in self.targets
+            if profiled:
+                self.remaining -= 1
+                self._running += 1
+            generation = self._generation
+        if not profiled:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            logger.warning("Could not profile %s, another profiler is active", target)
+            try:
+                yield
+            finally:
+                self._add(None, generation)
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._add(profile, generation)
+
+    def wrap(self, fn: Callable, target: str = "endpoints") -> Callable:
+        """Wrap a function, so calls to it are profiled as :code:`target`"""
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.section(target):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    def _add(self, profile: Optional[cProfile.Profile], generation: int):
+        """Merge the profile of a call that has finished, if it could be profiled"""
+        with self._lock:
+            if generation != self._generation:
+                # Started before the profile was restarted or stopped
+                return
+            if profile is not None:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self._profiled += 1
+            self._running -= 1
+            done = self.remaining <= 0 and self._running <= 0
+        if done:
+            self.finish()
+
+    def finish(self) -> Optional[Dict[str, Any]]:
+        """
+        Stop profiling, and write the stats of the calls profiled so far.
+
+        Calls still being profiled are left out.
+
+        Returns:
+            The result stored in :attr:`last`, or :code:`None` if no profile was
+            running
+        """
+        with self._lock:
+            if not self.running and self._stats is None:
+                return None
+            stats, self._stats = self._stats, None
+            profiled = self._profiled
+            self._generation += 1
+            self.remaining = 0
+            self._running = 0
+
+        result: Dict[str, Any] = {"status": "done", "profiled": profiled, "path": None}
+        if stats is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            path = self.directory.joinpath(f"{self.prefix}_{stamp}.pstats")
+            try:
+                stats.dump_stats(path)
+                result["path"] = str(path)
+            except OSError:
+                logger.exception("Failed to write profile to %s", path)
+            result["total_time"] = stats.total_tt
+            result["top"] = self.summary(stats)
+        self.last = result
+        return result
+
+    def summary(self, stats: pstats.Stats) -> List[Dict[str, Any]]:
+        """The :attr:`top` functions of the stats, sorted by :attr:`sort`"""
+        stats.sort_stats(self.sort)
+        rows = []
+        for func in stats.fcn_list[: self.top]:
+            primitive, calls, total, cumulative, _ = stats.stats[func]
+            rows.append(
+                {
+                    "function": pstats.func_std_string(func),
+                    "calls": calls,
+                    "primitive_calls": primitive,
+                    "total_time": total,
+                    "cumulative_time": cumulative,
+                }
+            )
+        return rows
+
+    def status(self) -> Dict[str, Any]:
+        """The progress of a running profile, or the result of the last one"""
+        with self._lock:
+            if self.running:
+                return {
+                    "status": "running",
+                    "remaining": self.remaining,
+                    "profiled": self._profiled,
+                    "targets": sorted(self.targets),
+                }
+        return self.last if self.last is not None else {"status": "idle"}
@@ -1,16 +1,73 @@
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
+from bisect import bisect_right
 import datetime
+import time
 
 from .const import EntityKind, Days
 
 dt_getter = None
+# All registered clocks, the most recent one is used as dt_getter
+_dt_getters: List[Any] = []
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
 
 
 def dt_now() -> datetime.datetime:
     return datetime.datetime.now() if dt_getter is None else dt_getter.get_now()
 
 
+def register_clock(getter):
+    """
+    Use an object with a :code:`get_now` method as the clock for :func:`dt_now`.
+
+    Several apps running in the same process can register themselves, and the clock
+    of a remaining app is used when one of them unregisters.
+    """
+    global dt_getter
+    _dt_getters.append(getter)
+    dt_getter = getter
+
+
+def unregister_clock(getter):
+    """Stop using a clock registered with :func:`register_clock`"""
+    global dt_getter
+    if getter in _dt_getters:
+        _dt_getters.remove(getter)
+    dt_getter = _dt_getters[-1] if _dt_getters else None
+
+
+ALL_DAYS = 0b1111111
+
+# The 7-bit day masks with the order of the days reversed
+_REVERSED_DAYS = [int(f"{m:07b}"[::-1], 2) for m in range(ALL_DAYS + 1)]
+
+
+def _rotate_days(mask: int, n: int) -> int:
+    """Rotate a day mask right by n days, so bit 0 is the day that was bit n"""
+    return ((mask >> n) | (mask << (7 - n))) & ALL_DAYS
+
+
+def _first_day(rotated: int, skip_first: bool) -> int:
+    """Number of days to the first day in a rotated mask, at most 7"""
+    if skip_first:
+        rotated &= ~1
+    if not rotated:
+        return 7
+    return (rotated & -rotated).bit_length() - 1
+
+
+def days_until(mask: int, weekday: int, skip_today: bool = False) -> int:
+    """Number of days from weekday until the next day in the mask"""
+    return _first_day(_rotate_days(mask, weekday), skip_today)
+
+
+def days_since(mask: int, weekday: int, skip_today: bool = False) -> int:
+    """Number of days since the last day in the mask, counted back from weekday"""
+    return _first_day(_rotate_days(_REVERSED_DAYS[mask], 6 - weekday), skip_today)
+
+
 class Entry:
     """
     Entry class that contains information about a single step in a schedule.
@@ -25,10 +82,24 @@ class Entry:
         minute (int): The minute of the starttime
         time (datetime.time): A :code:`time`-variable representing the time given by
             :code:`hour` and :code:`minute`
+        day_mask (int): The days of the week this entry is valid, with monday as bit 0
+            and sunday as bit 6
         days (List[int]): A list containing the days of the week this entry is valid
         next_datetime (datetime.datetime): The next datetime this entry should trigger
     """
 
+    __slots__ = (
+        "value",
+        "additional_attrs",
+        "hour",
+        "minute",
+        "is_service",
+        "entity_identifier",
+        "day_mask",
+        "_next_cache",
+        "_prev_cache",
+    )
+
     def __init__(
         self,
         value: Any,
@@ -43,19 +114,21 @@ class Entry:
         self.value = value
         self.additional_attrs = additional_attrs if additional_attrs is not None else {}
 
+        datetime.time(hour=hour, minute=minute)  # Validate the time
         self.hour = hour
         self.minute = minute
-        self.time = datetime.time(hour=hour, minute=minute)
         self.is_service = is_service
         self.entity_identifier = entity_identifier
 
         if days == "daily":
-            self.days = list(map(lambda d: Days.to_int(d), Days.__all__))
+            self.day_mask = ALL_DAYS
         else:
             if not isinstance(days, list):
                 raise ValueError(
                     "Days must be either the string 'daily' or a list of day strings (e.g. 'mon', 'tue', etc., or a list of ints."
                 )
+            if not days:
+                raise ValueError("Days must not be empty")
             if isinstance(days[0], int):
                 if not all([isinstance(x, int) and 0 <= x <= 6 for x in days]):
                     raise ValueError(
@@ -68,10 +141,26 @@ class Entry:
                     )
                 days = list(map(lambda d: Days.to_int(d), days))
 
-            self.days = list(set(days))  # Remove duplicates
+            self.days = days
+
+        # (minute, result) of the last next_after and previous_before calls
+        self._next_cache: Optional[Tuple] = None
+        self._prev_cache: Optional[Tuple] = None
 
-        self.__next_datetime = None
-        self.__prev_datetime = None
+    @property
+    def days(self) -> List[int]:
+        return [d for d in range(7) if self.day_mask >> d & 1]
+
+    @days.setter
+    def days(self, days: Iterable[int]):
+        mask = 0
+        for d in days:
+            mask |= 1 << d
+        self.day_mask = mask
+
+    @property
+    def time(self) -> datetime.time:
+        return datetime.time(hour=self.hour, minute=self.minute)
 
     def __str__(self):
         return f"Entry [hour={self.hour}, minute={self.minute}, value={self.value}, attrs={self.additional_attrs}, days={self.days}]"
@@ -84,60 +173,71 @@ class Entry:
         return (
             self.hour == other.hour
             and self.minute == other.minute
-            and any([d in other.days for d in self.days])
+            and self.day_mask & other.day_mask != 0
+        )
+
+    def week_minutes(self) -> List[int]:
+        """The minutes since monday 00:00 at which this entry triggers, one per day"""
+        minute_of_day = self.hour * 60 + self.minute
+        return [
+            d * MINUTES_PER_DAY + minute_of_day
+            for d in range(7)
+            if self.day_mask >> d & 1
+        ]
+
+    def next_after(self, now: datetime.datetime) -> datetime.datetime:
+        """
+        Find the first time after :code:`now` when this entry triggers.
+
+        The result only depends on the minute of :code:`now`, so the last result is
+        cached and reused while the minute is the same.
+        """
+        minute = now.replace(second=0, microsecond=0)
+        if self._next_cache is not None and self._next_cache[0] == minute:
+            return self._next_cache[1]
+
+        # Today only counts if the start time is still ahead
+        passed = (self.hour, self.minute) <= (now.hour, now.minute)
+        diff = days_until(self.day_mask, now.weekday(), passed)
+        result = minute.replace(hour=self.hour, minute=self.minute) + datetime.timedelta(
+            days=diff
         )
+        self._next_cache = (minute, result)
+        return result
+
+    def previous_before(self, now: datetime.datetime) -> datetime.datetime:
+        """
+        Find the last time before :code:`now` when this entry triggered.
+
+        The last result is cached and reused while the minute of :code:`now` is the
+        same, except for the first instant of the minute, where an entry starting in
+        that minute has not yet triggered.
+        """
+        minute = now.replace(second=0, microsecond=0)
+        key = (minute, minute == now)
+        if self._prev_cache is not None and self._prev_cache[0] == key:
+            return self._prev_cache[1]
+
+        # Today only counts if the start time has passed
+        ahead = (self.hour, self.minute) > (now.hour, now.minute) or (
+            (self.hour, self.minute) == (now.hour, now.minute) and minute == now
+        )
+        diff = days_since(self.day_mask, now.weekday(), ahead)
+        result = minute.replace(hour=self.hour, minute=self.minute) - datetime.timedelta(
+            days=diff
+        )
+        self._prev_cache = (key, result)
+        return result
 
     @property
     def next_datetime(self):
         """Find the next date and time when this entry triggers"""
-        now = dt_now()
-        if self.__next_datetime is None or self.__next_datetime < now:
-            cur_day = now.weekday()
-            diff = [d - cur_day for d in self.days]
-            if self.time > now.time():
-                targ = 0
-            else:
-                targ = 1
-
-            best_diff = float("inf")
-            for d in diff:
-                if d < targ:
-                    d += 7
-                elif d == targ:
-                    best_diff = d
-                    break
-                if d < best_diff:
-                    best_diff = d
-            self.__next_datetime = now.replace(
-                hour=self.hour, minute=self.minute
-            ) + datetime.timedelta(days=best_diff)
-        return self.__next_datetime
+        return self.next_after(dt_now())
 
     @property
     def previous_datetime(self):
-        now = dt_now()
-        cur_day = now.weekday()
-        diff = [cur_day - d for d in self.days]
-
-        if self.time < now.time():
-            targ = 0
-        else:
-            targ = 1
-
-        best_diff = float("inf")
-        for d in diff:
-            if d < targ:
-                d += 7
-            elif d == targ:
-                best_diff = d
-                break
-            if d < best_diff:
-                best_diff = d
-        self.__prev_datetime = now.replace(
-            hour=self.hour, minute=self.minute
-        ) + datetime.timedelta(days=-best_diff)
-
-        return self.__prev_datetime
+        """Find the last date and time when this entry triggered"""
+        return self.previous_before(dt_now())
 
 
 class Schedule:
@@ -158,77 +258,255 @@ class Schedule:
             restart or when adding them.
         next_entry (Entry): The next entry that will be activated, used when the update
             is triggered.
-        scheduler (scheduler.Scheduler): The scheduler that runs the actual schedule
+        next_datetime (datetime.datetime): The time the next entry is activated
+        scheduler (scheduler.Scheduler): The scheduler that runs the actual schedule. The
+            trigger for the next entry is queued in its :code:`triggers` queue.
+        armed (bool): Whether a trigger is queued for the next entry. A schedule that
+            is not armed still finds its current and next entries when its state is
+            updated, but does not trigger.
+        on_demand (bool): Whether the schedule is disarmed when it has no active
+            subscribing groups, see :meth:`subscribers_changed`.
+        metrics (Optional[Metrics]): If set, the lateness of triggers and the time
+            spent updating the state when triggered are recorded in it
+
+    The schedule keeps an index from each weekday, hour and minute, stored as the
+    minute of the week, to the entry triggering then. It is used to check collisions
+    and look up entries without scanning all entries. A table of all transitions in a
+    week, sorted by minute of the week, is built from the index, so the current and
+    next entries are found with a binary search. The table is rebuilt lazily the first
+    time it is needed after the entries change.
     """
 
-    def __init__(self, name: str, kind: str, scheduler: "Scheduler"):
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        scheduler: "Scheduler",
+        armed: bool = True,
+        on_demand: bool = False,
+        metrics: Optional["Metrics"] = None,
+    ):
         if kind not in EntityKind.__all__:
             raise ValueError("Unknown schedule kind")
         self.kind: str = kind
         self.name: str = name
-        self.entries: List[Entry] = []
+        # Insertion ordered set of entries
+        self._entries: Dict[Entry, None] = {}
+        self._index: Dict[int, Entry] = {}
+        self._transitions: Optional[Tuple[List[int], List[Entry]]] = None
         self.subscribers: List["EntityGroup"] = []
         self.current_entry: Optional[Entry] = None
         self.next_entry: Optional[Entry] = None
+        self.next_datetime: Optional[datetime.datetime] = None
         self.next_trigger: object = None
         self.scheduler: "Scheduler" = scheduler
+        self.armed: bool = armed
+        self.on_demand: bool = on_demand
+        self.metrics = metrics
+
+    @property
+    def entries(self) -> List[Entry]:
+        """A copy of the entries in this schedule"""
+        return list(self._entries)
+
+    @entries.setter
+    def entries(self, entries: List[Entry]):
+        self._entries = dict.fromkeys(entries)
+        self._index = {m: e for e in self._entries for m in e.week_minutes()}
+        self._transitions = None
+
+    def transitions(self) -> Tuple[List[int], List[Entry]]:
+        """
+        Get the weekly transition table of this schedule.
+
+        Returns:
+            A tuple of two lists of equal length. The first contains the minutes since
+            monday 00:00 where an entry triggers, in ascending order, and the second
+            contains the entry triggering at that minute.
+        """
+        if self._transitions is None:
+            minutes = sorted(self._index)
+            self._transitions = (minutes, [self._index[m] for m in minutes])
+        return self._transitions
 
     def cancel(self):
         """Cancel the current trigger if it is set"""
         if self.next_trigger is not None:
-            if self.scheduler.timer_running(self.next_trigger):
-                self.scheduler.cancel_timer(self.next_trigger)
+            self.scheduler.triggers.cancel_timer(self.next_trigger)
             self.next_trigger = None
 
-    def get_entry(self, hour, minute, days):
-        tmp_entry = Entry(0, hour, minute, days)
+    def arm(self):
+        """Update the state and queue a trigger for the next entry, if not armed yet"""
+        if not self.armed:
+            self.armed = True
+            self.update_state()
+
+    def disarm(self):
+        """Cancel the current trigger, and stop queuing triggers"""
+        self.armed = False
+        self.cancel()
+
+    @property
+    def live(self) -> bool:
+        """Whether any subscriber is an active group"""
+        return any(getattr(sub, "active", False) for sub in self.subscribers)
 
-        first = filter(lambda e: tmp_entry.same_time(e), self.entries)
-        if first:
-            return next(first)
+    def subscribers_changed(self):
+        """
+        Arm the schedule if it has an active subscribing group.
+
+        Called by groups when they subscribe, unsubscribe, or are activated or
+        deactivated. A schedule that is armed on demand is disarmed when it has no
+        active groups left, and its state is then only updated when it is requested.
+        """
+        if self.live:
+            self.arm()
+        elif self.on_demand:
+            self.disarm()
+
+    def get_entry(self, hour, minute, days) -> Optional[Entry]:
+        """Get an entry triggering at the given time on any of the given days, if any"""
+        for m in Entry(0, hour, minute, days).week_minutes():
+            entry = self._index.get(m)
+            if entry is not None:
+                return entry
         return None
 
+    def _check_free(self, entries: List[Entry], replacing: Optional[Entry] = None):
+        """Raise a ValueError if any of the entries collide, ignoring :code:`replacing`"""
+        taken = set()
+        for entry in entries:
+            for m in entry.week_minutes():
+                existing = self._index.get(m)
+                if m in taken or (existing is not None and existing is not replacing):
+                    raise ValueError(
+                        "Trying to add a new entry that collides with an existing one."
+                    )
+                taken.add(m)
+
     def add_entry(self, entry: Entry):
         """Add a new trigger, update the state, and if the current entry has changed, update subscribers"""
-        if any([e.same_time(entry) for e in self.entries]):
-            raise ValueError(
-                "Trying to add a new entry that collides with an existing one."
-            )
-        self.entries.append(entry)
+        self.add_entries([entry])
+
+    def add_entries(self, entries: Iterable[Entry]):
+        """
+        Add several entries at once.
+
+        Collisions are checked for all entries before any of them are added, and the
+        state is only updated once, so loading a schedule arms a single trigger.
+
+        Raises:
+            ValueError: If an entry collides with an existing entry or another new one.
+                No entries are added in that case.
+        """
+        entries = list(entries)
+        self._check_free(entries)
+
+        for entry in entries:
+            self._insert(entry)
+        cur_entry = self.current_entry
+        self.update_state()
+        if self.current_entry != cur_entry:
+            self.set_subscribers(self.current_entry)
+
+    def remove_entry(self, entry: Entry):
+        """Remove an entry, update the state, and if the current entry has changed, update subscribers"""
+        self._remove(entry)
+        cur_entry = self.current_entry
+        self.update_state()
+        if self.current_entry != cur_entry:
+            self.set_subscribers(self.current_entry)
+
+    def replace_entry(self, entry: Entry, new_entry: Entry):
+        """
+        Replace an entry with a new one, updating the state once.
+
+        Raises:
+            ValueError: If the new entry collides with any entry other than the one it
+                replaces. The schedule is not changed in that case.
+        """
+        self._check_free([new_entry], replacing=entry)
+        self._remove(entry)
+        self._insert(new_entry)
         cur_entry = self.current_entry
         self.update_state()
         if self.current_entry != cur_entry:
             self.set_subscribers(self.current_entry)
 
-    def set_subscribers(self, entry):
-        """Set the state of all subscribers based on entry"""
+    def _insert(self, entry: Entry):
+        self._entries[entry] = None
+        for m in entry.week_minutes():
+            self._index[m] = entry
+        self._transitions = None
+
+    def _remove(self, entry: Entry):
+        del self._entries[entry]
+        for m in entry.week_minutes():
+            del self._index[m]
+        self._transitions = None
+
+    def set_subscribers(self, entry, transition: bool = False):
+        """
+        Set the state of all subscribers based on entry.
+
+        Parameters:
+            entry: The current entry
+            transition: Whether the entry became current because the schedule
+                triggered, which lets groups stagger their updates
+        """
         for sub in self.subscribers:
-            sub.schedule_changed(entry)
+            sub.schedule_changed(entry, transition=transition)
 
-    def update_state(self):
+    def update_state(self, now: Optional[datetime.datetime] = None):
         """
         Update the state of the schedule.
 
         This cancels the current trigger (if active), finds the current and next entries,
-        and sets up a trigger for the next.
+        and if the schedule is armed, sets up a trigger for the next.
+
+        Parameters:
+            now: The time to find the current entry for. Defaults to :func:`dt_now`,
+                which is only called once.
         """
         self.cancel()
-        if not self.entries:
+        if not self._entries:
             self.current_entry = None
             self.next_entry = None
+            self.next_datetime = None
             self.next_trigger = None
             return
 
-        now = dt_now()
-        tmp_entries = list(self.entries)
-
-        self.next_entry = min(tmp_entries, key=lambda e: e.next_datetime - now)
-        self.current_entry = min(tmp_entries, key=lambda e: now - e.previous_datetime)
-        self.next_trigger = self.scheduler.run_at(
-            self.trigger, self.next_entry.next_datetime
+        if now is None:
+            now = dt_now()
+        minutes, entries = self.transitions()
+        now_minute = now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+        # An entry is current from the start of its minute. Index -1 wraps around to
+        # the last transition of the previous week.
+        idx = bisect_right(minutes, now_minute)
+        next_idx = idx % len(minutes)
+        self.current_entry = entries[idx - 1]
+        self.next_entry = entries[next_idx]
+
+        delta = (minutes[next_idx] - now_minute) % MINUTES_PER_WEEK or MINUTES_PER_WEEK
+        self.next_datetime = now.replace(second=0, microsecond=0) + datetime.timedelta(
+            minutes=delta
         )
+        if self.armed:
+            self.next_trigger = self.scheduler.triggers.run_at(
+                self.trigger, self.next_datetime
+            )
 
     def trigger(self, kwargs):
         """Trigger callback"""
-        self.update_state()
-        self.set_subscribers(self.current_entry)
+        if self.metrics is None or self.next_datetime is None:
+            self.update_state()
+        else:
+            now = dt_now()
+            self.metrics.observe(
+                "trigger_lateness", (now - self.next_datetime).total_seconds()
+            )
+            start = time.perf_counter()
+            self.update_state(now)
+            self.metrics.observe("update_state", time.perf_counter() - start)
+        self.set_subscribers(self.current_entry, transition=True)
@@ -1,138 +1,732 @@
 from .schedule import Entry, Schedule
-from .entities import EntityGroup
+from .entities import AppliedStateCache, EntityGroup
 import ad_scheduler.schedule
-from typing import Dict
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+import threading
+import time
 
 import appdaemon.plugins.hass.hassapi as hass
 
 from pathlib import Path, PurePosixPath
 
+from .dispatch import AsyncDispatcher, Dispatcher, DispatchQueue
+from .metrics import Metrics
+from .persistence import WriteBehindStore
+from .preview import expand_schedules
+from .profiling import TARGETS, Profiler
+from .sharding import Shard
+from .storage import (
+    JournalStorage,
+    JsonStorage,
+    SQLiteStorage,
+    Storage,
+    atomic_write_text,
+)
+from .transaction import Transaction
+from .triggers import TriggerQueue
 from .writers import GroupsWriter, ScheduleWriter
 
+# Event carrying a group to the shard of its new schedule
+HANDOFF_EVENT = "ad_scheduler_group_handoff"
+
+
+class ScheduleWatcher:
+    """
+    Subscriber that marks a schedule as changed in the published scheduler state.
+
+    Attributes:
+        scheduler (Scheduler): The scheduler publishing the state
+        schedule (Schedule): The schedule that is watched
+    """
+
+    def __init__(self, scheduler: "Scheduler", schedule: Schedule):
+        self.scheduler = scheduler
+        self.schedule = schedule
+
+    @property
+    def name(self):
+        return self.scheduler.name
+
+    def schedule_changed(self, entry: Entry, transition: bool = False):
+        self.scheduler.state_changed(self.schedule)
+
 
 class Scheduler(hass.Hass):
     def initialize(self):
-        ad_scheduler.schedule.dt_getter = self
+        ad_scheduler.schedule.register_clock(self)
+
+        # All schedules share this queue, which keeps a single timer in AppDaemon
+        self.triggers = TriggerQueue(self)
+
+        # Published state of each schedule and group, rebuilt when marked dirty
+        self._states: Dict[object, Dict] = {}
+        self._dirty: Set[object] = set()
+        self._publish_pending = False
+        self._publish_held = 0
+        self._publish_lock = threading.Lock()
 
         self.root: Path = Path(self.args["root_dir"])
         self.root.mkdir(parents=True, exist_ok=True)
+        # Several apps may share the root directory, each handling a part of it
+        self.shard = Shard(
+            self.args.get("shard_index", 0), self.args.get("shard_count", 1)
+        )
+        storage = self.open_storage()
+        self.store = WriteBehindStore(self, storage, self.args.get("store_delay", 1))
+        self.journal = storage if isinstance(storage, JournalStorage) else None
+        self._replaying = False
+
+        # Trigger lateness, time spent dispatching, and calls to Home Assistant
+        self.metrics = Metrics(
+            self.args.get("metrics_window", 1000),
+            self.args.get("metrics_group_window", 100),
+        )
 
-        # Read all existing schedules
-        schedule_dir: Path = self.root.joinpath("schedules")
+        # Read all existing schedules. They are armed when a group is assigned to them.
+        # With on_demand, schedules are also disarmed while no active group uses them.
+        self.on_demand: bool = self.args.get("on_demand", False)
         self.schedules: Dict[str, Schedule] = {}
-
-        if schedule_dir.exists():
-            all_scheds = schedule_dir.glob("*.json")
-            for sched_path in all_scheds:
-                with open(sched_path, "r") as f:
-                    sched = ScheduleWriter.read_schedule(f, self)
-                    if sched.name in self.schedules:
-                        raise ValueError(
-                            f"Schedule with duplicate name found: {sched.name}"
-                        )
-                    sched.subscribers.append(self)
-                    self.schedules[sched.name] = sched
-        else:
-            schedule_dir.mkdir()
+        for data in storage.load_schedules(self.shard.owns_schedule):
+            sched = ScheduleWriter.schedule_from_dict(
+                data,
+                self,
+                armed=False,
+                on_demand=self.on_demand,
+                metrics=self.metrics,
+            )
+            if sched.name in self.schedules:
+                raise ValueError(f"Schedule with duplicate name found: {sched.name}")
+            self.watch(sched)
+            self.schedules[sched.name] = sched
+
+        # Profiles the next triggers or endpoint calls when asked to
+        self.profiler = Profiler(self.root.joinpath("profiles"), self.name)
+
+        # Calls to Home Assistant are rate limited if dispatch_rate is set, or made
+        # concurrently if dispatch is async
+        self.dispatcher: Optional[Dispatcher] = None
+        if self.args.get("dispatch_rate"):
+            if self.args.get("dispatch") == "async":
+                raise ValueError("dispatch_rate can not be used with async dispatch")
+            self.dispatcher = DispatchQueue(
+                self,
+                self.args["dispatch_rate"],
+                self.args.get("dispatch_burst"),
+                self.args.get("domain_rates"),
+                self.args.get("dispatch_backlog", 1000),
+                on_backlog=self.publish_backlog,
+                clock=self.monotonic,
+            )
+        elif self.args.get("dispatch") == "async":
+            self.dispatcher = AsyncDispatcher(
+                self,
+                self.args.get("dispatch_limit", 10),
+                self.args.get("dispatch_timeout", 10),
+            )
+        self.triggers.batch = self.trigger_batch
+        if self.dispatcher is not None:
+            self.dispatcher.metrics = self.metrics
 
         # Read all entity groups
-        self.groups: Dict[str, EntityGroup] = {}
-
-        group_path = self.root.joinpath("groups.json")
-        if group_path.exists():
-            with open(group_path, "r") as f:
-                groups, schedule_names = GroupsWriter.read_groups(
-                    f, self, self.schedules
-                )
-
-                self.groups = {g.name: g for g in groups}
+        self.applied = AppliedStateCache(self.args.get("verify_state", False))
+        groups, schedule_names = GroupsWriter.groups_from_dicts(
+            [g for g in storage.load_groups() if self.shard.owns_group_dict(g)],
+            self,
+            self.schedules,
+            applied=self.applied,
+            dispatcher=self.dispatcher,
+            metrics=self.metrics,
+        )
+        self.groups: Dict[str, EntityGroup] = {g.name: g for g in groups}
+        # Groups are handed to this shard when assigned to one of its schedules
+        if self.shard.count > 1:
+            self.listen_event(
+                self.receive_group,
+                HANDOFF_EVENT,
+                root=str(self.root),
+                shard=self.shard.index,
+            )
+
+        # Operations that can be called as endpoints, or as part of a batch
+        self.operations: Dict[str, Callable[[Dict], Tuple]] = {
+            "groups_add": self.add_entity_group,
+            "groups_edit": self.edit_entity_group,
+            "groups_delete": self.remove_entity_group,
+            "groups_activate": self.activate_group,
+            "groups_deactivate": self.deactivate_group,
+            "groups_assign": self.assign_schedule,
+            "schedules_add": self.add_schedule,
+            "schedules_edit": self.edit_schedule,
+            "schedules_delete": self.remove_schedule,
+            "entries_add": self.add_entry,
+            "entries_edit": self.edit_entry,
+            "entries_delete": self.remove_entry,
+        }
+        if self.journal is not None:
+            self.operations = {
+                op: self._journaled(op, callback)
+                for op, callback in self.operations.items()
+            }
+            self.replay_journal()
+            interval = self.args.get("compact_interval", 3600)
+            self.run_every(
+                self.compact_journal,
+                self.get_now() + timedelta(seconds=interval),
+                interval,
+            )
 
         def build_endpoint(*parts):
             return "_".join([self.name, *parts])
 
-        self.register_endpoint(self.add_entity_group, build_endpoint("groups", "add"))
-        self.register_endpoint(self.edit_entity_group, build_endpoint("groups", "edit"))
-        self.register_endpoint(
-            self.remove_entity_group, build_endpoint("groups", "delete")
-        )
-        self.register_endpoint(
-            self.activate_group, build_endpoint("groups", "activate")
-        )
-        self.register_endpoint(
-            self.deactivate_group, build_endpoint("groups", "deactivate")
-        )
-        self.register_endpoint(self.assign_schedule, build_endpoint("groups", "assign"))
-
-        self.register_endpoint(self.add_schedule, build_endpoint("schedules", "add"))
-        self.register_endpoint(self.edit_schedule, build_endpoint("schedules", "edit"))
-        self.register_endpoint(
-            self.remove_schedule, build_endpoint("schedules", "delete")
-        )
+        endpoints = {
+            **self.operations,
+            "batch": self.batch,
+            "transaction": self.transaction,
+            "export": self.export,
+            "status": self.status,
+            "preview": self.preview,
+            "metrics": self.diagnostics,
+        }
+        for endpoint, callback in endpoints.items():
+            self.register_endpoint(
+                self.profiler.wrap(callback), build_endpoint(endpoint)
+            )
+        self.register_endpoint(self.profile, build_endpoint("profile"))
+
+        # Metrics can also be written to a file for the Prometheus textfile collector
+        if self.args.get("metrics_file"):
+            interval = self.args.get("metrics_interval", 60)
+            self.run_every(
+                self.write_metrics,
+                self.get_now() + timedelta(seconds=interval),
+                interval,
+            )
 
-        self.register_endpoint(self.add_entry, build_endpoint("entries", "add"))
-        self.register_endpoint(self.edit_entry, build_endpoint("entries", "edit"))
-        self.register_endpoint(self.remove_entry, build_endpoint("entries", "delete"))
+        self.set_own_state()
 
+    def state_changed(self, *objs):
+        """
+        Mark schedules or groups as changed, and publish the new state.
+
+        Only the state of the given objects is rebuilt, and all changes made before the
+        next event loop tick are published together.
+        """
+        with self._publish_lock:
+            self._dirty.update(objs)
+            if self._publish_pending or self._publish_held:
+                return
+            self._publish_pending = True
+        self.run_in(self._publish_state, 0)
+
+    @contextmanager
+    def deferred(self):
+        """
+        Defer persisting and publishing changes until the end of the block.
+
+        All changes made within the block are stored and published once, when the
+        outermost block ends.
+        """
+        with self._publish_lock:
+            self._publish_held += 1
+        try:
+            with self.store.hold(), self.collect_calls():
+                yield
+        finally:
+            with self._publish_lock:
+                self._publish_held -= 1
+                changed = bool(self._dirty)
+            if changed:
+                self.state_changed()
+
+    @contextmanager
+    def trigger_batch(self):
+        """
+        Context of all triggers that are due at the same time.
+
+        The calls they make are sent together if async, and they are profiled as
+        one trigger when profiling.
+        """
+        with self.profiler.section("triggers"), self.collect_calls():
+            yield
+
+    def collect_calls(self):
+        """Send the calls to Home Assistant made within the block together, if async"""
+        if isinstance(self.dispatcher, AsyncDispatcher):
+            return self.dispatcher.collect()
+        return nullcontext()
+
+    def monotonic(self) -> float:
+        """Seconds from a clock that never goes back, used to limit the call rate"""
+        return time.monotonic()
+
+    def _publish_state(self, kwargs):
+        with self._publish_lock:
+            self._publish_pending = False
         self.set_own_state()
 
     def set_own_state(self):
-        state = {}
-
-        def map_entry(entry: Entry):
-            return {
-                "hour": entry.hour,
-                "minute": entry.minute,
-                "days": entry.days,
-                "value": entry.value,
-                "attrs": entry.additional_attrs,
-            }
+        """Publish the state of all schedules and groups, rebuilding the changed ones"""
+        # Schedules that are not armed are only evaluated when publishing, and only
+        # once their next entry has been reached
+        now = ad_scheduler.schedule.dt_now()
+        stale = set()
+        for schedule in self.schedules.values():
+            if schedule.armed or (
+                schedule.next_datetime is not None and schedule.next_datetime > now
+            ):
+                continue
+            current = schedule.current_entry
+            schedule.update_state(now)
+            if schedule.current_entry is not current:
+                stale.add(schedule)
+
+        with self._publish_lock:
+            dirty, self._dirty = self._dirty | stale, set()
+        for obj in dirty:
+            self._states.pop(obj, None)
+
+        def cached(obj, mapper):
+            state = self._states.get(obj)
+            if state is None:
+                state = self._states[obj] = mapper(obj)
+            return state
+
+        state = {
+            "schedules": [
+                cached(s, self.map_schedule) for s in self.schedules.values()
+            ],
+            "groups": [cached(g, self.map_group) for g in self.groups.values()],
+        }
+
+        state["shard"] = {
+            "index": self.shard.index,
+            "count": self.shard.count,
+            "root": str(self.root),
+        }
 
-        def map_schedule(schedule: Schedule):
-            return {
-                "name": schedule.name,
-                "kind": schedule.kind,
-                "current_entry": map_entry(schedule.current_entry)
-                if schedule.current_entry is not None
-                else None,
-                "next_entry": map_entry(schedule.next_entry)
-                if schedule.next_entry is not None
-                else None,
-                "entries": [map_entry(e) for e in schedule.entries],
-                "subscribers": [sub.name for sub in schedule.subscribers],
-            }
+        self.set_state(f"sensor.scheduler_{self.name}", state="on", attributes=state)
 
-        def map_group(group: EntityGroup):
-            return {
-                "name": group.name,
-                "kind": group.kind,
-                "entities": list(group.entities),
-                "active": group.active,
-                "schedule": group.schedule.name if group.schedule is not None else None,
-            }
+    @staticmethod
+    def map_entry(entry: Entry) -> Dict:
+        return {
+            "hour": entry.hour,
+            "minute": entry.minute,
+            "days": entry.days,
+            "value": entry.value,
+            "attrs": entry.additional_attrs,
+        }
+
+    @classmethod
+    def map_schedule(cls, schedule: Schedule) -> Dict:
+        return {
+            "name": schedule.name,
+            "kind": schedule.kind,
+            "current_entry": cls.map_entry(schedule.current_entry)
+            if schedule.current_entry is not None
+            else None,
+            "next_entry": cls.map_entry(schedule.next_entry)
+            if schedule.next_entry is not None
+            else None,
+            "entries": [cls.map_entry(e) for e in schedule.entries],
+            "subscribers": [sub.name for sub in schedule.subscribers],
+        }
+
+    @staticmethod
+    def map_group(group: EntityGroup) -> Dict:
+        return {
+            "name": group.name,
+            "kind": group.kind,
+            "entities": list(group.entities),
+            "active": group.active,
+            "schedule": group.schedule.name if group.schedule is not None else None,
+            "offset": group.offset,
+            "jitter": group.jitter,
+        }
+
+    def watch(self, schedule: Schedule):
+        """Subscribe to a schedule, to publish its state when it changes"""
+        schedule.subscribers.append(ScheduleWatcher(self, schedule))
+
+    def open_storage(self) -> Storage:
+        """
+        Open the storage backend selected by the :code:`storage` argument.
+
+        The :code:`json` backend stores files in the root directory. The
+        :code:`sqlite` backend stores everything in :code:`scheduler.db` in the root
+        directory. The :code:`journal` backend appends each operation to a journal,
+        which is compacted into a snapshot every :code:`compact_interval` seconds.
+        The other backends import existing JSON files when they are new.
+
+        When sharded, the groups written by this app are limited to its partition.
+        The journal backend can not be shared.
+        """
+        kind = self.args.get("storage", "json")
+        if kind == "json":
+            storage = JsonStorage(self.root, self.args.get("load_workers"))
+        elif kind == "sqlite":
+            storage = SQLiteStorage(self.root.joinpath("scheduler.db"))
+        elif kind == "journal":
+            if self.shard.count > 1:
+                raise ValueError("The journal storage can not be shared by shards")
+            storage = JournalStorage(self.root)
+        else:
+            raise ValueError(f"Unknown storage backend: {kind}")
+
+        if self.shard.count > 1:
+            storage.partition = self.shard.owns_group_dict
+        if kind == "json":
+            return storage
+
+        if storage.is_empty():
+            import_from = JsonStorage(self.root)
+            if not import_from.is_empty():
+                self.log("Importing schedules and groups from JSON files")
+                storage.write(
+                    {s["name"]: s for s in import_from.load_schedules()},
+                    import_from.load_groups(),
+                )
+        return storage
+
+    def _journaled(self, op: str, callback: Callable[[Dict], Tuple]):
+        """Wrap an operation to append it to the journal when it succeeds"""
+
+        def journaled(request: Dict):
+            body, status = callback(request)
+            if status == 200 and not self._replaying:
+                if op == "groups_deactivate" and body.get("activate_at"):
+                    # Replay relative to the time of the deactivation, not of the replay
+                    request = {"name": body["name"], "until": body["activate_at"]}
+                self.journal.append(op, request)
+            return body, status
+
+        return journaled
+
+    def replay_journal(self):
+        """Apply the operations in the journal that are not part of the snapshot"""
+        operations = {**self.operations, "transaction": self.transaction}
+        self._replaying = True
+        try:
+            with self.deferred():
+                for op, data in self.journal.tail():
+                    body, status = operations[op](data)
+                    if status != 200:
+                        self.log(f"Failed to replay {op} from journal: {body}")
+        finally:
+            self._replaying = False
+
+    def compact_journal(self, kwargs):
+        """Fold the journal into the snapshot, once all current changes are stored"""
+        self.store.after_flush(self.journal.compact, self.journal.seq)
+
+    def publish_backlog(self, depth: int):
+        """Publish the number of calls waiting in the dispatch queue"""
+        self.set_state(
+            f"sensor.scheduler_{self.name}_backlog",
+            state=depth,
+            attributes={
+                "domains": self.dispatcher.backlog(),
+                "dropped": self.dispatcher.dropped,
+            },
+        )
 
-        state["schedules"] = [map_schedule(s) for s in self.schedules.values()]
-        state["groups"] = [map_group(g) for g in self.groups.values()]
+    def terminate(self):
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        self.store.close()
+        ad_scheduler.schedule.unregister_clock(self)
 
-        self.set_state(f"sensor.scheduler_{self.name}", state="on", attributes=state)
+    def not_owned(self, what: str, name: str, owner: int) -> Optional[Tuple[str, int]]:
+        """The response for an object handled by another shard, if it is not ours"""
+        if owner == self.shard.index:
+            return None
+        return f"{what} {name} is handled by shard {owner}", 403
 
     def store_groups(self):
-        with open(self.root.joinpath("groups.json"), "w") as f:
-            GroupsWriter.write_groups(f, self.groups.values())
+        self.store.groups_changed(self.groups.values())
 
     def store_schedule(self, schedule: Schedule):
-        with open(self.root.joinpath("schedules", f"{schedule.name}.json"), "w") as f:
-            ScheduleWriter.write_schedule(f, schedule)
+        self.store.schedule_changed(schedule)
+
+    def batch(self, request: Dict):
+        """
+        Apply a list of operations, then store and publish the changes once.
+
+        Each operation is given as :code:`{"op": <operation>, "data": <request>}`, where
+        the operation is one of the keys in :attr:`operations`, e.g.
+        :code:`entries_add`. Operations are applied in order, and a failing operation
+        does not stop the rest.
+        """
+        results = []
+        with self.deferred():
+            for operation in request.get("operations", []):
+                op = operation.get("op")
+                if op not in self.operations:
+                    results.append({"status": 400, "msg": f"Unknown operation: {op}"})
+                    continue
+                try:
+                    body, status = self.operations[op](operation.get("data", {}))
+                except KeyError as e:
+                    body, status = f"Missing field: {e}", 400
+                except TypeError as e:
+                    body, status = f"Invalid field: {e}", 400
+                except ValueError as e:
+                    body, status = str(e), 403
+                result = {"status": status}
+                if status != 200:
+                    result["msg"] = body.get("msg") if isinstance(body, dict) else body
+                results.append(result)
+
+        return {"results": results}, 200
+
+    def transaction(self, request: Dict):
+        """
+        Apply a list of operations atomically.
+
+        Operations are given like in :meth:`batch`, and may be any of
+        :attr:`Transaction.OPERATIONS`. If any operation is invalid, nothing is
+        applied. Otherwise all operations are applied, and schedules, groups,
+        persistence and the published state are each updated once.
+        """
+        txn = Transaction(self)
+        for i, operation in enumerate(request.get("operations", [])):
+            op = operation.get("op")
+            try:
+                txn.add(op, operation.get("data", {}))
+                continue
+            except KeyError as e:
+                error, status = f"Missing field {e}", 400
+            except TypeError as e:
+                error, status = f"Invalid field: {e}", 400
+            except ValueError as e:
+                error, status = str(e), 403
+            return {"msg": f"Operation {i} ({op}): {error}", "index": i}, status
+
+        with self.deferred():
+            result = txn.commit()
+        if self.journal is not None and not self._replaying:
+            self.journal.append("transaction", request)
+        return result, 200
+
+    def export(self, request: Dict):
+        """
+        Write all schedules and groups as JSON files to the :code:`export` directory in
+        the root directory, in the layout read by the :code:`json` storage backend.
+        """
+        target = JsonStorage(self.root.joinpath("export"))
+        target.write(
+            {
+                name: ScheduleWriter.schedule_to_dict(s)
+                for name, s in self.schedules.items()
+            },
+            [GroupsWriter.group_to_dict(g) for g in self.groups.values()],
+        )
+        return {"path": str(target.root)}, 200
+
+    def status(self, request: Dict):
+        """
+        Combined state of all shards sharing the root directory of this app.
+
+        The state of each shard is read from the sensor it publishes, so shards may
+        run in other AppDaemon processes.
+        """
+        shards = self.shard_states()
+        return {
+            "shards": sorted(shards),
+            "missing": [i for i in range(self.shard.count) if i not in shards],
+            "schedules": [s for i in sorted(shards) for s in shards[i]["schedules"]],
+            "groups": [g for i in sorted(shards) for g in shards[i]["groups"]],
+        }, 200
+
+    def shard_states(self) -> Dict[int, Dict]:
+        """The state published by each running shard sharing the root directory"""
+        shards = {}
+        for entity_id, sensor in (self.get_state("sensor") or {}).items():
+            attributes = sensor.get("attributes", {})
+            shard = attributes.get("shard", {})
+            if (
+                entity_id.startswith("sensor.scheduler_")
+                and shard.get("root") == str(self.root)
+                and shard.get("count") == self.shard.count
+            ):
+                shards[shard["index"]] = attributes
+        return shards
+
+    def preview(self, request: Dict):
+        """
+        All transitions of schedules in a date range, for calendars and forecasts.
+
+        The request may contain the names of the :code:`schedules` to expand, which
+        defaults to all schedules of this shard, and the :code:`start` and
+        :code:`end` of the range as ISO 8601 strings. The range defaults to the
+        :code:`days` (7 by default) from the current time. Times without a timezone
+        are in the timezone of AppDaemon.
+
+        The first item of each schedule is the entry that is current at the start.
+        """
+        names = request.get("schedules", list(self.schedules))
+        for name in names:
+            if name not in self.schedules:
+                owner = self.shard.schedule_owner(name)
+                error = self.not_owned("Schedule", name, owner)
+                return error or (f"Schedule not found: {name}", 403)
+
+        now = self.get_now()
+        try:
+            start = (
+                self.parse_time(request["start"], now) if "start" in request else now
+            )
+            end = (
+                self.parse_time(request["end"], now)
+                if "end" in request
+                else start + timedelta(days=request.get("days", 7))
+            )
+        except (TypeError, ValueError) as e:
+            return {"msg": f"Invalid time range: {e}"}, 400
+
+        rows = expand_schedules(
+            (self.schedules[name] for name in names), start, end, initial=True
+        )
+        return {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "schedules": {
+                name: [
+                    {"time": ts.isoformat(), **self.map_entry(entry)}
+                    for ts, entry, _ in schedule_rows
+                ]
+                for name, schedule_rows in rows.items()
+            },
+        }, 200
+
+    @staticmethod
+    def parse_time(value: str, now: datetime) -> datetime:
+        """Parse an ISO 8601 time, using the timezone of :code:`now` if it has none"""
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=now.tzinfo)
+        return parsed
+
+    def diagnostics(self, request: Dict):
+        """
+        Timing and call metrics, see :class:`Metrics`.
+
+        Lateness tells whether triggers run late in AppDaemon, and fan-out and call
+        failures whether updates are slow to reach Home Assistant. The request may
+        give the number of slowest groups to include as :code:`top`.
+        """
+        result = self.metrics.summary(request.get("top", 20))
+        result["pending_triggers"] = len(self.triggers)
+        if isinstance(self.dispatcher, DispatchQueue):
+            result["dispatch"] = {
+                "backlog": self.dispatcher.backlog(),
+                "dropped": self.dispatcher.dropped,
+            }
+        elif isinstance(self.dispatcher, AsyncDispatcher):
+            result["dispatch"] = {
+                "failed": self.dispatcher.failed,
+                "recent_failures": list(self.dispatcher.failures)[-10:],
+            }
+        return result, 200
+
+    def profile(self, request: Dict):
+        """
+        Profile the next triggers or endpoint calls with cProfile.
+
+        A request with a :code:`count` starts profiling that many calls. It may
+        give the :code:`target` to profile, :code:`triggers`, :code:`endpoints` or
+        :code:`all` (the default), the number of functions in the summary as
+        :code:`top`, and the :code:`sort` key of the summary. A request with
+        :code:`stop` finishes a running profile early.
+
+        When done, the stats are written to the :code:`profiles` directory in the
+        root directory. Every request returns the progress of the running profile,
+        or the path and summary of the last one. All triggers due at the same time
+        count as one trigger. With async dispatch, the time spent in the calls
+        themselves is not included, since they run in the event loop.
+        """
+        if request.get("stop"):
+            return self.profiler.finish() or self.profiler.status(), 200
+
+        if "count" in request:
+            target = request.get("target", "all")
+            try:
+                self.profiler.start(
+                    request["count"],
+                    TARGETS if target == "all" else [target],
+                    request.get("top", 20),
+                    request.get("sort", "cumulative"),
+                )
+            except (TypeError, ValueError) as e:
+                return {"msg": str(e)}, 400
+        return self.profiler.status(), 200
+
+    def metrics_path(self) -> Path:
+        """The file written by :meth:`write_metrics`, given by :code:`metrics_file`"""
+        name = self.args.get("metrics_file")
+        if not isinstance(name, str):
+            name = f"metrics_{self.name}.prom"
+        return self.root.joinpath(name)
+
+    def write_metrics(self, kwargs=None):
+        """Write the metrics in the Prometheus text format to :meth:`metrics_path`"""
+        text = self.metrics.prometheus({"app": self.name})
+        atomic_write_text(self.metrics_path(), text)
+
+    def new_schedule(self, name: str, kind: str) -> Schedule:
+        """Create a schedule, which is only armed when used if running on demand"""
+        return Schedule(
+            name,
+            kind,
+            self,
+            armed=not self.on_demand,
+            on_demand=self.on_demand,
+            metrics=self.metrics,
+        )
+
+    def new_group(self, name: str, kind: str, entities) -> EntityGroup:
+        """Create an entity group using the state cache, dispatcher and metrics of this app"""
+        return EntityGroup(
+            name,
+            kind,
+            self,
+            *entities,
+            applied=self.applied,
+            dispatcher=self.dispatcher,
+            metrics=self.metrics,
+        )
+
+    @staticmethod
+    def entry_from_request(request: Dict) -> Entry:
+        """Create an entry from the fields of an :code:`entries_add` request"""
+        return Entry(
+            request["value"],
+            request["hour"],
+            request["minute"],
+            request.get("days", "daily"),
+            request.get("attrs", {}),
+            request.get("is_service", False),
+            request.get("entity_identifier", "entity_id"),
+        )
 
     def add_entity_group(self, request: Dict):
         name = request["name"]
         if name in self.groups:
             return f"Group with name {name} already exists", 403
+        error = self.not_owned("Group", name, self.shard.group_owner(name, None))
+        if error:
+            return error
 
-        entities = request.get("entities", [])
-        eg = EntityGroup(request["name"], request["kind"], self, *entities)
+        eg = self.new_group(name, request["kind"], request.get("entities", []))
+        try:
+            eg.set_stagger(request.get("offset", 0), request.get("jitter", 0))
+        except ValueError as e:
+            return {"msg": str(e)}, 403
         self.groups[name] = eg
         self.store_groups()
-        self.set_own_state()
+        self.state_changed(eg)
         return GroupsWriter.group_to_dict(eg), 200
 
     def edit_entity_group(self, request: Dict):
@@ -140,24 +734,39 @@ class Scheduler(hass.Hass):
         if name not in self.groups:
             return f"Group not found: {name}", 403
 
+        offset = request.get("offset", self.groups[name].offset)
+        jitter = request.get("jitter", self.groups[name].jitter)
+        if offset < 0 or jitter < 0:
+            return {"msg": "Offset and jitter can not be negative"}, 403
+
         if "new_name" in request:
             new_name = request["new_name"]
             if new_name in self.groups:
                 return f"Group with name {new_name} already exists", 403
+            schedule = self.groups[name].schedule
+            error = self.not_owned(
+                "Group",
+                new_name,
+                self.shard.group_owner(new_name, schedule and schedule.name),
+            )
+            if error:
+                return error
 
             self.groups[new_name] = self.groups[name]
             self.groups[new_name].name = new_name
             del self.groups[name]
+            self.metrics.remove_group(name)
             name = new_name
 
         group = self.groups[name]
         group.kind = request.get("kind", group.kind)
+        group.set_stagger(offset, jitter)
 
         if "entities" in request:
             group.set_entities(request["entities"])
 
         self.store_groups()
-        self.set_own_state()
+        self.state_changed(group, group.schedule)
         return GroupsWriter.group_to_dict(group), 200
 
     def remove_entity_group(self, request: Dict):
@@ -166,12 +775,14 @@ class Scheduler(hass.Hass):
             return f"Group not found: {name}", 403
 
         group = self.groups[name]
-        group.remove_schedule()
+        schedule = group.schedule
+        group.close()
 
         del self.groups[name]
+        self.metrics.remove_group(name)
 
         self.store_groups()
-        self.set_own_state()
+        self.state_changed(group, schedule)
 
         return {"msg": f"Group {name} removed"}, 200
 
@@ -183,7 +794,7 @@ class Scheduler(hass.Hass):
         self.groups[name].activate()
 
         self.store_groups()
-        self.set_own_state()
+        self.state_changed(self.groups[name])
 
         return GroupsWriter.group_to_dict(self.groups[name]), 200
 
@@ -194,10 +805,13 @@ class Scheduler(hass.Hass):
 
         group = self.groups[name]
 
-        group.deactivate_for(request.get("delay", None))
+        if "until" in request:
+            group.deactivate_until(self.parse_time(request["until"], self.get_now()))
+        else:
+            group.deactivate_for(request.get("delay", None))
 
         self.store_groups()
-        self.set_own_state()
+        self.state_changed(group)
 
         return GroupsWriter.group_to_dict(group), 200
 
@@ -207,40 +821,126 @@ class Scheduler(hass.Hass):
 
         if groupname not in self.groups:
             return f"Group not found: {groupname}", 403
+        group = self.groups[groupname]
+        old_schedule = group.schedule
 
         if schedulename == "":
-            self.groups[groupname].remove_schedule()
+            owner = self.shard.group_owner(groupname, None)
+            if owner != self.shard.index:
+                return self.hand_off_group(group, None, owner)
+            group.remove_schedule()
             self.store_groups()
-            self.set_own_state()
+            self.state_changed(group, old_schedule)
             return "", 200
 
         if schedulename not in self.schedules:
+            owner = self.shard.schedule_owner(schedulename)
+            if owner != self.shard.index:
+                return self.hand_off_group(group, schedulename, owner)
             return f"Schedule not found: {schedulename}", 403
 
-        self.groups[groupname].assign_schedule(self.schedules[schedulename])
+        group.assign_schedule(self.schedules[schedulename])
 
         self.store_groups()
-        self.set_own_state()
+        self.state_changed(group, old_schedule, group.schedule)
 
         return "", 200
 
+    def hand_off_group(
+        self, group: EntityGroup, schedule_name: Optional[str], owner: int
+    ):
+        """
+        Move a group to the shard that handles it after assigning a schedule.
+
+        The group is removed here, and written to the shared storage with its new
+        schedule, which puts it in the partition of the other shard, so that shard
+        loads it when it starts. Once written, it is sent in a :data:`HANDOFF_EVENT`
+        through Home Assistant, which reaches shards running in other AppDaemon
+        instances, so a running shard adds it right away, see :meth:`receive_group`.
+        The schedule is looked up in the state published by that shard.
+        """
+        shard = self.shard_states().get(owner)
+        if shard is None:
+            return f"Shard {owner} handling group {group.name} not found", 403
+        if schedule_name is not None:
+            kinds = {s["name"]: s["kind"] for s in shard["schedules"]}
+            if schedule_name not in kinds:
+                return f"Schedule not found: {schedule_name}", 403
+            if kinds[schedule_name] != group.kind:
+                return (
+                    f"Incompatible schedule kind: entities are {group.kind}, "
+                    f"schedule is {kinds[schedule_name]}",
+                    403,
+                )
+
+        data = GroupsWriter.group_to_dict(group)
+        data["schedule_name"] = schedule_name
+        schedule = group.schedule
+        group.close()
+        del self.groups[group.name]
+        self.metrics.remove_group(group.name)
+        self.store.group_handed_off(self.groups.values(), data)
+        self.store.flush().result()
+        self.state_changed(group, schedule)
+
+        self.fire_event(
+            HANDOFF_EVENT,
+            root=str(self.root),
+            shard=owner,
+            sender=self.shard.index,
+            group=data,
+        )
+        return {"msg": f"Group {group.name} moved to shard {owner}"}, 200
+
+    def receive_group(self, event_name: str, data: Dict, kwargs: Dict):
+        """
+        Add a group handed off by another shard, see :meth:`hand_off_group`.
+
+        The group may already have been loaded from the storage, if this shard
+        started after it was handed off.
+        """
+        name = data["group"]["name"]
+        if name in self.groups:
+            if GroupsWriter.group_to_dict(self.groups[name]) != data["group"]:
+                self.log(
+                    f"Group {name} from shard {data['sender']} already exists",
+                    level="WARNING",
+                )
+            return
+        with self.deferred():
+            [group], _ = GroupsWriter.groups_from_dicts(
+                [data["group"]],
+                self,
+                self.schedules,
+                applied=self.applied,
+                dispatcher=self.dispatcher,
+                metrics=self.metrics,
+            )
+            self.groups[name] = group
+            self.store_groups()
+            self.state_changed(group, group.schedule)
+
+            # The schedule may have been removed in the meantime
+            owner = self.shard.group_owner(name, None)
+            if group.schedule is None and owner != self.shard.index:
+                self.hand_off_group(group, None, owner)
+
     def add_schedule(self, request: Dict):
         name = request["name"]
         if name in self.schedules:
             return f"Schedule already exists: {name}", 403
+        error = self.not_owned("Schedule", name, self.shard.schedule_owner(name))
+        if error:
+            return error
 
-        sched = Schedule(name, request["kind"], self)
+        sched = self.new_schedule(name, request["kind"])
         self.schedules[name] = sched
+        self.watch(sched)
 
         self.store_schedule(sched)
-        self.set_own_state()
-
-        sched.subscribers.append(self)
+        self.state_changed(sched)
         return ScheduleWriter.schedule_to_dict(sched), 200
 
-    def schedule_changed(self, entry: Entry):
-        self.set_own_state()
-
     def edit_schedule(self, request: Dict):
         name = request["name"]
         if name not in self.schedules:
@@ -250,21 +950,30 @@ class Scheduler(hass.Hass):
             new_name = request["new_name"]
             if new_name in self.schedules:
                 return f"Schedule with name {new_name} already exists", 403
+            error = self.not_owned(
+                "Schedule", new_name, self.shard.schedule_owner(new_name)
+            )
+            if error:
+                return error
 
             self.schedules[new_name] = self.schedules[name]
             del self.schedules[name]
             self.schedules[new_name].name = new_name
 
-            p = self.root.joinpath("schedules", f"{name}.json")
-            if p.exists():
-                p.unlink()
+            self.store.schedule_removed(name)
+            # Groups are stored with the name of their schedule
+            self.store_groups()
             name = new_name
 
         schedule = self.schedules[name]
         schedule.kind = request.get("kind", schedule.kind)
 
         self.store_schedule(schedule)
-        self.set_own_state()
+        # Groups show the name of their schedule
+        self.state_changed(
+            schedule,
+            *[sub for sub in schedule.subscribers if isinstance(sub, EntityGroup)],
+        )
         return ScheduleWriter.schedule_to_dict(schedule), 200
 
     def remove_schedule(self, request: Dict):
@@ -272,12 +981,12 @@ class Scheduler(hass.Hass):
         if name not in self.schedules:
             return f"Schedule not found: {name}", 403
 
+        schedule = self.schedules[name]
+        schedule.disarm()
         del self.schedules[name]
-        p = self.root.joinpath("schedules", f"{name}.json")
-        if p.exists():
-            p.unlink()
+        self.store.schedule_removed(name)
 
-        self.set_own_state()
+        self.state_changed(schedule)
         return {"msg": f"Schedule {name} removed"}, 200
 
     def add_entry(self, request: Dict):
@@ -287,24 +996,13 @@ class Scheduler(hass.Hass):
             return f"Schedule not found: {schedulename}", 403
         schedule = self.schedules[schedulename]
 
-        value = request["value"]
-        hour = request["hour"]
-        minute = request["minute"]
-        days = request.get("days", "daily")
-        attrs = request.get("attrs", {})
-
-        is_service = request.get("is_service", False)
-        entity_identifier = request.get("entity_identifier", "entity_id")
-
-        entry = Entry(value, hour, minute, days, attrs, is_service, entity_identifier)
-
         try:
-            schedule.add_entry(entry)
+            schedule.add_entry(self.entry_from_request(request))
         except ValueError as e:
             return {"msg": str(e)}, 403
 
         self.store_schedule(schedule)
-        self.set_own_state()
+        self.state_changed(schedule)
         return ScheduleWriter.schedule_to_dict(schedule), 200
 
     def edit_entry(self, request: Dict):
@@ -325,7 +1023,7 @@ class Scheduler(hass.Hass):
         new_minute = request.get("new_minute", entry.minute)
         new_days = request.get("new_days", entry.days)
         new_value = request.get("new_value", entry.value)
-        new_attrs = request.get("new_attrs", entry.attrs)
+        new_attrs = request.get("new_attrs", entry.additional_attrs)
         new_is_service = request.get("new_is_service", entry.is_service)
         new_entity_identifier = request.get(
             "new_entity_identifier", entry.entity_identifier
@@ -341,11 +1039,13 @@ class Scheduler(hass.Hass):
             new_entity_identifier,
         )
 
-        schedule.entries.remove(entry)
-        schedule.add_entry(new_entry)
+        try:
+            schedule.replace_entry(entry, new_entry)
+        except ValueError as e:
+            return {"msg": str(e)}, 403
 
         self.store_schedule(schedule)
-        self.set_own_state()
+        self.state_changed(schedule)
 
         return ScheduleWriter.schedule_to_dict(schedule), 200
 
@@ -363,10 +1063,9 @@ class Scheduler(hass.Hass):
         if entry is None:
             return "No entry with given spec found", 403
 
-        schedule.entries.remove(entry)
-        schedule.trigger()
+        schedule.remove_entry(entry)
 
         self.store_schedule(schedule)
-        self.set_own_state()
+        self.state_changed(schedule)
 
         return ScheduleWriter.schedule_to_dict(schedule), 200
@@ -0,0 +1,48 @@
+from typing import Dict, Optional
+
+import hashlib
+
+
+def shard_of(key: str, count: int) -> int:
+    """The shard of a name, which is the same in every process and on every restart"""
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+class Shard:
+    """
+    The part of a shared store handled by one of several Scheduler apps.
+
+    Schedules are partitioned by the hash of their name. Groups belong to the shard
+    of their schedule, so a schedule and all groups using it are handled by the same
+    app. Groups without a schedule are partitioned by the hash of their own name. A
+    group that is assigned a schedule handled by another shard, or unassigned on a
+    shard other than that of its name, moves there, see
+    :meth:`Scheduler.hand_off_group`.
+
+    Attributes:
+        index (int): The index of this shard
+        count (int): The number of shards sharing the store
+    """
+
+    def __init__(self, index: int = 0, count: int = 1):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}")
+        self.index = index
+        self.count = count
+
+    def schedule_owner(self, name: str) -> int:
+        return shard_of(name, self.count)
+
+    def group_owner(self, name: str, schedule_name: Optional[str]) -> int:
+        return shard_of(schedule_name if schedule_name else name, self.count)
+
+    def owns_schedule(self, name: str) -> bool:
+        return self.schedule_owner(name) == self.index
+
+    def owns_group(self, name: str, schedule_name: Optional[str] = None) -> bool:
+        return self.group_owner(name, schedule_name) == self.index
+
+    def owns_group_dict(self, d: Dict) -> bool:
+        """Check if this shard owns a group as stored by :class:`GroupsWriter`"""
+        return self.owns_group(d["name"], d["schedule_name"])
@@ -0,0 +1,422 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from collections import Counter
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import math
+import tempfile
+import threading
+from types import SimpleNamespace
+
+from .scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class VirtualClock:
+    """
+    A clock that only moves when told to, running the timers that become due.
+
+    Implements the timer part of the AppDaemon API. Several simulated apps can share a
+    clock, and their timers then run in the order they are due.
+
+    Attributes:
+        now (datetime.datetime): The current time of the clock
+        fired (int): The number of timer callbacks run so far
+    """
+
+    # Positions in the handle lists stored in the heap
+    _WHEN, _SEQ, _CALLBACK, _KWARGS, _INTERVAL = range(5)
+
+    def __init__(self, start: Optional[datetime.datetime] = None):
+        if start is None:
+            # Midnight at the start of this week, so simulations start on a monday
+            today = datetime.datetime.now().replace(
+                hour=0, minute=0, second=0, microsecond=0
+            )
+            start = today - datetime.timedelta(days=today.weekday())
+        self.now = start
+        self.fired = 0
+        self._heap: List[list] = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return sum(1 for h in self._heap if h[self._CALLBACK] is not None)
+
+    def get_now(self) -> datetime.datetime:
+        return self.now
+
+    def run_at(
+        self, callback: Callable[[Dict], Any], start: datetime.datetime, **kwargs
+    ) -> list:
+        """
+        Run :code:`callback(kwargs)` at :code:`start`.
+
+        Like AppDaemon, a start that has passed is moved forward by whole days, so it
+        runs at the same time of day as soon as possible.
+        """
+        if start < self.now:
+            logger.warning("run_at start %s has passed, running the next day", start)
+            days = math.ceil((self.now - start) / datetime.timedelta(days=1))
+            start += datetime.timedelta(days=days)
+        return self._add(callback, start, kwargs)
+
+    def run_in(self, callback: Callable[[Dict], Any], delay: float, **kwargs) -> list:
+        """Run :code:`callback(kwargs)` in :code:`delay` seconds"""
+        # Round up, so waiting for a fraction of a microsecond moves the clock
+        delta = datetime.timedelta(microseconds=math.ceil(delay * 1e6))
+        return self._add(callback, self.now + delta, kwargs)
+
+    def run_every(
+        self,
+        callback: Callable[[Dict], Any],
+        start: Union[datetime.datetime, str],
+        interval: float,
+        **kwargs,
+    ) -> list:
+        """Run :code:`callback(kwargs)` from :code:`start`, every :code:`interval` seconds"""
+        when = self.now if start == "now" else max(start, self.now)
+        return self._add(
+            callback, when, kwargs, datetime.timedelta(seconds=interval)
+        )
+
+    def cancel_timer(self, handle: list):
+        handle[self._CALLBACK] = None
+        handle[self._KWARGS] = None
+
+    def timer_running(self, handle: list) -> bool:
+        return handle[self._CALLBACK] is not None
+
+    def _add(self, callback, when, kwargs, interval=None) -> list:
+        handle = [when, next(self._counter), callback, kwargs, interval]
+        heapq.heappush(self._heap, handle)
+        return handle
+
+    def next_time(self) -> Optional[datetime.datetime]:
+        """The time of the earliest pending timer, or :code:`None` if there is none"""
+        while self._heap and self._heap[0][self._CALLBACK] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0][self._WHEN] if self._heap else None
+
+    def run_until(self, until: datetime.datetime) -> int:
+        """
+        Move the clock to :code:`until`, running all timers due until then.
+
+        The clock is set to the due time of each timer before it runs, and timers
+        added by callbacks run in the same call if they are due.
+
+        Returns:
+            The number of callbacks run
+        """
+        fired = 0
+        while True:
+            when = self.next_time()
+            if when is None or when > until:
+                break
+            handle = heapq.heappop(self._heap)
+            callback, kwargs = handle[self._CALLBACK], handle[self._KWARGS]
+            self.now = max(self.now, when)
+            interval = handle[self._INTERVAL]
+            if interval is not None:
+                handle[self._WHEN] = when + interval
+                heapq.heappush(self._heap, handle)
+            else:
+                self.cancel_timer(handle)
+            fired += 1
+            try:
+                callback(kwargs)
+            except Exception:
+                logger.exception("Timer callback failed: %s", callback)
+        self.now = max(self.now, until)
+        self.fired += fired
+        return fired
+
+    def advance(self, delta: Union[datetime.timedelta, float]) -> int:
+        """Move the clock forward by a timedelta or a number of seconds, see :meth:`run_until`"""
+        if not isinstance(delta, datetime.timedelta):
+            delta = datetime.timedelta(seconds=delta)
+        return self.run_until(self.now + delta)
+
+
+class SimulatedHass:
+    """
+    The part of Home Assistant shared by simulated apps: entity states and events.
+
+    Apps sharing it see the states set by each other, like the sensors published by
+    other shards, and receive the events fired by each other.
+
+    Attributes:
+        states (Dict[str, Dict]): The state and attributes of each entity
+    """
+
+    def __init__(self):
+        self.states: Dict[str, Dict] = {}
+        self._listeners: List[list] = []
+
+    def listen(
+        self, clock: VirtualClock, callback: Callable, event: Optional[str], filters
+    ) -> list:
+        handle = [clock, callback, event, filters]
+        self._listeners.append(handle)
+        return handle
+
+    def cancel(self, handle: list):
+        if handle in self._listeners:
+            self._listeners.remove(handle)
+
+    def fire(self, event: str, data: Dict):
+        """
+        Deliver an event to all listeners whose event and filters match.
+
+        Like in AppDaemon, callbacks are not run by the caller, but on the next run of
+        the clock of the listening app.
+        """
+        for clock, callback, name, filters in list(self._listeners):
+            if name is not None and name != event:
+                continue
+            if any(data.get(key) != value for key, value in filters.items()):
+                continue
+            clock.run_in(
+                self._deliver, 0, listener=callback, event=event, data=data, kw=filters
+            )
+
+    @staticmethod
+    def _deliver(kwargs):
+        kwargs["listener"](kwargs["event"], kwargs["data"], kwargs["kw"])
+
+
+class SimulatedScheduler(Scheduler):
+    """
+    A :class:`Scheduler` running in-process against a stand-in for Home Assistant.
+
+    The AppDaemon API used by the scheduler is implemented on top of a
+    :class:`VirtualClock` and a dict of entity states, so schedules can be run for
+    weeks in seconds, without AppDaemon or Home Assistant. Service calls are counted,
+    and :code:`homeassistant/turn_on`, :code:`turn_off` and :code:`toggle` update the
+    state of their entities. Endpoints are called with :meth:`call_endpoint`. Apps
+    simulating shards can share a :class:`SimulatedHass`, to see each other's states
+    and events.
+
+    The app is initialized when created, with :code:`root_dir` defaulting to a new
+    temporary directory. With :code:`dispatch: async`, an event loop runs in a thread
+    in place of the loop of AppDaemon.
+
+    Attributes:
+        clock (VirtualClock): The clock used for :code:`get_now` and all timers
+        hass (SimulatedHass): The entity states and events of Home Assistant
+        states (Dict[str, Dict]): The state and attributes of each entity
+        endpoints (Dict[str, Callable]): The registered endpoints by name
+        call_counts (Counter): The number of calls of each service
+        calls (Optional[List[Tuple]]): The time, service and arguments of each call,
+            if recorded
+    """
+
+    def __init__(
+        self,
+        args: Optional[Dict] = None,
+        clock: Optional[VirtualClock] = None,
+        name: str = "scheduler",
+        record: bool = False,
+        hass: Optional[SimulatedHass] = None,
+    ):
+        self._name = name
+        self.args = dict(args or {})
+        if "root_dir" not in self.args:
+            self.args["root_dir"] = tempfile.mkdtemp(prefix="ad_scheduler_")
+        self.clock = clock if clock is not None else VirtualClock()
+        self.hass = hass if hass is not None else SimulatedHass()
+        self.states: Dict[str, Dict] = self.hass.states
+        self.endpoints: Dict[str, Callable] = {}
+        self.call_counts: Counter = Counter()
+        self.calls: Optional[List[Tuple]] = [] if record else None
+        # Timers and listeners of this app, cancelled when it is closed
+        self._timers: List[list] = []
+        self._prune_at = 64
+        self._listeners: List[list] = []
+
+        self.AD = SimpleNamespace(loop=None, main_thread_id=None)
+        self._loop_thread: Optional[threading.Thread] = None
+        if self.args.get("dispatch") == "async":
+            self.AD.loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(
+                target=self.AD.loop.run_forever, daemon=True
+            )
+            self._loop_thread.start()
+
+        self.initialize()
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def close(self):
+        """
+        Terminate the app, and stop its event loop if it has one.
+
+        Like in AppDaemon, all timers and event listeners of the app are cancelled,
+        so a clock or Home Assistant shared with other apps no longer runs them.
+        """
+        self.terminate()
+        for handle in self._timers:
+            self.clock.cancel_timer(handle)
+        self._timers = []
+        for handle in self._listeners:
+            self.hass.cancel(handle)
+        self._listeners = []
+        if self._loop_thread is not None:
+            self.AD.loop.call_soon_threadsafe(self.AD.loop.stop)
+            self._loop_thread.join()
+            self.AD.loop.close()
+            self._loop_thread = None
+
+    # Time and timers
+
+    def get_now(self) -> datetime.datetime:
+        return self.clock.now
+
+    def monotonic(self) -> float:
+        return self.clock.now.timestamp()
+
+    def run_at(self, callback, start, **kwargs):
+        return self._track(self.clock.run_at(callback, start, **kwargs))
+
+    def run_in(self, callback, delay, **kwargs):
+        return self._track(self.clock.run_in(callback, delay, **kwargs))
+
+    def run_every(self, callback, start, interval, **kwargs):
+        return self._track(self.clock.run_every(callback, start, interval, **kwargs))
+
+    def _track(self, handle: list) -> list:
+        self._timers.append(handle)
+        if len(self._timers) >= self._prune_at:
+            # Forget the timers that ran or were cancelled
+            self._timers = [h for h in self._timers if self.clock.timer_running(h)]
+            self._prune_at = max(64, 2 * len(self._timers))
+        return handle
+
+    def cancel_timer(self, handle):
+        self.clock.cancel_timer(handle)
+
+    def timer_running(self, handle) -> bool:
+        return self.clock.timer_running(handle)
+
+    # Entity states and services
+
+    def _record(self, service: str, args: tuple, kwargs: Dict):
+        self.call_counts[service] += 1
+        if self.calls is not None:
+            self.calls.append((self.clock.now, service, args, kwargs))
+
+    def set_state(self, entity_id: str, state=None, attributes=None, **kwargs):
+        self._record(
+            "set_state", (entity_id,), {"state": state, "attributes": attributes}
+        )
+        current = self.states.setdefault(entity_id, {"state": None, "attributes": {}})
+        if state is not None:
+            current["state"] = state
+        if attributes:
+            current["attributes"].update(attributes)
+        current["last_changed"] = self.clock.now.isoformat()
+        return current
+
+    def get_state(
+        self, entity_id: Optional[str] = None, attribute: Optional[str] = None, **kwargs
+    ):
+        """
+        Get the state of an entity, like AppDaemon.
+
+        Without an entity id, or with only a domain, the full states of all matching
+        entities are returned by entity id. With :code:`attribute="all"`, the full
+        state of the entity is returned, and with any other attribute its value.
+        """
+        if entity_id is None or "." not in entity_id:
+            return {
+                e: s
+                for e, s in self.states.items()
+                if entity_id is None or e.split(".", 1)[0] == entity_id
+            }
+        state = self.states.get(entity_id)
+        if state is None:
+            return None
+        if attribute == "all":
+            return state
+        if attribute is not None:
+            return state["attributes"].get(attribute)
+        return state["state"]
+
+    def call_service(self, service: str, **kwargs):
+        self._record(service, (), kwargs)
+        new_state = {
+            "homeassistant/turn_on": "on",
+            "homeassistant/turn_off": "off",
+            "homeassistant/toggle": None,
+        }
+        if service in new_state:
+            entities = kwargs.get("entity_id", [])
+            if isinstance(entities, str):
+                entities = [entities]
+            for entity in entities:
+                self._switch(entity, new_state[service])
+
+    def turn_on(self, entity_id: str, **kwargs):
+        self._record("turn_on", (entity_id,), kwargs)
+        self._switch(entity_id, "on", kwargs)
+
+    def turn_off(self, entity_id: str, **kwargs):
+        self._record("turn_off", (entity_id,), kwargs)
+        self._switch(entity_id, "off", kwargs)
+
+    def toggle(self, entity_id: str, **kwargs):
+        self._record("toggle", (entity_id,), kwargs)
+        self._switch(entity_id, None, kwargs)
+
+    def _switch(self, entity_id: str, state: Optional[str], attributes=None):
+        """Set an entity on or off, or toggle it if the state is :code:`None`"""
+        current = self.states.setdefault(entity_id, {"state": "off", "attributes": {}})
+        if state is None:
+            state = "off" if current["state"] == "on" else "on"
+        current["state"] = state
+        if attributes:
+            current["attributes"].update(attributes)
+        current["last_changed"] = self.clock.now.isoformat()
+
+    # Events
+
+    def listen_event(self, callback: Callable, event: Optional[str] = None, **kwargs):
+        """Listen for an event, or all events, with data matching the keyword arguments"""
+        handle = self.hass.listen(self.clock, callback, event, kwargs)
+        self._listeners.append(handle)
+        return handle
+
+    def cancel_listen_event(self, handle):
+        self.hass.cancel(handle)
+        if handle in self._listeners:
+            self._listeners.remove(handle)
+
+    def fire_event(self, event: str, **kwargs):
+        self._record("fire_event", (event,), kwargs)
+        self.hass.fire(event, kwargs)
+
+    # Endpoints and logging
+
+    def register_endpoint(self, callback: Callable, endpoint: Optional[str] = None):
+        self.endpoints[endpoint if endpoint is not None else self.name] = callback
+        return endpoint
+
+    def call_endpoint(self, endpoint: str, data: Optional[Dict] = None) -> Tuple:
+        """
+        Call an endpoint by its full name, or by the name without the app prefix.
+
+        Returns:
+            The body and status code returned by the endpoint
+        """
+        callback = self.endpoints.get(endpoint) or self.endpoints[
+            f"{self.name}_{endpoint}"
+        ]
+        return callback(data if data is not None else {})
+
+    def log(self, msg: str, *args, level: str = "INFO", **kwargs):
+        logger.log(logging.getLevelName(level), msg, *args)
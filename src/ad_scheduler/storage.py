@@ -0,0 +1,614 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from json.decoder import JSONDecodeError
+from pathlib import Path
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write_json(path: Path, data: Any):
+    """Write data as JSON to a file, replacing it atomically"""
+    atomic_write_text(path, json.dumps(data))
+
+
+def atomic_write_text(path: Path, text: str):
+    """
+    Write text to a file, replacing it atomically.
+
+    The text is written to a temporary file in the same directory, which is then
+    renamed over the target, so a crash never leaves a partially written file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class Storage(ABC):
+    """
+    Storage backend for schedules and groups.
+
+    Schedules and groups are passed to and from the backend as the dicts created by
+    :meth:`ScheduleWriter.schedule_to_dict` and :meth:`GroupsWriter.group_to_dict`.
+    Writes may be called from a background thread, but never concurrently.
+
+    Attributes:
+        partition (Optional[Callable[[Dict], bool]]): When several apps share the
+            storage, the groups of this app. Writing the groups only replaces the
+            groups in the partition, and keeps the others.
+    """
+
+    partition: Optional[Callable[[Dict], bool]] = None
+
+    @abstractmethod
+    def load_schedules(
+        self, include: Optional[Callable[[str], bool]] = None
+    ) -> List[Dict]:
+        """Read all schedules, or only those with a name for which include is true"""
+
+    @abstractmethod
+    def load_groups(self) -> List[Dict]:
+        """Read all groups"""
+
+    @abstractmethod
+    def is_empty(self) -> bool:
+        """Check if nothing has been stored yet"""
+
+    @abstractmethod
+    def write(self, schedules: Dict[str, Optional[Dict]], groups: Optional[List[Dict]]):
+        """
+        Store changes.
+
+        Parameters:
+            schedules: Schedules to store by name. A value of :code:`None` deletes the
+                schedule.
+            groups: All groups in the partition, or :code:`None` if the groups have not
+                changed.
+        """
+
+    def close(self):
+        pass
+
+
+class JsonStorage(Storage):
+    """
+    Storage in a directory, with one JSON file per schedule in :code:`schedules` and
+    all groups in :code:`groups.json`.
+
+    Schedule files are read and parsed on a thread pool, so slow storage is read with
+    several requests in flight.
+
+    Attributes:
+        root (Path): The directory to store in
+        workers (Optional[int]): Number of threads reading schedule files. Defaults
+            to the :class:`ThreadPoolExecutor` default.
+    """
+
+    def __init__(self, root: Path, workers: Optional[int] = None):
+        self.root = root
+        self.workers = workers
+        self.root.joinpath("schedules").mkdir(parents=True, exist_ok=True)
+
+    def schedule_path(self, name: str) -> Path:
+        return self.root.joinpath("schedules", f"{name}.json")
+
+    def groups_path(self) -> Path:
+        return self.root.joinpath("groups.json")
+
+    def schedule_paths(self) -> List[Path]:
+        return list(self.root.joinpath("schedules").glob("*.json"))
+
+    @staticmethod
+    def _read(path: Path) -> Dict:
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def load_schedules(
+        self, include: Optional[Callable[[str], bool]] = None
+    ) -> List[Dict]:
+        paths = [p for p in self.schedule_paths() if include is None or include(p.stem)]
+        if len(paths) <= 1:
+            return [self._read(p) for p in paths]
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="ad_scheduler_load"
+        ) as executor:
+            return list(executor.map(self._read, paths))
+
+    def load_groups(self) -> List[Dict]:
+        if not self.groups_path().exists():
+            return []
+        with open(self.groups_path(), "r") as f:
+            try:
+                return json.load(f)
+            except JSONDecodeError as e:
+                logger.warning("Failed to read groups from file: %s", e)
+                return []
+
+    def is_empty(self) -> bool:
+        return not self.groups_path().exists() and not self.schedule_paths()
+
+    def write(self, schedules: Dict[str, Optional[Dict]], groups: Optional[List[Dict]]):
+        for name, data in schedules.items():
+            path = self.schedule_path(name)
+            try:
+                if data is None:
+                    if path.exists():
+                        path.unlink()
+                else:
+                    atomic_write_json(path, data)
+            except OSError:
+                logger.exception("Failed to store schedule %s", name)
+        if groups is not None:
+            try:
+                if self.partition is None:
+                    atomic_write_json(self.groups_path(), groups)
+                else:
+                    self._write_partition(groups)
+            except OSError:
+                logger.exception("Failed to store groups")
+
+    def _write_partition(self, groups: List[Dict]):
+        # Other apps write their own partition of the same file
+        with open(self.root.joinpath(".groups.lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # A group handed over by another app may still be stored in its partition
+            names = {g["name"] for g in groups}
+            others = [
+                g
+                for g in self.load_groups()
+                if not self.partition(g) and g["name"] not in names
+            ]
+            atomic_write_json(self.groups_path(), others + groups)
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in an SQLite database.
+
+    Each entry and each group is a row, so storing a schedule only writes the entries
+    that were added, changed or removed, and all schedules are read with a single
+    query. Entries are keyed by their schedule, time and days, which no two entries
+    of a schedule share.
+
+    Attributes:
+        path (Path): The database file
+    """
+
+    ENTRIES_TABLE = """
+        CREATE TABLE IF NOT EXISTS entries (
+            schedule TEXT NOT NULL REFERENCES schedules(name) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            minute INTEGER NOT NULL,
+            day_mask INTEGER NOT NULL,
+            value TEXT NOT NULL,
+            attrs TEXT NOT NULL,
+            is_service INTEGER NOT NULL,
+            entity_identifier TEXT NOT NULL,
+            PRIMARY KEY (schedule, hour, minute, day_mask)
+        );
+    """
+
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS schedules (
+            name TEXT PRIMARY KEY,
+            kind TEXT NOT NULL
+        );
+        {ENTRIES_TABLE}
+        CREATE TABLE IF NOT EXISTS groups (
+            name TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            active INTEGER NOT NULL,
+            schedule_name TEXT,
+            entities TEXT NOT NULL,
+            "offset" REAL NOT NULL DEFAULT 0,
+            jitter REAL NOT NULL DEFAULT 0,
+            activate_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS groups_schedule ON groups(schedule_name);
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Update tables created by earlier versions"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(groups)")}
+        with self._conn:
+            for column in ('"offset"', "jitter"):
+                if column.strip('"') not in columns:
+                    self._conn.execute(
+                        f"ALTER TABLE groups ADD COLUMN {column} REAL NOT NULL DEFAULT 0"
+                    )
+            if "activate_at" not in columns:
+                self._conn.execute("ALTER TABLE groups ADD COLUMN activate_at TEXT")
+
+        # Entries used to be keyed by their position in the schedule
+        info = self._conn.execute("PRAGMA table_info(entries)").fetchall()
+        if "position" in {row[1] for row in info if row[5]}:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.execute("ALTER TABLE entries RENAME TO entries_by_position")
+                self._conn.execute(self.ENTRIES_TABLE)
+                self._conn.execute(
+                    "INSERT INTO entries SELECT * FROM entries_by_position"
+                )
+                self._conn.execute("DROP TABLE entries_by_position")
+
+    @staticmethod
+    def _days_to_mask(days: Iterable[int]) -> int:
+        mask = 0
+        for d in days:
+            mask |= 1 << d
+        return mask
+
+    def load_schedules(
+        self, include: Optional[Callable[[str], bool]] = None
+    ) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT s.name, s.kind, e.hour, e.minute, e.day_mask, e.value, e.attrs,
+                       e.is_service, e.entity_identifier
+                FROM schedules s LEFT JOIN entries e ON e.schedule = s.name
+                ORDER BY s.name, e.position
+                """
+            ).fetchall()
+
+        schedules: Dict[str, Dict] = {}
+        for name, kind, hour, minute, mask, value, attrs, is_service, ident in rows:
+            if include is not None and not include(name):
+                continue
+            schedule = schedules.setdefault(
+                name, {"name": name, "kind": kind, "entries": []}
+            )
+            if hour is None:
+                continue  # Schedule without entries
+            schedule["entries"].append(
+                {
+                    "value": json.loads(value),
+                    "hour": hour,
+                    "minute": minute,
+                    "days": [d for d in range(7) if mask >> d & 1],
+                    "attrs": json.loads(attrs),
+                    "is_service": bool(is_service),
+                    "entity_identifier": ident,
+                }
+            )
+        return list(schedules.values())
+
+    def load_groups(self) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, kind, active, schedule_name, entities, "
+                '"offset", jitter, activate_at FROM groups ORDER BY position'
+            ).fetchall()
+        return [
+            {
+                "name": name,
+                "kind": kind,
+                "active": bool(active),
+                "schedule_name": schedule_name,
+                "entities": json.loads(entities),
+                "offset": offset,
+                "jitter": jitter,
+                "activate_at": activate_at,
+            }
+            for (
+                name,
+                kind,
+                active,
+                schedule_name,
+                entities,
+                offset,
+                jitter,
+                activate_at,
+            ) in rows
+        ]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not any(
+                self._conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+                for table in ("schedules", "groups")
+            )
+
+    def write(self, schedules: Dict[str, Optional[Dict]], groups: Optional[List[Dict]]):
+        with self._lock, self._conn:
+            # Take the write lock before reading the groups of other apps, like the
+            # lock file of the JSON storage
+            self._conn.execute("BEGIN IMMEDIATE")
+            for name, data in schedules.items():
+                self._write_schedule(name, data)
+            if groups is not None:
+                self._write_groups(groups)
+
+    def _write_schedule(self, name: str, data: Optional[Dict]):
+        if data is None:
+            self._conn.execute("DELETE FROM schedules WHERE name = ?", (name,))
+            return
+
+        self._conn.execute(
+            "INSERT INTO schedules (name, kind) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET kind = excluded.kind "
+            "WHERE kind IS NOT excluded.kind",
+            (name, data["kind"]),
+        )
+
+        rows = [
+            (
+                name,
+                i,
+                e["hour"],
+                e["minute"],
+                self._days_to_mask(e["days"]),
+                json.dumps(e["value"]),
+                json.dumps(e.get("attrs", {})),
+                int(e.get("is_service", False)),
+                e.get("entity_identifier", "entity_id"),
+            )
+            for i, e in enumerate(data["entries"])
+        ]
+        keys = {row[2:5] for row in rows}
+        stored = self._conn.execute(
+            "SELECT hour, minute, day_mask FROM entries WHERE schedule = ?", (name,)
+        )
+        self._conn.executemany(
+            "DELETE FROM entries "
+            "WHERE schedule = ? AND hour = ? AND minute = ? AND day_mask = ?",
+            [(name, *key) for key in stored.fetchall() if key not in keys],
+        )
+        # Only entries that were added or changed are written
+        self._conn.executemany(
+            """
+            INSERT INTO entries (
+                schedule, position, hour, minute, day_mask, value, attrs, is_service,
+                entity_identifier
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(schedule, hour, minute, day_mask) DO UPDATE SET
+                position = excluded.position,
+                value = excluded.value,
+                attrs = excluded.attrs,
+                is_service = excluded.is_service,
+                entity_identifier = excluded.entity_identifier
+            WHERE (position, value, attrs, is_service, entity_identifier)
+                IS NOT (excluded.position, excluded.value, excluded.attrs,
+                        excluded.is_service, excluded.entity_identifier)
+            """,
+            rows,
+        )
+
+    def _write_groups(self, groups: List[Dict]):
+        names = [g["name"] for g in groups]
+        if self.partition is None:
+            self._conn.execute(
+                f"DELETE FROM groups WHERE name NOT IN ({','.join('?' * len(names))})",
+                names,
+            )
+        else:
+            rows = self._conn.execute("SELECT name, schedule_name FROM groups")
+            keep = set(names)
+            self._conn.executemany(
+                "DELETE FROM groups WHERE name = ?",
+                [
+                    (name,)
+                    for name, schedule_name in rows.fetchall()
+                    if name not in keep
+                    and self.partition({"name": name, "schedule_name": schedule_name})
+                ],
+            )
+        self._conn.executemany(
+            """
+            INSERT INTO groups (
+                name, position, kind, active, schedule_name, entities, "offset", jitter,
+                activate_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                position = excluded.position,
+                kind = excluded.kind,
+                active = excluded.active,
+                schedule_name = excluded.schedule_name,
+                entities = excluded.entities,
+                "offset" = excluded."offset",
+                jitter = excluded.jitter,
+                activate_at = excluded.activate_at
+            WHERE (
+                position, kind, active, schedule_name, entities, "offset", jitter,
+                activate_at
+            ) IS NOT (
+                excluded.position, excluded.kind, excluded.active,
+                excluded.schedule_name, excluded.entities, excluded."offset",
+                excluded.jitter, excluded.activate_at
+            )
+            """,
+            [
+                (
+                    g["name"],
+                    i,
+                    g["kind"],
+                    int(g["active"]),
+                    g["schedule_name"],
+                    json.dumps(sorted(g["entities"])),
+                    g.get("offset", 0),
+                    g.get("jitter", 0),
+                    g.get("activate_at"),
+                )
+                for i, g in enumerate(groups)
+            ],
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JournalStorage(Storage):
+    """
+    Storage as a snapshot plus an append-only journal of operations.
+
+    Every successful operation is appended to :code:`journal.jsonl` as one line, so
+    a change costs a single append. :code:`snapshot.json` holds all schedules and
+    groups up to some journal line, and :meth:`compact` folds the journal into a new
+    snapshot. On startup, the snapshot is loaded and the operations after it are
+    replayed, see :meth:`tail`.
+
+    Journal lines are numbered, and the snapshot records the number of the last line
+    it contains, so lines already in the snapshot are never replayed, even if the
+    journal could not be truncated after writing the snapshot.
+
+    Attributes:
+        root (Path): The directory containing the snapshot and the journal
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.snapshot_path = root.joinpath("snapshot.json")
+        self.journal_path = root.joinpath("journal.jsonl")
+        self._lock = threading.Lock()
+
+        snapshot = {"seq": 0, "schedules": {}, "groups": []}
+        if self.snapshot_path.exists():
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+        self._snapshot_seq: int = snapshot["seq"]
+        self._schedules: Dict[str, Dict] = snapshot["schedules"]
+        self._groups: List[Dict] = snapshot["groups"]
+        # Whether the state differs from the snapshot
+        self._dirty = False
+
+        self._tail = [
+            line for line in self._read_journal() if line["seq"] > self._snapshot_seq
+        ]
+        self.seq: int = self._tail[-1]["seq"] if self._tail else self._snapshot_seq
+        self._file = open(self.journal_path, "a")
+        if self._file.tell() > 0:
+            with open(self.journal_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read() != b"\n":
+                    # Terminate a partial last line, so the next append starts a new one
+                    self._file.write("\n")
+                    self._file.flush()
+
+    def _read_journal(self) -> List[Dict]:
+        if not self.journal_path.exists():
+            return []
+        lines = []
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    lines.append(json.loads(line))
+                except JSONDecodeError:
+                    # Only the last line can be partial, if writing it was interrupted
+                    logger.warning("Skipping unreadable journal line: %s", line)
+        return lines
+
+    def tail(self) -> List[Tuple[str, Dict]]:
+        """The operations that are not part of the snapshot, as (operation, data)"""
+        return [(line["op"], line["data"]) for line in self._tail]
+
+    def append(self, op: str, data: Dict):
+        """Durably append an operation to the journal"""
+        with self._lock:
+            self.seq += 1
+            line = {"seq": self.seq, "time": time.time(), "op": op, "data": data}
+            self._file.write(json.dumps(line) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def load_schedules(
+        self, include: Optional[Callable[[str], bool]] = None
+    ) -> List[Dict]:
+        return [
+            s
+            for name, s in self._schedules.items()
+            if include is None or include(name)
+        ]
+
+    def load_groups(self) -> List[Dict]:
+        return list(self._groups)
+
+    def is_empty(self) -> bool:
+        return not self._schedules and not self._groups and not self._tail
+
+    def write(self, schedules: Dict[str, Optional[Dict]], groups: Optional[List[Dict]]):
+        """Update the state that is written by the next compaction"""
+        with self._lock:
+            for name, data in schedules.items():
+                if data is None:
+                    self._schedules.pop(name, None)
+                else:
+                    self._schedules[name] = data
+            if groups is not None:
+                self._groups = groups
+            self._dirty = True
+
+    def compact(self, seq: Optional[int] = None):
+        """
+        Write a snapshot and remove the journal lines it contains.
+
+        Parameters:
+            seq: The number of the last journal line contained in the current state.
+                Defaults to the last line of the journal.
+        """
+        with self._lock:
+            if seq is None:
+                seq = self.seq
+            if seq <= self._snapshot_seq and not self._dirty:
+                return
+            atomic_write_json(
+                self.snapshot_path,
+                {"seq": seq, "schedules": self._schedules, "groups": self._groups},
+            )
+            self._snapshot_seq = seq
+            self._dirty = False
+
+            self._file.close()
+            fd, tmp = tempfile.mkstemp(
+                dir=self.root, prefix=f".{self.journal_path.name}.", suffix=".tmp"
+            )
+            with os.fdopen(fd, "w") as f:
+                for line in self._read_journal():
+                    if line["seq"] > seq:
+                        f.write(json.dumps(line) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.journal_path)
+            self._file = open(self.journal_path, "a")
+
+    def close(self):
+        self.compact()
+        with self._lock:
+            self._file.close()
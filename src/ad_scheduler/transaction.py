@@ -0,0 +1,192 @@
+from typing import Dict, List, Optional, Set
+
+from .const import EntityKind
+from .entities import EntityGroup
+from .schedule import Entry, Schedule
+from .writers import GroupsWriter, ScheduleWriter
+
+
+class Transaction:
+    """
+    A set of operations that are validated together and applied together.
+
+    Operations are checked against a shadow copy of the scheduler state when they
+    are added, so nothing is changed until :meth:`commit` is called, and commit only
+    runs once all operations are known to be valid. At commit, each schedule gets all
+    its new entries in one :meth:`Schedule.add_entries` call, so it updates its state
+    and trigger once, and each group is assigned its final schedule once.
+
+    Supported operations are :code:`schedules_add`, :code:`entries_add`,
+    :code:`groups_add` and :code:`groups_assign`, taking the same data as the
+    endpoints of the same name.
+
+    Attributes:
+        scheduler (Scheduler): The scheduler the operations are applied to
+    """
+
+    OPERATIONS = ("schedules_add", "entries_add", "groups_add", "groups_assign")
+
+    def __init__(self, scheduler: "Scheduler"):
+        self.scheduler = scheduler
+        # Shadow state: kinds of all schedules and groups, and the taken minutes of
+        # schedules that get new entries
+        self._schedule_kinds: Dict[str, str] = {
+            name: s.kind for name, s in scheduler.schedules.items()
+        }
+        self._group_kinds: Dict[str, str] = {
+            name: g.kind for name, g in scheduler.groups.items()
+        }
+        self._taken: Dict[str, Set[int]] = {}
+
+        self._new_schedules: Dict[str, str] = {}
+        self._new_entries: Dict[str, List[Entry]] = {}
+        self._new_groups: Dict[str, Dict] = {}
+        self._assignments: Dict[str, Optional[str]] = {}
+
+    def add(self, op: str, data: Dict):
+        """
+        Validate an operation and add it to the transaction.
+
+        Raises:
+            ValueError: If the operation is unknown or not valid
+            KeyError: If a required field is missing
+            TypeError: If a field has the wrong type, like a string offset
+        """
+        if op not in self.OPERATIONS:
+            raise ValueError(f"Unsupported operation: {op}")
+        getattr(self, f"_add_{op}")(data)
+
+    def _add_schedules_add(self, data: Dict):
+        name = data["name"]
+        if name in self._schedule_kinds:
+            raise ValueError(f"Schedule already exists: {name}")
+        if data["kind"] not in EntityKind.__all__:
+            raise ValueError("Unknown schedule kind")
+        self._check_owner("Schedule", name, self.scheduler.shard.schedule_owner(name))
+        self._schedule_kinds[name] = data["kind"]
+        self._new_schedules[name] = data["kind"]
+
+    def _add_entries_add(self, data: Dict):
+        name = data["schedule"]
+        if name not in self._schedule_kinds:
+            raise ValueError(f"Schedule not found: {name}")
+        entry = self.scheduler.entry_from_request(data)
+
+        if name not in self._taken:
+            schedule = self.scheduler.schedules.get(name)
+            self._taken[name] = (
+                set(schedule.transitions()[0]) if schedule is not None else set()
+            )
+        taken = self._taken[name]
+        minutes = entry.week_minutes()
+        if any(m in taken for m in minutes):
+            raise ValueError(
+                "Trying to add a new entry that collides with an existing one."
+            )
+        taken.update(minutes)
+        self._new_entries.setdefault(name, []).append(entry)
+
+    def _add_groups_add(self, data: Dict):
+        name = data["name"]
+        if name in self._group_kinds:
+            raise ValueError(f"Group with name {name} already exists")
+        if data["kind"] not in EntityKind.__all__:
+            raise ValueError(f"Illegal group kind: {data['kind']}")
+        entities = data.get("entities", [])
+        if not isinstance(entities, list) or not all(
+            isinstance(e, str) for e in entities
+        ):
+            raise TypeError("Entities must be a list of entity ids")
+        self._check_owner("Group", name, self.scheduler.shard.group_owner(name, None))
+        if data.get("offset", 0) < 0 or data.get("jitter", 0) < 0:
+            raise ValueError("Offset and jitter can not be negative")
+        self._group_kinds[name] = data["kind"]
+        self._new_groups[name] = data
+
+    def _add_groups_assign(self, data: Dict):
+        group = data["group"]
+        schedule = data["schedule"]
+        if group not in self._group_kinds:
+            raise ValueError(f"Group not found: {group}")
+        # Moving a group to another shard can not be part of a transaction
+        if schedule == "":
+            self._check_owner(
+                "Group", group, self.scheduler.shard.group_owner(group, None)
+            )
+            self._assignments[group] = None
+            return
+        if schedule not in self._schedule_kinds:
+            self._check_owner(
+                "Schedule", schedule, self.scheduler.shard.schedule_owner(schedule)
+            )
+            raise ValueError(f"Schedule not found: {schedule}")
+        if self._schedule_kinds[schedule] != self._group_kinds[group]:
+            raise ValueError(
+                f"Incompatible schedule kind: entities are {self._group_kinds[group]}, "
+                f"schedule is {self._schedule_kinds[schedule]}"
+            )
+        self._assignments[group] = schedule
+
+    def _check_owner(self, what: str, name: str, owner: int):
+        if owner != self.scheduler.shard.index:
+            raise ValueError(f"{what} {name} is handled by shard {owner}")
+
+    def commit(self) -> Dict:
+        """
+        Apply all operations.
+
+        Returns:
+            The resulting state of all schedules and groups that were changed
+        """
+        scheduler = self.scheduler
+        changed_schedules: Dict[str, Schedule] = {}
+        changed_groups: Dict[str, EntityGroup] = {}
+
+        # Create all new objects first, so nothing is changed if one can not be
+        new_schedules = {
+            name: scheduler.new_schedule(name, kind)
+            for name, kind in self._new_schedules.items()
+        }
+        new_groups = {}
+        for name, data in self._new_groups.items():
+            group = scheduler.new_group(name, data["kind"], data.get("entities", []))
+            group.set_stagger(data.get("offset", 0), data.get("jitter", 0))
+            new_groups[name] = group
+
+        for name, schedule in new_schedules.items():
+            scheduler.schedules[name] = schedule
+            scheduler.watch(schedule)
+            changed_schedules[name] = schedule
+
+        for name, entries in self._new_entries.items():
+            schedule = scheduler.schedules[name]
+            schedule.add_entries(entries)
+            changed_schedules[name] = schedule
+
+        for name, group in new_groups.items():
+            scheduler.groups[name] = group
+            changed_groups[name] = group
+
+        for name, schedule_name in self._assignments.items():
+            group = scheduler.groups[name]
+            if group.schedule is not None:
+                changed_schedules[group.schedule.name] = group.schedule
+            if schedule_name is None:
+                group.remove_schedule()
+            else:
+                group.assign_schedule(scheduler.schedules[schedule_name])
+                changed_schedules[schedule_name] = group.schedule
+            changed_groups[name] = group
+
+        for schedule in changed_schedules.values():
+            scheduler.store_schedule(schedule)
+        if changed_groups:
+            scheduler.store_groups()
+        scheduler.state_changed(*changed_schedules.values(), *changed_groups.values())
+
+        return {
+            "schedules": [
+                ScheduleWriter.schedule_to_dict(s) for s in changed_schedules.values()
+            ],
+            "groups": [GroupsWriter.group_to_dict(g) for g in changed_groups.values()],
+        }
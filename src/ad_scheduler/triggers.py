@@ -0,0 +1,156 @@
+from typing import Any, Callable, ContextManager, Dict, List, Optional
+
+from contextlib import nullcontext
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TriggerQueue:
+    """
+    Queue of upcoming schedule triggers, backed by a single AppDaemon timer.
+
+    The queue mirrors the part of the AppDaemon scheduling API used by
+    :class:`ad_scheduler.schedule.Schedule`: :code:`run_at` returns a handle, which
+    can be passed to :code:`cancel_timer` and :code:`timer_running`. All pending
+    triggers are kept in a min-heap, and only the earliest of them has a timer armed
+    in AppDaemon. When that timer fires, every trigger that is due is dispatched
+    before the timer is re-armed for the new earliest trigger.
+
+    Cancelled triggers are left in the heap and skipped when they reach the top, so
+    cancelling never touches the AppDaemon timer. Once they outnumber the pending
+    triggers, the heap is rebuilt without them, so it does not grow with the number
+    of cancellations.
+
+    Triggers that become due while others are dispatched, for instance because the
+    calls take longer than the stagger of a group, are dispatched before the timer is
+    re-armed. The timer is never armed for a time that has passed, since AppDaemon
+    would run it the next day.
+
+    Attributes:
+        app (hass.Hass): The app used to arm the AppDaemon timer
+        batch (Optional[Callable[[], ContextManager]]): If set, all triggers that are
+            due together are run within a single :code:`with batch():` block
+    """
+
+    # Positions in the handle lists stored in the heap
+    _WHEN, _SEQ, _CALLBACK, _KWARGS = range(4)
+
+    def __init__(self, app: "hass.Hass"):
+        self.app = app
+        self._heap: List[list] = []
+        self._counter = itertools.count()
+        self._live = 0
+        self._timer = None
+        self._timer_at: Optional[datetime.datetime] = None
+        self._dispatching = False
+        self._lock = threading.RLock()
+        self.batch: Optional[Callable[[], ContextManager]] = None
+
+    def __len__(self):
+        return self._live
+
+    def run_at(
+        self, callback: Callable[[Dict], Any], when: datetime.datetime, **kwargs
+    ) -> list:
+        """
+        Add a trigger calling :code:`callback(kwargs)` at :code:`when`.
+
+        Returns:
+            A handle that can be given to :meth:`cancel_timer`.
+        """
+        with self._lock:
+            handle = [when, next(self._counter), callback, kwargs]
+            heapq.heappush(self._heap, handle)
+            self._live += 1
+            if not self._dispatching and (
+                self._timer_at is None or when < self._timer_at
+            ):
+                self._arm()
+            return handle
+
+    def cancel_timer(self, handle: list):
+        """Cancel a trigger. Cancelling a trigger that already ran does nothing."""
+        with self._lock:
+            if handle[self._CALLBACK] is not None:
+                handle[self._CALLBACK] = None
+                handle[self._KWARGS] = None
+                self._live -= 1
+                if len(self._heap) > 2 * self._live:
+                    self._compact()
+
+    def timer_running(self, handle: list) -> bool:
+        """Check if a trigger is still waiting to run"""
+        return handle[self._CALLBACK] is not None
+
+    def next_time(self) -> Optional[datetime.datetime]:
+        """The time of the earliest pending trigger, or :code:`None` if there is none"""
+        with self._lock:
+            self._drop_cancelled()
+            return self._heap[0][self._WHEN] if self._heap else None
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][self._CALLBACK] is None:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        """Rebuild the heap without the cancelled triggers"""
+        self._heap = [h for h in self._heap if h[self._CALLBACK] is not None]
+        heapq.heapify(self._heap)
+
+    def _arm(self):
+        """Arm the AppDaemon timer for the earliest pending trigger"""
+        self._drop_cancelled()
+        if self._timer is not None:
+            self.app.cancel_timer(self._timer)
+            self._timer = None
+            self._timer_at = None
+        if self._heap:
+            self._timer_at = self._heap[0][self._WHEN]
+            if self._timer_at > self.app.get_now():
+                self._timer = self.app.run_at(self._fire, self._timer_at)
+            else:
+                # AppDaemon moves a start time that has passed to the next day
+                self._timer = self.app.run_in(self._fire, 0)
+
+    def _fire(self, kwargs):
+        """AppDaemon callback dispatching all triggers that are due"""
+        with self._lock:
+            self._timer = None
+            limit = self._timer_at
+            self._timer_at = None
+
+            self._dispatching = True
+            try:
+                with self.batch() if self.batch is not None else nullcontext():
+                    now = self.app.get_now()
+                    if limit is None or now > limit:
+                        limit = now
+                    # Run the triggers that became due while dispatching as well
+                    while True:
+                        self._run_due(limit)
+                        now = self.app.get_now()
+                        self._drop_cancelled()
+                        if not self._heap or self._heap[0][self._WHEN] > now:
+                            break
+                        limit = now
+            finally:
+                self._dispatching = False
+                self._arm()
+
+    def _run_due(self, limit: datetime.datetime):
+        while self._heap and self._heap[0][self._WHEN] <= limit:
+            handle = heapq.heappop(self._heap)
+            callback = handle[self._CALLBACK]
+            if callback is None:
+                continue
+            cb_kwargs = handle[self._KWARGS]
+            self.cancel_timer(handle)
+            try:
+                callback(cb_kwargs)
+            except Exception:
+                logger.exception("Trigger callback failed: %s", callback)
@@ -1,3 +1,4 @@
+from datetime import datetime
 from json.decoder import JSONDecodeError
 
 from .entities import EntityGroup
@@ -31,19 +32,31 @@ class ScheduleWriter:
             "hour": entry.hour,
             "minute": entry.minute,
             "days": entry.days,
+            "attrs": entry.additional_attrs,
+            "is_service": entry.is_service,
+            "entity_identifier": entry.entity_identifier,
         }
 
     @classmethod
     def entry_from_dict(cls, d: Dict) -> Entry:
-        return Entry(d["value"], d["hour"], d["minute"], d["days"])
+        return Entry(
+            d["value"],
+            d["hour"],
+            d["minute"],
+            d["days"],
+            d.get("attrs"),
+            d.get("is_service", False),
+            d.get("entity_identifier", "entity_id"),
+        )
 
     @classmethod
     def read_schedule(cls, fp: TextIO, scheduler) -> Schedule:
-        d = json.load(fp)
-        sched = Schedule(d["name"], d["kind"], scheduler)
+        return cls.schedule_from_dict(json.load(fp), scheduler)
 
-        for e in d["entries"]:
-            sched.add_entry(cls.entry_from_dict(e))
+    @classmethod
+    def schedule_from_dict(cls, d: Dict, scheduler, **schedule_kwargs) -> Schedule:
+        sched = Schedule(d["name"], d["kind"], scheduler, **schedule_kwargs)
+        sched.add_entries(cls.entry_from_dict(e) for e in d["entries"])
         return sched
 
 
@@ -64,6 +77,11 @@ class GroupsWriter:
             if group.schedule is not None
             else None,
             "entities": list(group.entities),
+            "offset": group.offset,
+            "jitter": group.jitter,
+            "activate_at": group.activate_at.isoformat()
+            if group.activate_at is not None
+            else None,
         }
 
     @classmethod
@@ -72,17 +90,33 @@ class GroupsWriter:
         fp: TextIO,
         scheduler,
         schedules: Optional[Dict[str, Schedule]] = None,
+        **group_kwargs,
     ):
 
         try:
             data = json.load(fp)
         except JSONDecodeError as e:
-            logger.warning("Failed to read groups from file:", e)
+            logger.warning("Failed to read groups from file: %s", e)
             return [], []
+        return cls.groups_from_dicts(data, scheduler, schedules, **group_kwargs)
+
+    @classmethod
+    def groups_from_dicts(
+        cls,
+        data: Iterable[Dict],
+        scheduler,
+        schedules: Optional[Dict[str, Schedule]] = None,
+        **group_kwargs,
+    ):
         groups = []
         schedule_names = []
         for g in data:
-            group = EntityGroup(g["name"], g["kind"], scheduler, *g["entities"])
+            group = EntityGroup(
+                g["name"], g["kind"], scheduler, *g["entities"], **group_kwargs
+            )
+            group.set_stagger(g.get("offset", 0), g.get("jitter", 0))
+            # Inactive groups are not armed or updated when assigned
+            group.active = g.get("active", True)
             groups.append(group)
             sched = g["schedule_name"]
             schedule_names.append(sched)
@@ -91,5 +125,7 @@ class GroupsWriter:
                     group.assign_schedule(schedules[sched])
                 except KeyError:
                     logger.warning(f"Schedule not found when reading: {sched}")
+            if not group.active and g.get("activate_at"):
+                group.deactivate_until(datetime.fromisoformat(g["activate_at"]))
 
         return groups, schedule_names
@@ -0,0 +1,255 @@
+import pytest
+from pytest_mock import mocker
+import asyncio
+import threading
+import time
+
+from ad_scheduler.const import EntityKind
+from ad_scheduler.dispatch import AsyncDispatcher, DispatchQueue, TokenBucket
+from ad_scheduler.entities import EntityGroup
+from ad_scheduler.metrics import Metrics
+from ad_scheduler.schedule import Entry
+
+
+@pytest.fixture
+def clock(mocker):
+    clock = mocker.patch("ad_scheduler.dispatch.time.monotonic")
+    clock.return_value = 1000.0
+    return clock
+
+
+@pytest.fixture
+def app(mocker):
+    return mocker.Mock()
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(2, burst=4)
+
+    assert bucket.wait_time(4, 1000.0) == 0
+    bucket.take(4, 1000.0)
+    assert bucket.wait_time(1, 1000.0) == 0.5
+    assert bucket.wait_time(1, 1000.5) == 0
+
+
+def test_sends_until_rate_exceeded(mocker, app, clock):
+    queue = DispatchQueue(app, 2)
+    fn = mocker.Mock()
+
+    for i in range(5):
+        queue.submit("light", 1, fn, (i,))
+
+    assert fn.call_args_list == [mocker.call(0), mocker.call(1)]
+    assert len(queue) == 3
+    app.run_in.assert_called_once_with(queue._drain, 0.5)
+
+    clock.return_value += 1
+    queue._drain({})
+
+    assert fn.call_count == 4
+    assert len(queue) == 1
+
+
+def test_domains_are_limited_separately(mocker, app, clock):
+    queue = DispatchQueue(app, 100, domain_rates={"zwave": 1})
+    fn = mocker.Mock()
+
+    queue.submit("zwave", 1, fn, ("z1",))
+    queue.submit("zwave", 1, fn, ("z2",))
+    queue.submit("light", 1, fn, ("l1",))
+
+    assert fn.call_args_list == [mocker.call("z1"), mocker.call("l1")]
+    assert queue.backlog() == {"zwave": 1}
+    assert list(queue.chunks("zwave", ["a", "b"])) == [["a"], ["b"]]
+    assert list(queue.chunks("light", ["a", "b"])) == [["a", "b"]]
+
+
+def test_full_backlog_drops_oldest(mocker, app, clock):
+    queue = DispatchQueue(app, 1, max_backlog=2)
+    fn, dropped = mocker.Mock(), mocker.Mock()
+
+    queue.submit("light", 1, fn, (0,))
+    queue.submit("light", 1, fn, (1,), on_drop=dropped)
+    queue.submit("switch", 1, fn, (2,))
+    queue.submit("light", 1, fn, (3,))
+
+    dropped.assert_called_once_with()
+    assert queue.dropped == 1
+    assert queue.backlog() == {"switch": 1, "light": 1}
+
+
+def test_failed_call_is_dropped(mocker, app, clock):
+    queue = DispatchQueue(app, 1)
+    fn, dropped = mocker.Mock(side_effect=RuntimeError("unavailable")), mocker.Mock()
+
+    queue.submit("light", 1, fn, (0,), on_drop=dropped)
+    queue.submit("light", 1, fn, (1,))
+    clock.return_value += 1
+    queue._drain({})
+
+    assert fn.call_count == 2
+    dropped.assert_called_once_with()
+
+
+def test_backlog_is_reported(mocker, app, clock):
+    report = mocker.Mock()
+    queue = DispatchQueue(app, 1, on_backlog=report)
+    fn = mocker.Mock()
+
+    for i in range(4):
+        queue.submit("light", 1, fn, (i,))
+    # Further depths are throttled
+    report.assert_called_once_with(1)
+
+    for _ in range(3):
+        clock.return_value += 1
+        queue._drain({})
+
+    assert [c.args[0] for c in report.call_args_list] == [1, 2, 1, 0]
+
+
+def test_group_dispatch_is_queued_per_domain(mocker, app, clock):
+    scheduler = mocker.Mock()
+    queue = DispatchQueue(app, 100, domain_rates={"light": 2})
+    group = EntityGroup(
+        "group",
+        EntityKind.ON_OFF,
+        scheduler,
+        "light.a",
+        "light.b",
+        "light.c",
+        "switch.a",
+        dispatcher=queue,
+    )
+    group.schedule = mocker.Mock()
+
+    group.dispatch(group.entities, Entry("on", 7, 0))
+
+    call_service = group.schedule.scheduler.call_service
+    assert call_service.call_args_list == [
+        mocker.call("homeassistant/turn_on", entity_id=["light.a", "light.b"]),
+        mocker.call("homeassistant/turn_on", entity_id=["switch.a"]),
+    ]
+    assert queue.backlog() == {"light": 1}
+
+    # The queued entity is updated again if its call is dropped
+    queue._drop_oldest()
+    assert len(queue) == 0
+    group.dispatch(group.entities, Entry("on", 7, 0))
+    assert queue.backlog() == {"light": 1}
+
+
+def test_queued_fan_out_lasts_until_last_call(mocker, app, clock):
+    metrics = Metrics()
+    queue = DispatchQueue(app, 1, burst=1)
+    group = EntityGroup(
+        "group",
+        EntityKind.ON_OFF,
+        mocker.Mock(),
+        "input_number.a",
+        "input_number.b",
+        "input_number.c",
+        dispatcher=queue,
+        metrics=metrics,
+    )
+    group.schedule = mocker.Mock()
+
+    group.dispatch(group.entities, Entry(21, 7, 0))
+    assert "group" not in metrics.groups
+    for _ in range(2):
+        clock.return_value += 1
+        queue._drain({})
+
+    assert list(metrics.groups["group"].recent) == [2.0]
+
+
+@pytest.fixture
+def loop_app(mocker):
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    app = mocker.Mock()
+    app.AD.loop = loop
+    app.AD.main_thread_id = thread.ident
+    yield app
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def api_call(seconds, log):
+    """Mimics an AppDaemon API method, which returns a task on the event loop"""
+
+    async def call(name):
+        await asyncio.sleep(seconds)
+        log.append(name)
+
+    return lambda name: asyncio.ensure_future(call(name))
+
+
+def test_async_calls_run_concurrently(loop_app):
+    log = []
+    dispatcher = AsyncDispatcher(loop_app, limit=10, timeout=5)
+
+    start = time.monotonic()
+    with dispatcher.collect():
+        for i in range(5):
+            dispatcher.submit("light", 1, api_call(0.2, log), (i,))
+        assert log == []
+
+    assert sorted(log) == [0, 1, 2, 3, 4]
+    assert time.monotonic() - start < 0.8
+
+
+def test_async_limit(loop_app):
+    log = []
+    dispatcher = AsyncDispatcher(loop_app, limit=1, timeout=5)
+
+    start = time.monotonic()
+    with dispatcher.collect():
+        for i in range(3):
+            dispatcher.submit("light", 1, api_call(0.1, log), (i,))
+
+    assert log == [0, 1, 2]
+    assert time.monotonic() - start >= 0.3
+
+
+def test_async_failures_are_collected(mocker, loop_app):
+    dropped = mocker.Mock()
+    dispatcher = AsyncDispatcher(loop_app, timeout=0.05)
+
+    def fail(name):
+        raise RuntimeError(name)
+
+    with dispatcher.collect():
+        dispatcher.submit("light", 1, api_call(1, []), ("slow",), on_drop=dropped)
+        dispatcher.submit("switch", 1, fail, ("broken",))
+        dispatcher.submit("switch", 1, api_call(0, []), ("ok",))
+
+    dropped.assert_called_once_with()
+    assert dispatcher.failed == 2
+    assert [f["domain"] for f in dispatcher.failures] == ["light", "switch"]
+    assert "broken" in dispatcher.failures[1]["error"]
+
+
+def test_async_fan_out_lasts_until_last_call(mocker, loop_app):
+    metrics = Metrics()
+    dispatcher = AsyncDispatcher(loop_app)
+    group = EntityGroup(
+        "group",
+        EntityKind.ON_OFF,
+        mocker.Mock(),
+        "input_number.a",
+        "input_number.b",
+        dispatcher=dispatcher,
+        metrics=metrics,
+    )
+    group.schedule = mocker.Mock()
+    set_state = api_call(0.1, [])
+    group.schedule.scheduler.set_state = lambda entity, **kwargs: set_state(entity)
+
+    with dispatcher.collect():
+        group.dispatch(group.entities, Entry(21, 7, 0))
+        assert "group" not in metrics.groups
+
+    assert list(metrics.groups["group"].recent)[0] >= 0.1
@@ -1,8 +1,9 @@
 import pytest
+from datetime import datetime, timedelta
 from pytest_mock import mocker
 
 from ad_scheduler.schedule import Entry
-from ad_scheduler.entities import EntityGroup
+from ad_scheduler.entities import AppliedStateCache, EntityGroup
 from ad_scheduler.const import EntityKind
 
 
@@ -80,7 +81,8 @@ def test_set_entities(mocker, schedule, scheduler):
     eg.set_entities(entities)
 
     assert eg.entities == {"light.other_light", "switch.something_new"}
-    assert eg.set_entity.call_count == 2
+    # light.other_light already has the current entry applied
+    eg.set_entity.assert_called_once_with("switch.something_new", schedule.current_entry)
 
 
 def test_schedule_changed_sets_all_entities(mocker, entry, scheduler):
@@ -155,5 +157,212 @@ def test_assign_does_everything(mocker, schedule, entry, scheduler):
 
     assert schedule == eg.schedule
     eg.remove_schedule.assert_called_once()
+    schedule.subscribers_changed.assert_called_once()
     eg.schedule_changed.assert_called_once_with(entry)
     assert schedule.subscribers == [eg]
+
+
+@pytest.mark.parametrize(
+    "value,service",
+    [
+        ("on", "homeassistant/turn_on"),
+        ("Off", "homeassistant/turn_off"),
+        ("toggle", "homeassistant/toggle"),
+    ],
+)
+def test_schedule_changed_batches_switch_entries(
+    mocker, schedule, scheduler, value, service
+):
+    entities = ["light.light1", "light.light2", "switch.switch1"]
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, *entities)
+    eg.schedule = schedule
+    mocker.patch.object(eg, "set_entity")
+
+    eg.schedule_changed(Entry(value, 10, 0, additional_attrs={"brightness": 10}))
+
+    schedule.scheduler.call_service.assert_called_once_with(
+        service, brightness=10, entity_id=sorted(entities)
+    )
+    eg.set_entity.assert_not_called()
+
+
+def test_schedule_changed_batches_service_entries(mocker, schedule, scheduler):
+    entities = ["climate.one", "climate.two"]
+    eg = EntityGroup("MyGroup", EntityKind.THERMO, scheduler, *entities)
+    eg.schedule = schedule
+    mocker.patch.object(eg, "set_entity")
+
+    entry = Entry(
+        "climate/set_temperature",
+        10,
+        0,
+        additional_attrs={"temperature": 21},
+        is_service=True,
+        entity_identifier="target",
+    )
+    eg.schedule_changed(entry)
+
+    schedule.scheduler.call_service.assert_called_once_with(
+        "climate/set_temperature", temperature=21, target=entities
+    )
+    eg.set_entity.assert_not_called()
+
+
+def test_schedule_changed_without_entry_does_nothing(mocker, scheduler):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "light.light1")
+
+    mocker.patch.object(eg, "set_entity")
+
+    eg.schedule_changed(None)
+    eg.set_entity.assert_not_called()
+
+
+def test_dispatch_skips_applied_entities(mocker, schedule, scheduler):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "light.one", "light.two")
+    eg.schedule = schedule
+    entry = Entry("on", 10, 0)
+
+    eg.schedule_changed(entry)
+    eg.schedule_changed(entry)
+    schedule.scheduler.call_service.assert_called_once_with(
+        "homeassistant/turn_on", entity_id=["light.one", "light.two"]
+    )
+
+    eg.applied.forget(["light.two"])
+    eg.schedule_changed(entry)
+    schedule.scheduler.call_service.assert_called_with(
+        "homeassistant/turn_on", entity_id=["light.two"]
+    )
+
+
+def test_transitions_are_never_skipped(mocker, schedule, scheduler):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "light.one")
+    eg.schedule = schedule
+    entry = Entry("on", 7, 0)
+
+    # A daily entry is the current entry again on every transition
+    eg.schedule_changed(entry)
+    eg.schedule_changed(entry, transition=True)
+    eg.schedule_changed(entry, transition=True)
+
+    assert schedule.scheduler.call_service.call_count == 3
+    eg.schedule_changed(entry)
+    assert schedule.scheduler.call_service.call_count == 3
+
+
+def test_dispatch_never_skips_services(mocker, schedule, scheduler):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "light.one")
+    eg.schedule = schedule
+    entry = Entry("script/morning", 7, 0, is_service=True)
+
+    eg.schedule_changed(entry)
+    eg.schedule_changed(entry)
+    assert schedule.scheduler.call_service.call_count == 2
+
+
+def test_failed_call_is_not_recorded(mocker, schedule, scheduler):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "light.one")
+    eg.schedule = schedule
+    entry = Entry("on", 7, 0)
+    schedule.scheduler.call_service.side_effect = [RuntimeError("down"), None]
+
+    with pytest.raises(RuntimeError):
+        eg.schedule_changed(entry)
+    eg.schedule_changed(entry)
+
+    assert schedule.scheduler.call_service.call_count == 2
+
+
+def test_dispatch_never_skips_toggle(mocker, schedule, scheduler):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "light.one")
+    eg.schedule = schedule
+    entry = Entry("toggle", 10, 0)
+
+    eg.schedule_changed(entry)
+    eg.schedule_changed(entry)
+    assert schedule.scheduler.call_service.call_count == 2
+
+
+def test_deactivate_forgets_applied_state(mocker, schedule, scheduler):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "light.one")
+    eg.schedule = schedule
+    schedule.current_entry = Entry("on", 10, 0)
+    eg.schedule_changed(schedule.current_entry)
+
+    eg.deactivate_for()
+    eg.activate()
+
+    assert schedule.scheduler.call_service.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "ha_state,sent",
+    [
+        ({"state": "on", "attributes": {}}, False),
+        ({"state": "off", "attributes": {}}, True),
+        (None, True),
+    ],
+)
+def test_verify_checks_home_assistant_state(mocker, schedule, ha_state, sent):
+    scheduler = mocker.Mock()
+    scheduler.get_state.return_value = ha_state
+    applied = AppliedStateCache(verify=True)
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "light.one", applied=applied)
+    eg.schedule = schedule
+
+    eg.schedule_changed(Entry("on", 10, 0))
+
+    scheduler.get_state.assert_called_once_with("light.one", attribute="all")
+    assert schedule.scheduler.call_service.called == sent
+
+
+def test_transition_is_staggered(mocker, schedule, entry, scheduler):
+    now = datetime(2021, 11, 1, 7, 0)
+    scheduler.get_now.return_value = now
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "switch.a")
+    eg.schedule = schedule
+    eg.set_stagger(offset=10, jitter=20)
+    mocker.patch.object(eg, "dispatch")
+
+    delay = eg.stagger_delay()
+    assert 10 <= delay < 30
+    same_name = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler)
+    same_name.set_stagger(offset=10, jitter=20)
+    assert same_name.stagger_delay() == delay
+
+    eg.schedule_changed(entry, transition=True)
+
+    eg.dispatch.assert_not_called()
+    scheduler.triggers.run_at.assert_called_once_with(
+        eg._staggered, now + timedelta(seconds=delay), entry=entry
+    )
+
+    eg._staggered({"entry": entry})
+    eg.dispatch.assert_called_once_with(eg.entities, entry, transition=True)
+
+
+def test_staggered_transition_skipped_when_schedule_changed(
+    mocker, schedule, entry, scheduler
+):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "switch.a")
+    eg.schedule = schedule
+    mocker.patch.object(eg, "dispatch")
+
+    eg._staggered({"entry": Entry(1, 8, 0)})
+
+    eg.dispatch.assert_not_called()
+
+
+def test_changes_are_not_staggered(mocker, entry, scheduler):
+    eg = EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler, "switch.a")
+    eg.set_stagger(offset=10)
+    mocker.patch.object(eg, "dispatch")
+
+    eg.schedule_changed(entry)
+
+    eg.dispatch.assert_called_once_with(eg.entities, entry, transition=False)
+
+
+def test_negative_stagger_raises(scheduler):
+    with pytest.raises(ValueError):
+        EntityGroup("MyGroup", EntityKind.ON_OFF, scheduler).set_stagger(jitter=-1)
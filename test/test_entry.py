@@ -148,3 +148,87 @@ def test_next_datetime_changes(mocker):
     exp = datetime.datetime(2021, 11, 4, 10, 0)
     actual = entry.next_datetime
     assert exp == actual, f"Incorrect next datetime, expected {exp}, got {actual}"
+
+
+@pytest.mark.parametrize(
+    "days,mask,day_list",
+    [
+        ("daily", 0b1111111, [0, 1, 2, 3, 4, 5, 6]),
+        (["mon", "sun"], 0b1000001, [0, 6]),
+        ([4, 2, 4], 0b0010100, [2, 4]),
+    ],
+)
+def test_days_stored_as_mask(days, mask, day_list):
+    entry = ad_scheduler.schedule.Entry(0, 10, 0, days)
+
+    assert entry.day_mask == mask
+    assert entry.days == day_list
+    assert not hasattr(entry, "__dict__")
+
+
+def test_same_time():
+    Entry = ad_scheduler.schedule.Entry
+
+    assert Entry(0, 10, 0, ["mon", "tue"]).same_time(Entry(1, 10, 0, ["tue"]))
+    assert not Entry(0, 10, 0, ["mon", "tue"]).same_time(Entry(1, 10, 0, ["wed"]))
+    assert not Entry(0, 10, 0, ["mon"]).same_time(Entry(1, 10, 1, ["mon"]))
+
+
+@pytest.mark.parametrize(
+    "mask,weekday,skip_today,until,since",
+    [
+        (0b0000010, 0, False, 1, 6),
+        (0b0000001, 0, False, 0, 0),
+        (0b0000001, 0, True, 7, 7),
+        (0b1000001, 6, True, 1, 6),
+        (0b0101000, 2, False, 1, 4),
+    ],
+)
+def test_days_until_and_since(mask, weekday, skip_today, until, since):
+    assert ad_scheduler.schedule.days_until(mask, weekday, skip_today) == until
+    assert ad_scheduler.schedule.days_since(mask, weekday, skip_today) == since
+
+
+def test_next_after_and_previous_before_take_explicit_now(mocker):
+    dt_now = mocker.patch("ad_scheduler.schedule.dt_now")
+    entry = ad_scheduler.schedule.Entry(0, 10, 0, ["mon", "thu"])
+    now = datetime.datetime(2021, 11, 2, 12, 0, 30)
+
+    assert entry.next_after(now) == datetime.datetime(2021, 11, 4, 10, 0)
+    assert entry.previous_before(now) == datetime.datetime(2021, 11, 1, 10, 0)
+    dt_now.assert_not_called()
+
+
+def test_previous_before_at_start_of_minute():
+    entry = ad_scheduler.schedule.Entry(0, 10, 0, ["mon", "thu"])
+
+    at_start = datetime.datetime(2021, 11, 4, 10, 0)
+    assert entry.previous_before(at_start) == datetime.datetime(2021, 11, 1, 10, 0)
+    after_start = datetime.datetime(2021, 11, 4, 10, 0, 0, 1)
+    assert entry.previous_before(after_start) == datetime.datetime(2021, 11, 4, 10, 0)
+
+
+def test_next_after_is_cached_by_minute(mocker):
+    entry = ad_scheduler.schedule.Entry(0, 10, 0, ["mon", "thu"])
+    days_until = mocker.spy(ad_scheduler.schedule, "days_until")
+
+    entry.next_after(datetime.datetime(2021, 11, 2, 12, 0, 1))
+    entry.next_after(datetime.datetime(2021, 11, 2, 12, 0, 59))
+    assert days_until.call_count == 1
+
+    entry.next_after(datetime.datetime(2021, 11, 2, 12, 1))
+    assert days_until.call_count == 2
+
+
+def test_clock_falls_back_to_remaining_app(mocker):
+    first, second = mocker.Mock(), mocker.Mock()
+
+    ad_scheduler.schedule.register_clock(first)
+    ad_scheduler.schedule.register_clock(second)
+    assert ad_scheduler.schedule.dt_now() is second.get_now.return_value
+
+    ad_scheduler.schedule.unregister_clock(second)
+    assert ad_scheduler.schedule.dt_now() is first.get_now.return_value
+
+    ad_scheduler.schedule.unregister_clock(first)
+    assert ad_scheduler.schedule.dt_getter is None
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+import pytest
+from pytest_mock import mocker
+
+from ad_scheduler.const import EntityKind
+from ad_scheduler.entities import EntityGroup
+from ad_scheduler.metrics import Histogram, Metrics, service_name
+from ad_scheduler.schedule import Entry
+from ad_scheduler.simulation import SimulatedScheduler, VirtualClock
+
+START = datetime(2021, 11, 1)  # Monday
+
+
+def test_histogram_buckets_and_recent_window():
+    histogram = Histogram(buckets=(1, 5), window=3)
+    for value in [0.5, 1, 2, 10, 3]:
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 2, 1]
+    assert histogram.count == 5
+    assert histogram.total == 16.5
+    summary = histogram.summary()
+    assert summary["recent"] == 3
+    assert summary["p50"] == 3
+    assert summary["max"] == 10
+
+
+def test_service_name(mocker):
+    api = mocker.Mock()
+    api.call_service.__name__ = "call_service"
+    api.turn_on.__name__ = "turn_on"
+
+    assert service_name(api.call_service, ("light/turn_on",)) == "light/turn_on"
+    assert service_name(api.turn_on, ("light.a",)) == "turn_on"
+
+
+def test_call_counts_failures(mocker):
+    metrics = Metrics()
+    fn = mocker.Mock(__name__="set_state", side_effect=[None, RuntimeError("down")])
+
+    metrics.call(fn, ("light.a",), {"state": "on"})
+    with pytest.raises(RuntimeError):
+        metrics.call(fn, ("light.b",))
+
+    assert metrics.calls == {"set_state": 2}
+    assert metrics.failures == {"set_state": 1}
+
+
+def test_group_records_fan_out_and_calls(mocker):
+    scheduler = mocker.Mock()
+    scheduler.call_service.__name__ = "call_service"
+    metrics = Metrics()
+    group = EntityGroup(
+        "g", EntityKind.ON_OFF, scheduler, "light.a", "light.b", metrics=metrics
+    )
+    group.schedule = mocker.Mock(scheduler=scheduler)
+
+    group.dispatch(group.entities, Entry("on", 7, 0))
+    group.dispatch(group.entities, Entry("on", 7, 0))
+
+    assert metrics.calls == {"homeassistant/turn_on": 1}
+    assert metrics.groups["g"].count == 1
+    assert metrics.histograms["fan_out"].count == 1
+
+
+def test_prometheus_format():
+    metrics = Metrics()
+    metrics.observe("trigger_lateness", 0.002)
+    metrics.called("light/turn_on")
+    metrics.fan_out('g"1', 0.5)
+
+    text = metrics.prometheus({"app": "test"})
+
+    assert "# TYPE ad_scheduler_trigger_lateness_seconds histogram" in text
+    assert (
+        'ad_scheduler_trigger_lateness_seconds_bucket{app="test",le="0.001"} 0' in text
+    )
+    assert (
+        'ad_scheduler_trigger_lateness_seconds_bucket{app="test",le="0.005"} 1' in text
+    )
+    assert 'ad_scheduler_trigger_lateness_seconds_bucket{app="test",le="+Inf"} 1' in text
+    assert 'ad_scheduler_calls_total{app="test",service="light/turn_on"} 1' in text
+    assert 'ad_scheduler_group_fan_out_seconds_max{app="test",group="g\\"1"} 0.5' in text
+
+
+def test_simulated_metrics(tmp_path):
+    clock = VirtualClock(START)
+    app = SimulatedScheduler(
+        {"root_dir": str(tmp_path), "metrics_file": True, "metrics_interval": 60},
+        clock=clock,
+    )
+    try:
+        app.call_endpoint("schedules_add", {"name": "s", "kind": "on_off"})
+        app.call_endpoint(
+            "entries_add", {"schedule": "s", "value": "on", "hour": 7, "minute": 0}
+        )
+        app.call_endpoint(
+            "groups_add", {"name": "g", "kind": "on_off", "entities": ["light.a"]}
+        )
+        app.call_endpoint("groups_assign", {"group": "g", "schedule": "s"})
+
+        clock.run_until(START + timedelta(hours=7, minutes=2))
+        body, status = app.call_endpoint("metrics", {})
+
+        assert status == 200
+        assert body["trigger_lateness"]["count"] == 1
+        assert body["trigger_lateness"]["max"] == 0
+        assert body["update_state"]["count"] == 1
+        # Set when assigned, then again at the trigger
+        assert body["calls"] == {"homeassistant/turn_on": 2}
+        assert body["slowest_groups"][0]["name"] == "g"
+        assert body["pending_triggers"] == 1
+
+        text = tmp_path.joinpath("metrics_scheduler.prom").read_text()
+        assert 'ad_scheduler_trigger_lateness_seconds_count{app="scheduler"} 1' in text
+
+        app.call_endpoint("groups_delete", {"name": "g"})
+        assert app.call_endpoint("metrics", {})[0]["slowest_groups"] == []
+    finally:
+        app.close()
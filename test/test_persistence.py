@@ -0,0 +1,80 @@
+import pytest
+from pytest_mock import mocker
+import json
+
+from ad_scheduler.const import EntityKind
+from ad_scheduler.entities import EntityGroup
+from ad_scheduler.persistence import WriteBehindStore
+from ad_scheduler.schedule import Schedule
+from ad_scheduler.storage import JsonStorage
+
+
+@pytest.fixture
+def app(mocker):
+    return mocker.Mock()
+
+
+@pytest.fixture
+def store(app, tmp_path) -> WriteBehindStore:
+    store = WriteBehindStore(app, JsonStorage(tmp_path), 2)
+    yield store
+    store.close()
+
+
+def test_changes_are_coalesced(app, store, tmp_path):
+    schedule = Schedule("sched", EntityKind.ON_OFF, app)
+
+    store.schedule_changed(schedule)
+    store.schedule_changed(schedule)
+    store.groups_changed([])
+
+    app.run_in.assert_called_once_with(store._flush_callback, 2)
+    assert not store.storage.schedule_path("sched").exists()
+
+    store._flush_callback({})
+    store.flush().result()
+
+    assert json.loads(store.storage.schedule_path("sched").read_text())["name"] == "sched"
+    assert json.loads(store.storage.groups_path().read_text()) == []
+
+
+def test_groups_are_read_when_flushing(app, store):
+    groups = {}
+    store.groups_changed(groups.values())
+    groups["g"] = EntityGroup("g", EntityKind.ON_OFF, app, "light.one")
+
+    store.flush().result()
+
+    assert json.loads(store.storage.groups_path().read_text())[0]["entities"] == ["light.one"]
+
+
+def test_removed_schedule_is_deleted(app, store):
+    schedule = Schedule("sched", EntityKind.ON_OFF, app)
+    store.schedule_changed(schedule)
+    store.flush().result()
+
+    store.schedule_removed("sched")
+    store.close()
+
+    assert not store.storage.schedule_path("sched").exists()
+
+
+def test_hold_requests_single_flush(app, store):
+    schedule = Schedule("sched", EntityKind.ON_OFF, app)
+
+    with store.hold():
+        store.schedule_changed(schedule)
+        store.groups_changed([])
+        app.run_in.assert_not_called()
+
+    app.run_in.assert_called_once_with(store._flush_callback, 2)
+
+
+def test_storage_errors_are_logged(app, store, mocker):
+    store.storage = mocker.Mock()
+    store.storage.write.side_effect = RuntimeError("disk full")
+
+    store.groups_changed([])
+    store.flush().result()
+
+    store.storage.write.assert_called_once_with({}, [])
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+import pytest
+from pytest_mock import mocker
+
+from ad_scheduler.const import EntityKind
+from ad_scheduler.preview import expand, expand_schedules
+from ad_scheduler.schedule import Entry, Schedule
+
+
+@pytest.fixture
+def schedule(mocker) -> Schedule:
+    schedule = Schedule("name", EntityKind.ON_OFF, mocker.Mock(), armed=False)
+    schedule.entries = [
+        Entry("on", 7, 30, ["mon", "tue", "wed", "thu", "fri"]),
+        Entry("off", 22, 0),
+    ]
+    return schedule
+
+
+def stepped(schedule: Schedule, start: datetime, end: datetime):
+    """Transitions found by stepping through the range one minute at a time"""
+    rows = []
+    now = start
+    while now < end:
+        schedule.update_state(now)
+        entry = schedule.current_entry
+        if now.hour * 60 + now.minute == entry.hour * 60 + entry.minute:
+            rows.append((now, entry, entry.value))
+        now += timedelta(minutes=1)
+    return rows
+
+
+def test_expand_matches_stepping(schedule):
+    start = datetime(2021, 11, 5, 12, 0)  # Friday
+    end = datetime(2021, 11, 16, 0, 0)
+
+    rows = expand(schedule, start, end)
+
+    assert rows == stepped(schedule, start, end)
+    assert rows[:3] == [
+        (datetime(2021, 11, 5, 22, 0), schedule.entries[1], "off"),
+        (datetime(2021, 11, 6, 22, 0), schedule.entries[1], "off"),
+        (datetime(2021, 11, 7, 22, 0), schedule.entries[1], "off"),
+    ]
+    assert rows[3] == (datetime(2021, 11, 8, 7, 30), schedule.entries[0], "on")
+
+
+def test_expand_range_bounds(schedule):
+    start = datetime(2021, 11, 8, 7, 30)
+    end = datetime(2021, 11, 8, 22, 0)
+
+    assert expand(schedule, start, end) == [(start, schedule.entries[0], "on")]
+    assert expand(schedule, start + timedelta(seconds=1), end) == []
+    assert expand(schedule, end, start) == []
+
+
+def test_expand_initial_entry(schedule):
+    on, off = schedule.entries
+
+    # Monday before the first entry of the week, so sunday's entry is current
+    start = datetime(2021, 11, 8, 6, 0)
+    rows = expand(schedule, start, datetime(2021, 11, 9), initial=True)
+    assert rows == [
+        (start, off, "off"),
+        (datetime(2021, 11, 8, 7, 30), on, "on"),
+        (datetime(2021, 11, 8, 22, 0), off, "off"),
+    ]
+
+    # No extra row when a transition is at the start
+    start = datetime(2021, 11, 8, 7, 30)
+    rows = expand(schedule, start, datetime(2021, 11, 9), initial=True)
+    assert rows[0] == (start, on, "on")
+    assert len(rows) == 2
+
+
+def test_expand_schedules(mocker, schedule):
+    empty = Schedule("empty", EntityKind.ON_OFF, mocker.Mock(), armed=False)
+    start = datetime(2021, 11, 1)
+    end = start + timedelta(days=365)
+
+    rows = expand_schedules([schedule, empty], start, end)
+
+    assert rows["empty"] == []
+    # 52 weeks and a monday
+    assert len(rows["name"]) == 365 + 52 * 5 + 1
+    assert rows["name"] == sorted(rows["name"], key=lambda r: r[0])
+    schedule.scheduler.triggers.run_at.assert_not_called()
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+import pstats
+import pytest
+
+from ad_scheduler.profiling import Profiler
+from ad_scheduler.simulation import SimulatedScheduler, VirtualClock
+
+START = datetime(2021, 11, 1)  # Monday
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+def test_profiles_next_calls(tmp_path):
+    profiler = Profiler(tmp_path, "app")
+    endpoint = profiler.wrap(busy)
+
+    profiler.start(2, ["endpoints"], top=5)
+    with profiler.section("triggers"):
+        busy(10)
+    endpoint(1000)
+    assert profiler.status() == {
+        "status": "running",
+        "remaining": 1,
+        "profiled": 1,
+        "targets": ["endpoints"],
+    }
+    endpoint(1000)
+    endpoint(1000)
+
+    result = profiler.status()
+    assert result["status"] == "done"
+    assert result["profiled"] == 2
+    assert len(result["top"]) == 5
+    assert any("busy" in row["function"] for row in result["top"])
+    stats = pstats.Stats(result["path"])
+    busy_calls = [v[1] for k, v in stats.stats.items() if k[2] == "busy"]
+    assert busy_calls == [2]
+
+
+@pytest.mark.parametrize(
+    "args", [(0,), (1, ["timers"]), (1, [], 20), (1, ["triggers"], 20, "slowest")]
+)
+def test_start_validates(tmp_path, args):
+    profiler = Profiler(tmp_path, "app")
+    with pytest.raises(ValueError):
+        profiler.start(*args)
+    assert not profiler.running
+
+
+def test_finish_early(tmp_path):
+    profiler = Profiler(tmp_path, "app")
+    assert profiler.finish() is None
+
+    profiler.start(5)
+    profiler.wrap(busy)(100)
+    result = profiler.finish()
+
+    assert result["profiled"] == 1
+    assert result is profiler.last
+    assert not profiler.running
+
+
+def test_profile_endpoint_profiles_triggers(tmp_path):
+    clock = VirtualClock(START)
+    app = SimulatedScheduler({"root_dir": str(tmp_path)}, clock=clock)
+    try:
+        app.call_endpoint("schedules_add", {"name": "s", "kind": "on_off"})
+        for value, hour in [("on", 7), ("off", 8)]:
+            app.call_endpoint(
+                "entries_add",
+                {"schedule": "s", "value": value, "hour": hour, "minute": 0},
+            )
+        app.call_endpoint(
+            "groups_add", {"name": "g", "kind": "on_off", "entities": ["light.a"]}
+        )
+        app.call_endpoint("groups_assign", {"group": "g", "schedule": "s"})
+
+        body, status = app.call_endpoint("profile", {"count": 1, "target": "nope"})
+        assert status == 400
+
+        body, status = app.call_endpoint(
+            "profile", {"count": 1, "target": "triggers", "sort": "tottime"}
+        )
+        assert status == 200
+        assert body["status"] == "running"
+
+        # Endpoint calls are not counted when profiling triggers
+        app.call_endpoint("status", {})
+        clock.run_until(START + timedelta(hours=7, minutes=1))
+
+        body, _ = app.call_endpoint("profile", {})
+        assert body["status"] == "done"
+        assert body["profiled"] == 1
+        assert Path(body["path"]).parent == tmp_path.joinpath("profiles")
+        assert any("trigger" in row["function"] for row in body["top"])
+    finally:
+        app.close()
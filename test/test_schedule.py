@@ -47,7 +47,7 @@ def test_cancel_with_trigger(mocker, schedule):
 
     schedule.cancel()
     assert schedule.next_trigger is None
-    schedule.scheduler.cancel_timer.assert_called()
+    schedule.scheduler.triggers.cancel_timer.assert_called()
 
 
 def test_add_entry(mocker, schedule, entry):
@@ -89,7 +89,7 @@ def test_set_subscribers_calls_all(schedule, subscribers, entry):
     schedule.set_subscribers(entry)
 
     for sub in subscribers:
-        sub.schedule_changed.assert_called_once_with(entry)
+        sub.schedule_changed.assert_called_once_with(entry, transition=False)
 
 
 def test_trigger_calls(mocker, schedule, entry):
@@ -100,7 +100,7 @@ def test_trigger_calls(mocker, schedule, entry):
     schedule.trigger(None)
 
     schedule.update_state.assert_called_once()
-    schedule.set_subscribers.assert_called_once_with(entry)
+    schedule.set_subscribers.assert_called_once_with(entry, transition=True)
 
 
 def test_update_state_with_no_entries(schedule):
@@ -118,7 +118,7 @@ def test_update_state_with_single_entry(schedule, entry):
     assert schedule.current_entry == entry
     assert schedule.next_entry == entry
 
-    schedule.scheduler.run_at.assert_called_once()
+    schedule.scheduler.triggers.run_at.assert_called_once()
 
 
 def test_update_state_with_multiple_entries(mocker, schedule: Schedule):
@@ -136,11 +136,180 @@ def test_update_state_with_multiple_entries(mocker, schedule: Schedule):
     schedule.update_state()
     assert schedule.current_entry == entries[2]
     assert schedule.next_entry == entries[0]
-    schedule.scheduler.run_at.assert_called()
+    schedule.scheduler.triggers.run_at.assert_called()
 
     mock.return_value = datetime(2021, 11, 1, 10, 1, 0, 1)  # Monday 10:00+
 
     schedule.update_state()
     assert schedule.current_entry == entries[0]
     assert schedule.next_entry == entries[2]
-    schedule.scheduler.run_at.assert_called()
+    schedule.scheduler.triggers.run_at.assert_called()
+
+
+def test_remove_entry(mocker, schedule, entry):
+    mocker.patch.object(schedule, "set_subscribers")
+    entry2 = Entry(10, 12, 0, ["tue"])
+    schedule.entries = [entry, entry2]
+
+    schedule.remove_entry(entry)
+
+    assert schedule.entries == [entry2]
+    assert schedule.current_entry == entry2
+    schedule.set_subscribers.assert_called_once_with(entry2)
+
+
+def test_update_state_wraps_around_week(mocker, schedule: Schedule):
+    mock = mocker.patch("ad_scheduler.schedule.dt_now")
+    mock.return_value = datetime(2021, 11, 7, 23, 30)  # Sunday 23:30
+
+    entries = [
+        Entry(10, 6, 0, ["mon"]),
+        Entry(20, 22, 0, ["sat"]),
+    ]
+    schedule.entries = entries
+
+    schedule.update_state()
+    assert schedule.current_entry == entries[1]
+    assert schedule.next_entry == entries[0]
+    assert schedule.next_datetime == datetime(2021, 11, 8, 6, 0)
+    schedule.scheduler.triggers.run_at.assert_called_once_with(
+        schedule.trigger, datetime(2021, 11, 8, 6, 0)
+    )
+
+
+def test_transitions_rebuilt_after_add(mocker, schedule: Schedule):
+    mocker.patch("ad_scheduler.schedule.dt_now").return_value = datetime(
+        2021, 11, 1, 9, 0
+    )
+    e1 = Entry(10, 10, 0, ["tue"])
+    e2 = Entry(20, 8, 0, ["mon"])
+
+    schedule.add_entry(e1)
+    assert schedule.transitions() == ([1440 + 600], [e1])
+
+    schedule.add_entry(e2)
+    assert schedule.transitions() == ([480, 1440 + 600], [e2, e1])
+    assert schedule.current_entry == e2
+    assert schedule.next_entry == e1
+
+
+def test_add_entries_updates_state_once(mocker, schedule):
+    mocker.patch.object(schedule, "update_state")
+    entries = [Entry(10, 8, 0, ["mon"]), Entry(20, 8, 0, ["tue"]), Entry(30, 9, 0)]
+
+    schedule.add_entries(entries)
+
+    assert schedule.entries == entries
+    schedule.update_state.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "existing,new",
+    [
+        ([], [Entry(10, 8, 0, ["mon", "fri"]), Entry(20, 8, 0, ["fri"])]),
+        ([Entry(10, 8, 0, ["mon"])], [Entry(20, 9, 0), Entry(20, 8, 0)]),
+    ],
+)
+def test_add_entries_collision_adds_nothing(mocker, schedule, existing, new):
+    mocker.patch.object(schedule, "update_state")
+    schedule.entries = existing
+
+    with pytest.raises(ValueError):
+        schedule.add_entries(new)
+
+    assert schedule.entries == existing
+    schedule.update_state.assert_not_called()
+
+
+def test_get_entry(schedule):
+    e1 = Entry(10, 8, 0, ["mon", "wed"])
+    e2 = Entry(20, 8, 0, ["tue"])
+    schedule.entries = [e1, e2]
+
+    assert schedule.get_entry(8, 0, ["wed"]) is e1
+    assert schedule.get_entry(8, 0, ["tue", "sun"]) is e2
+    assert schedule.get_entry(8, 0, ["thu"]) is None
+    assert schedule.get_entry(9, 0, "daily") is None
+
+
+def test_replace_entry(mocker, schedule):
+    mocker.patch.object(schedule, "update_state")
+    e1 = Entry(10, 8, 0, ["mon", "wed"])
+    e2 = Entry(20, 9, 0, ["tue"])
+    schedule.entries = [e1, e2]
+
+    new = Entry(30, 8, 0, ["mon"])
+    schedule.replace_entry(e1, new)
+
+    assert schedule.entries == [e2, new]
+    assert schedule.get_entry(8, 0, ["wed"]) is None
+    assert schedule.get_entry(8, 0, ["mon"]) is new
+    schedule.update_state.assert_called_once()
+
+
+def test_replace_entry_collision_changes_nothing(mocker, schedule):
+    mocker.patch.object(schedule, "update_state")
+    e1 = Entry(10, 8, 0, ["mon"])
+    e2 = Entry(20, 9, 0, ["tue"])
+    schedule.entries = [e1, e2]
+
+    with pytest.raises(ValueError):
+        schedule.replace_entry(e1, Entry(30, 9, 0))
+
+    assert schedule.entries == [e1, e2]
+    assert schedule.get_entry(8, 0, ["mon"]) is e1
+    schedule.update_state.assert_not_called()
+
+
+def test_unarmed_schedule_finds_state_without_trigger(mocker):
+    scheduler = mocker.Mock()
+    schedule = Schedule("name", EntityKind.ON_OFF, scheduler, armed=False)
+    entry = Entry("on", 10, 0)
+
+    schedule.add_entry(entry)
+
+    assert schedule.current_entry is entry
+    scheduler.triggers.run_at.assert_not_called()
+
+    schedule.arm()
+    schedule.arm()
+
+    scheduler.triggers.run_at.assert_called_once_with(
+        schedule.trigger, schedule.next_datetime
+    )
+
+
+def test_disarm_cancels_trigger(schedule, entry):
+    schedule.add_entry(entry)
+    trigger = schedule.next_trigger
+
+    schedule.disarm()
+    schedule.update_state()
+
+    schedule.scheduler.triggers.cancel_timer.assert_called_with(trigger)
+    assert schedule.next_trigger is None
+    assert not schedule.armed
+
+
+@pytest.mark.parametrize("on_demand", [False, True])
+def test_subscribers_changed_arms_for_active_groups(mocker, on_demand):
+    scheduler = mocker.Mock()
+    schedule = Schedule(
+        "name", EntityKind.ON_OFF, scheduler, armed=False, on_demand=on_demand
+    )
+    schedule.add_entry(Entry("on", 10, 0))
+    group = EntityGroup("group", EntityKind.ON_OFF, scheduler)
+
+    group.active = False
+    group.assign_schedule(schedule)
+    assert not schedule.armed
+
+    group.activate()
+    assert schedule.armed
+
+    group.deactivate_for()
+    assert schedule.armed is not on_demand
+
+    group.activate()
+    group.remove_schedule()
+    assert schedule.armed is not on_demand
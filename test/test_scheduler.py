@@ -1,6 +1,12 @@
+from datetime import datetime, timedelta
+import json
 import pytest
+import shutil
+from pytest_mock import mocker
 
 from ad_scheduler.scheduler import Scheduler
+from ad_scheduler.simulation import SimulatedScheduler, VirtualClock
+from ad_scheduler.writers import GroupsWriter
 
 
 @pytest.fixture
@@ -11,3 +17,287 @@ def scheduler(given_that):
     given_that.mock_functions_are_cleared()
 
     return sched
+
+
+START = datetime(2021, 11, 1)  # Monday
+
+
+@pytest.fixture
+def clock() -> VirtualClock:
+    return VirtualClock(START)
+
+
+@pytest.fixture
+def app(clock, tmp_path):
+    app = SimulatedScheduler({"root_dir": str(tmp_path)}, clock=clock, record=True)
+    yield app
+    app.close()
+
+
+def add_schedule(app, name: str, minute: int = 0):
+    app.call_endpoint("schedules_add", {"name": name, "kind": "on_off"})
+    for value, hour in [("on", 7), ("off", 22)]:
+        app.call_endpoint(
+            "entries_add",
+            {"schedule": name, "value": value, "hour": hour, "minute": minute},
+        )
+    app.call_endpoint(
+        "groups_add", {"name": name, "kind": "on_off", "entities": [f"light.{name}"]}
+    )
+    app.call_endpoint("groups_assign", {"group": name, "schedule": name})
+
+
+def publishes(app) -> int:
+    return sum(
+        1
+        for _, service, args, _ in app.calls
+        if service == "set_state" and args == ("sensor.scheduler_scheduler",)
+    )
+
+
+def test_trigger_rebuilds_only_its_schedule(app, clock, mocker):
+    add_schedule(app, "first", minute=0)
+    add_schedule(app, "second", minute=30)
+    clock.advance(0)
+    map_schedule = mocker.spy(app, "map_schedule")
+    map_group = mocker.spy(app, "map_group")
+
+    clock.run_until(START + timedelta(hours=7, minutes=1))
+
+    assert [c.args[0].name for c in map_schedule.call_args_list] == ["first"]
+    map_group.assert_not_called()
+    state = app.get_state("sensor.scheduler_scheduler", attribute="all")
+    first, second = state["attributes"]["schedules"]
+    assert first["current_entry"]["value"] == "on"
+    assert second["current_entry"]["value"] == "off"
+
+
+def test_changes_in_one_tick_are_published_once(app, clock):
+    clock.advance(0)
+    before = publishes(app)
+
+    add_schedule(app, "first")
+    add_schedule(app, "second")
+    app.call_endpoint("groups_deactivate", {"name": "first"})
+    assert publishes(app) == before
+
+    clock.advance(0)
+    assert publishes(app) == before + 1
+    state = app.get_state("sensor.scheduler_scheduler", attribute="all")
+    assert [s["name"] for s in state["attributes"]["schedules"]] == ["first", "second"]
+    assert not state["attributes"]["groups"][0]["active"]
+
+
+def test_removed_objects_are_not_published(app, clock):
+    add_schedule(app, "first")
+    add_schedule(app, "second")
+    clock.advance(0)
+    removed = [app.schedules["first"], app.groups["first"]]
+    assert all(obj in app._states for obj in removed)
+
+    app.call_endpoint("groups_delete", {"name": "first"})
+    app.call_endpoint("schedules_delete", {"name": "first"})
+    clock.advance(0)
+
+    assert not any(obj in app._states for obj in removed)
+    assert len(app._states) == 2
+    state = app.get_state("sensor.scheduler_scheduler", attribute="all")
+    assert [s["name"] for s in state["attributes"]["schedules"]] == ["second"]
+    assert [g["name"] for g in state["attributes"]["groups"]] == ["second"]
+
+
+def test_batch_applies_valid_operations(app, clock, mocker):
+    clock.advance(0)
+    flush = mocker.spy(app.store, "flush")
+    before = publishes(app)
+
+    body, status = app.call_endpoint(
+        "batch",
+        {
+            "operations": [
+                {"op": "schedules_add", "data": {"name": "s", "kind": "on_off"}},
+                {
+                    "op": "entries_add",
+                    "data": {"schedule": "s", "value": "on", "hour": "7", "minute": 0},
+                },
+                {
+                    "op": "entries_add",
+                    "data": {"schedule": "s", "value": "on", "hour": 7, "minute": 0},
+                },
+                {"op": "groups_add", "data": {"name": "g"}},
+                {"op": "groups_add", "data": {"name": "g", "kind": "on_off"}},
+                {"op": "groups_edit", "data": {"name": "g", "offset": "soon"}},
+                {"op": "groups_assign", "data": {"group": "g", "schedule": "s"}},
+                {"op": "unknown"},
+            ]
+        },
+    )
+
+    assert status == 200
+    statuses = [r["status"] for r in body["results"]]
+    assert statuses == [200, 400, 200, 400, 200, 400, 200, 400]
+    assert body["results"][1]["msg"].startswith("Invalid field")
+    assert body["results"][3]["msg"].startswith("Missing field")
+    assert body["results"][5]["msg"].startswith("Invalid field")
+    assert app.groups["g"].schedule is app.schedules["s"]
+    assert len(app.schedules["s"].entries) == 1
+
+    clock.advance(app.store.delay)
+    assert flush.call_count == 1
+    assert publishes(app) == before + 1
+
+
+@pytest.mark.parametrize(
+    "operation,status",
+    [
+        (
+            {
+                "op": "groups_add",
+                "data": {"name": "g", "kind": "on_off", "offset": "1"},
+            },
+            400,
+        ),
+        ({"op": "groups_add", "data": {"name": "g"}}, 400),
+        (
+            {
+                "op": "groups_add",
+                "data": {"name": "g", "kind": "on_off", "entities": 5},
+            },
+            400,
+        ),
+        ({"op": "groups_assign", "data": {"group": "g", "schedule": "missing"}}, 403),
+        (
+            {
+                "op": "entries_add",
+                "data": {
+                    "schedule": "s",
+                    "value": "on",
+                    "hour": 7,
+                    "minute": 0,
+                    "days": [],
+                },
+            },
+            403,
+        ),
+    ],
+)
+def test_failed_transaction_changes_nothing(app, clock, mocker, operation, status):
+    clock.advance(0)
+    schedule_changed = mocker.spy(app.store, "schedule_changed")
+    groups_changed = mocker.spy(app.store, "groups_changed")
+    before = publishes(app)
+
+    body, code = app.call_endpoint(
+        "transaction",
+        {
+            "operations": [
+                {"op": "schedules_add", "data": {"name": "s", "kind": "on_off"}},
+                operation,
+            ]
+        },
+    )
+    clock.advance(app.store.delay)
+
+    assert code == status
+    assert body["index"] == 1
+    assert body["msg"].startswith(f"Operation 1 ({operation['op']})")
+    assert app.schedules == {}
+    assert app.groups == {}
+    schedule_changed.assert_not_called()
+    groups_changed.assert_not_called()
+    assert publishes(app) == before
+
+
+def test_transaction_is_journaled(clock, tmp_path):
+    app = SimulatedScheduler(
+        {"root_dir": str(tmp_path), "storage": "journal"}, clock=clock, record=True
+    )
+    request = {
+        "operations": [
+            {"op": "schedules_add", "data": {"name": "s", "kind": "on_off"}},
+            {
+                "op": "entries_add",
+                "data": {"schedule": "s", "value": "on", "hour": 7, "minute": 0},
+            },
+            {"op": "groups_add", "data": {"name": "g", "kind": "on_off"}},
+            {"op": "groups_assign", "data": {"group": "g", "schedule": "s"}},
+        ]
+    }
+    try:
+        body, status = app.call_endpoint("transaction", request)
+        assert status == 200
+        assert [s["name"] for s in body["schedules"]] == ["s"]
+        assert [g["name"] for g in body["groups"]] == ["g"]
+        lines = app.journal.journal_path.read_text().splitlines()
+        assert [json.loads(line)["op"] for line in lines] == ["transaction"]
+        assert json.loads(lines[0])["data"] == request
+        clock.advance(0)
+        assert publishes(app) == 2
+    finally:
+        app.close()
+
+
+def test_journal_replay_matches_snapshot(clock, tmp_path):
+    def start(root):
+        args = {"root_dir": str(root), "storage": "journal"}
+        return SimulatedScheduler(args, clock=clock, record=True)
+
+    def groups(app):
+        return [GroupsWriter.group_to_dict(g) for g in app.groups.values()]
+
+    app = start(tmp_path.joinpath("live"))
+    add_schedule(app, "paused")
+    add_schedule(app, "stopped")
+    add_schedule(app, "running")
+    app.call_endpoint("groups_deactivate", {"name": "paused", "delay": 3600})
+    app.call_endpoint("groups_deactivate", {"name": "stopped"})
+    expected = groups(app)
+    activate_at = clock.now + timedelta(hours=1)
+    assert expected[0]["active"] is False
+    assert expected[0]["activate_at"] == activate_at.isoformat()
+    assert expected[1]["active"] is False
+
+    # Before closing, the journal holds all changes and there is no snapshot
+    shutil.copytree(tmp_path.joinpath("live"), tmp_path.joinpath("replayed"))
+    app.close()
+    clock.advance(600)
+
+    compacted = start(tmp_path.joinpath("live"))
+    replayed = start(tmp_path.joinpath("replayed"))
+    try:
+        assert replayed.journal.tail()
+        assert not compacted.journal.tail()
+        assert groups(replayed) == groups(compacted) == expected
+
+        clock.run_until(activate_at)
+        for restored in (compacted, replayed):
+            assert [g["active"] for g in groups(restored)] == [True, False, True]
+    finally:
+        compacted.close()
+        replayed.close()
+
+
+def test_unarmed_schedules_are_evaluated_when_due(clock, tmp_path, mocker):
+    app = SimulatedScheduler(
+        {"root_dir": str(tmp_path), "on_demand": True}, clock=clock, record=True
+    )
+    try:
+        add_schedule(app, "idle")
+        app.call_endpoint("groups_deactivate", {"name": "idle"})
+        schedule = app.schedules["idle"]
+        clock.advance(0)
+        assert not schedule.armed
+        assert schedule.current_entry.value == "off"
+
+        update_state = mocker.spy(schedule, "update_state")
+        app.set_own_state()
+        update_state.assert_not_called()
+
+        clock.run_until(schedule.next_datetime)
+        app.set_own_state()
+        update_state.assert_called_once()
+        assert schedule.current_entry.value == "on"
+        published = app.states["sensor.scheduler_scheduler"]["attributes"]
+        assert published["schedules"][0]["current_entry"]["value"] == "on"
+    finally:
+        app.close()
@@ -0,0 +1,209 @@
+from datetime import datetime
+import pytest
+import threading
+import time
+
+from ad_scheduler.sharding import Shard, shard_of
+from ad_scheduler.simulation import SimulatedHass, SimulatedScheduler, VirtualClock
+from ad_scheduler.storage import JsonStorage, SQLiteStorage
+
+
+def group(name, schedule_name=None):
+    return {
+        "name": name,
+        "kind": "on_off",
+        "active": True,
+        "schedule_name": schedule_name,
+        "entities": [],
+        "offset": 0,
+        "jitter": 0,
+    }
+
+
+def test_shard_of_is_stable():
+    assert shard_of("living_room", 4) == shard_of("living_room", 4)
+    assert [shard_of(f"s{i}", 3) for i in range(6)] == [
+        shard_of(f"s{i}", 3) for i in range(6)
+    ]
+    assert {shard_of(f"s{i}", 3) for i in range(30)} == {0, 1, 2}
+
+
+@pytest.mark.parametrize("index,count", [(1, 1), (-1, 2), (0, 0)])
+def test_invalid_shard_raises(index, count):
+    with pytest.raises(ValueError):
+        Shard(index, count)
+
+
+def test_groups_follow_their_schedule():
+    shards = [Shard(i, 3) for i in range(3)]
+
+    for i in range(20):
+        owners = [s for s in shards if s.owns_group(f"g{i}", "sched")]
+        assert owners == [s for s in shards if s.owns_schedule("sched")]
+        assert sum(s.owns_group(f"g{i}") for s in shards) == 1
+
+
+def test_single_shard_owns_everything():
+    shard = Shard()
+    assert shard.owns_schedule("anything")
+    assert shard.owns_group_dict(group("g", "s"))
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_partitioned_group_writes(tmp_path, backend):
+    shards = [Shard(i, 2) for i in range(2)]
+    names = [f"g{i}" for i in range(10)]
+    storages = []
+    for shard in shards:
+        if backend == "json":
+            storage = JsonStorage(tmp_path)
+        else:
+            storage = SQLiteStorage(tmp_path.joinpath("scheduler.db"))
+        storage.partition = shard.owns_group_dict
+        storages.append(storage)
+
+    for shard, storage in zip(shards, storages):
+        storage.write({}, [group(n) for n in names if shard.owns_group(n)])
+    # Removing a group only affects the partition of the writer
+    removed = next(n for n in names if shards[0].owns_group(n))
+    storages[0].write(
+        {}, [group(n) for n in names if shards[0].owns_group(n) and n != removed]
+    )
+
+    loaded = storages[1].load_groups()
+    assert sorted(g["name"] for g in loaded) == sorted(n for n in names if n != removed)
+    for storage in storages:
+        storage.close()
+
+
+def test_load_schedules_filter(tmp_path):
+    storage = JsonStorage(tmp_path)
+    storage.write({n: {"name": n, "kind": "on_off", "entries": []} for n in "abc"}, None)
+
+    loaded = storage.load_schedules(lambda name: name != "b")
+
+    assert sorted(s["name"] for s in loaded) == ["a", "c"]
+
+
+def start_shard(tmp_path, backend, clock, hass, index):
+    return SimulatedScheduler(
+        {
+            "root_dir": str(tmp_path),
+            "storage": backend,
+            "shard_index": index,
+            "shard_count": 2,
+        },
+        clock=clock,
+        name=f"shard{index}",
+        hass=hass,
+    )
+
+
+def test_sqlite_partition_write_keeps_groups_stored_meanwhile(tmp_path):
+    path = tmp_path.joinpath("scheduler.db")
+    storages = [SQLiteStorage(path), SQLiteStorage(path)]
+    storages[0].partition = lambda g: g["schedule_name"] == "mine"
+    storages[1].partition = lambda g: g["schedule_name"] != "mine"
+    storages[0].write({}, [group("g", "mine")])
+
+    # The other app stores the group under the same name while it is partitioned
+    other = threading.Thread(
+        target=storages[1].write, args=({}, [group("g", "theirs")])
+    )
+    partition = storages[0].partition
+
+    def racing_partition(g):
+        if other.ident is None:
+            other.start()
+            time.sleep(0.1)
+        return partition(g)
+
+    storages[0].partition = racing_partition
+    storages[0].write({}, [])
+    other.join()
+
+    assert [g["schedule_name"] for g in storages[0].load_groups()] == ["theirs"]
+    for storage in storages:
+        storage.close()
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_group_handed_to_stopped_shard_is_stored(tmp_path, backend):
+    clock = VirtualClock(datetime(2021, 11, 1))
+    hass = SimulatedHass()
+    apps = [start_shard(tmp_path, backend, clock, hass, i) for i in range(2)]
+    schedule = next(f"s{i}" for i in range(20) if shard_of(f"s{i}", 2) == 1)
+    name = next(f"g{i}" for i in range(20) if shard_of(f"g{i}", 2) == 0)
+    try:
+        apps[1].call_endpoint("schedules_add", {"name": schedule, "kind": "on_off"})
+        apps[0].call_endpoint("groups_add", {"name": name, "kind": "on_off"})
+        clock.advance(2)
+        apps[1].close()
+
+        body, status = apps[0].call_endpoint(
+            "groups_assign", {"group": name, "schedule": schedule}
+        )
+        assert status == 200
+        clock.advance(2)
+
+        apps[1] = start_shard(tmp_path, backend, clock, hass, 1)
+        assert apps[1].groups[name].schedule is apps[1].schedules[schedule]
+    finally:
+        for app in apps:
+            app.close()
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_groups_move_to_the_shard_of_their_schedule(tmp_path, backend):
+    clock = VirtualClock(datetime(2021, 11, 1))
+    hass = SimulatedHass()
+    apps = [start_shard(tmp_path, backend, clock, hass, i) for i in range(2)]
+    schedule = next(f"s{i}" for i in range(20) if shard_of(f"s{i}", 2) == 1)
+    name = next(f"g{i}" for i in range(20) if shard_of(f"g{i}", 2) == 0)
+
+    def stored():
+        for app in apps:
+            app.store.flush().result()
+        return [g for g in apps[0].store.storage.load_groups() if g["name"] == name]
+
+    try:
+        apps[1].call_endpoint("schedules_add", {"name": schedule, "kind": "on_off"})
+        for value, hour in [("on", 7), ("off", 22)]:
+            apps[1].call_endpoint(
+                "entries_add",
+                {"schedule": schedule, "value": value, "hour": hour, "minute": 0},
+            )
+        apps[0].call_endpoint(
+            "groups_add", {"name": name, "kind": "on_off", "entities": ["light.a"]}
+        )
+        clock.advance(0)
+
+        body, status = apps[0].call_endpoint(
+            "groups_assign", {"group": name, "schedule": "missing"}
+        )
+        assert status == 403
+        assert name in apps[0].groups
+
+        body, status = apps[0].call_endpoint(
+            "groups_assign", {"group": name, "schedule": schedule}
+        )
+        assert status == 200
+        assert name not in apps[0].groups
+        clock.advance(2)
+        assert apps[1].groups[name].schedule is apps[1].schedules[schedule]
+        assert [g["schedule_name"] for g in stored()] == [schedule]
+        clock.run_until(datetime(2021, 11, 1, 7))
+        assert hass.states["light.a"]["state"] == "on"
+
+        # Unassigned groups belong to the shard of their name again
+        body, status = apps[1].call_endpoint(
+            "groups_assign", {"group": name, "schedule": ""}
+        )
+        assert status == 200
+        clock.advance(2)
+        assert name not in apps[1].groups
+        assert apps[0].groups[name].schedule is None
+        assert [g["schedule_name"] for g in stored()] == [None]
+    finally:
+        for app in apps:
+            app.close()
@@ -0,0 +1,173 @@
+from datetime import datetime, timedelta
+import pytest
+
+from ad_scheduler.simulation import SimulatedScheduler, VirtualClock
+
+START = datetime(2021, 11, 1)  # Monday
+
+
+@pytest.fixture
+def clock() -> VirtualClock:
+    return VirtualClock(START)
+
+
+def simulated(clock, tmp_path, **args) -> SimulatedScheduler:
+    return SimulatedScheduler({"root_dir": str(tmp_path), **args}, clock=clock)
+
+
+def add_lights(app: SimulatedScheduler, count: int):
+    with app.deferred():
+        for i in range(count):
+            app.call_endpoint("schedules_add", {"name": f"s{i}", "kind": "on_off"})
+            for value, hour in [("on", 7), ("off", 22)]:
+                app.call_endpoint(
+                    "entries_add",
+                    {"schedule": f"s{i}", "value": value, "hour": hour, "minute": i},
+                )
+            app.call_endpoint(
+                "groups_add",
+                {"name": f"g{i}", "kind": "on_off", "entities": [f"light.l{i}"]},
+            )
+            app.call_endpoint("groups_assign", {"group": f"g{i}", "schedule": f"s{i}"})
+
+
+def test_clock_runs_passed_start_the_next_day(clock, caplog):
+    clock.advance(timedelta(hours=12))
+    log = []
+    clock.run_at(lambda kw: log.append(clock.now), START + timedelta(hours=6))
+
+    assert "has passed" in caplog.text
+    clock.advance(timedelta(hours=12))
+    assert log == []
+    clock.advance(timedelta(hours=6))
+    assert log == [START + timedelta(days=1, hours=6)]
+
+
+def test_clock_runs_timers_in_order(clock):
+    log = []
+    clock.run_in(lambda kw: log.append(("in", clock.now)), 90)
+    clock.run_at(lambda kw: log.append((kw["name"], clock.now)), START, name="at")
+    every = clock.run_every(lambda kw: log.append(("every", clock.now)), "now", 60)
+    cancelled = clock.run_in(lambda kw: log.append("cancelled"), 30)
+    clock.cancel_timer(cancelled)
+
+    assert clock.advance(120) == 5
+    assert log == [
+        ("at", START),
+        ("every", START),
+        ("every", START + timedelta(seconds=60)),
+        ("in", START + timedelta(seconds=90)),
+        ("every", START + timedelta(seconds=120)),
+    ]
+    assert clock.now == START + timedelta(seconds=120)
+    assert not clock.timer_running(cancelled)
+    assert clock.timer_running(every)
+
+
+def test_clock_runs_timers_added_by_callbacks(clock):
+    log = []
+
+    def chain(kwargs):
+        log.append(clock.now)
+        if len(log) < 3:
+            clock.run_in(chain, 0.0000001)
+
+    clock.run_in(chain, 10)
+    clock.advance(60)
+
+    assert log == [
+        START + timedelta(seconds=10),
+        START + timedelta(seconds=10, microseconds=1),
+        START + timedelta(seconds=10, microseconds=2),
+    ]
+
+
+def test_simulated_week(clock, tmp_path):
+    app = simulated(clock, tmp_path)
+    try:
+        add_lights(app, 3)
+        assert app.get_state("light.l1") == "off"
+
+        clock.run_until(START + timedelta(hours=7, minutes=1))
+        assert app.get_state("light.l0") == "on"
+        assert app.get_state("light.l1") == "on"
+        assert app.get_state("light.l2") == "off"
+
+        clock.run_until(START + timedelta(days=7))
+        assert app.call_counts["homeassistant/turn_on"] == 3 * 7
+        # The groups are turned off when assigned, then every evening
+        assert app.call_counts["homeassistant/turn_off"] == 3 + 3 * 7
+        assert app.get_state("sensor.scheduler_scheduler", attribute="all")
+    finally:
+        app.close()
+
+
+def test_closed_app_stops_running(clock, tmp_path, caplog):
+    first = simulated(clock, tmp_path, storage="journal", compact_interval=60)
+    add_lights(first, 1)
+    clock.advance(1)
+    first.close()
+    calls = dict(first.call_counts)
+
+    restarted = simulated(clock, tmp_path, storage="journal", compact_interval=60)
+    try:
+        clock.run_until(START + timedelta(hours=7, minutes=1))
+        assert first.call_counts == calls
+        assert restarted.call_counts["homeassistant/turn_on"] == 1
+        assert "failed" not in caplog.text
+    finally:
+        restarted.close()
+
+
+def test_simulated_rate_limit_uses_virtual_time(clock, tmp_path):
+    app = SimulatedScheduler(
+        {"root_dir": str(tmp_path), "dispatch_rate": 1, "dispatch_burst": 1},
+        clock=clock,
+        record=True,
+    )
+    try:
+        with app.deferred():
+            app.call_endpoint("schedules_add", {"name": "s", "kind": "on_off"})
+            app.call_endpoint(
+                "entries_add", {"schedule": "s", "value": "on", "hour": 7, "minute": 0}
+            )
+            for i in range(3):
+                app.call_endpoint(
+                    "groups_add",
+                    {"name": f"g{i}", "kind": "on_off", "entities": [f"switch.s{i}"]},
+                )
+                app.call_endpoint("groups_assign", {"group": f"g{i}", "schedule": "s"})
+
+        clock.advance(10)
+        times = [t for t, service, _, _ in app.calls if service.startswith("home")]
+        assert times == [START + timedelta(seconds=s) for s in range(3)]
+    finally:
+        app.close()
+
+
+def test_simulated_repeating_transitions(clock, tmp_path):
+    app = simulated(clock, tmp_path)
+    try:
+        with app.deferred():
+            for name, entry in [
+                ("light", {"value": "on"}),
+                ("script", {"value": "script/morning", "is_service": True}),
+            ]:
+                app.call_endpoint("schedules_add", {"name": name, "kind": "on_off"})
+                app.call_endpoint(
+                    "entries_add", {"schedule": name, "hour": 7, "minute": 0, **entry}
+                )
+                app.call_endpoint(
+                    "groups_add",
+                    {"name": name, "kind": "on_off", "entities": [f"{name}.a"]},
+                )
+                app.call_endpoint("groups_assign", {"group": name, "schedule": name})
+
+        for day in range(3):
+            app.turn_off("light.a")
+            clock.run_until(START + timedelta(days=day, hours=7, minutes=1))
+            assert app.get_state("light.a") == "on"
+        # Once when assigned, then every morning
+        assert app.call_counts["script/morning"] == 1 + 3
+    finally:
+        app.close()
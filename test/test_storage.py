@@ -0,0 +1,214 @@
+import pytest
+import json
+import sqlite3
+
+from ad_scheduler.storage import (
+    JournalStorage,
+    JsonStorage,
+    SQLiteStorage,
+    atomic_write_json,
+)
+
+SCHEDULE = {
+    "kind": "on_off",
+    "name": "sched",
+    "entries": [
+        {
+            "value": "on",
+            "hour": 7,
+            "minute": 30,
+            "days": [0, 2, 4],
+            "attrs": {"brightness": 100},
+            "is_service": False,
+            "entity_identifier": "entity_id",
+        },
+        {
+            "value": "off",
+            "hour": 22,
+            "minute": 0,
+            "days": [0, 1, 2, 3, 4, 5, 6],
+            "attrs": {},
+            "is_service": False,
+            "entity_identifier": "entity_id",
+        },
+    ],
+}
+
+GROUP = {
+    "name": "lights",
+    "kind": "on_off",
+    "active": True,
+    "schedule_name": "sched",
+    "entities": ["light.a", "light.b"],
+    "offset": 0,
+    "jitter": 30,
+    "activate_at": None,
+}
+
+
+@pytest.fixture(params=["json", "sqlite", "journal"])
+def storage(request, tmp_path):
+    if request.param == "json":
+        storage = JsonStorage(tmp_path)
+    elif request.param == "sqlite":
+        storage = SQLiteStorage(tmp_path.joinpath("scheduler.db"))
+    else:
+        storage = JournalStorage(tmp_path)
+    yield storage
+    storage.close()
+
+
+def test_atomic_write_replaces_file(tmp_path):
+    path = tmp_path.joinpath("data.json")
+    path.write_text("old")
+
+    atomic_write_json(path, {"new": True})
+
+    assert json.loads(path.read_text()) == {"new": True}
+    assert [p.name for p in tmp_path.iterdir()] == ["data.json"]
+
+
+def test_round_trip(storage):
+    assert storage.is_empty()
+
+    storage.write({"sched": SCHEDULE}, [GROUP])
+
+    assert not storage.is_empty()
+    assert storage.load_schedules() == [SCHEDULE]
+    assert storage.load_groups() == [GROUP]
+
+
+def test_schedule_without_entries(storage):
+    storage.write({"empty": {"kind": "thermo", "name": "empty", "entries": []}}, None)
+
+    assert storage.load_schedules() == [
+        {"kind": "thermo", "name": "empty", "entries": []}
+    ]
+
+
+def test_delete_schedule(storage):
+    storage.write({"sched": SCHEDULE}, None)
+    storage.write({"sched": None}, None)
+
+    assert storage.load_schedules() == []
+
+
+def test_write_replaces_entries_and_groups(storage):
+    storage.write({"sched": SCHEDULE}, [GROUP, dict(GROUP, name="other")])
+    changed = dict(SCHEDULE, entries=SCHEDULE["entries"][:1])
+    storage.write({"sched": changed}, [dict(GROUP, active=False)])
+
+    assert storage.load_schedules() == [changed]
+    assert storage.load_groups() == [dict(GROUP, active=False)]
+
+
+def test_sqlite_persists_across_connections(tmp_path):
+    path = tmp_path.joinpath("scheduler.db")
+    storage = SQLiteStorage(path)
+    storage.write({"sched": SCHEDULE}, [GROUP])
+    storage.close()
+
+    storage = SQLiteStorage(path)
+    assert storage.load_schedules() == [SCHEDULE]
+    assert storage.load_groups() == [GROUP]
+    storage.close()
+
+
+def test_journal_tail_is_replayed_until_compacted(tmp_path):
+    storage = JournalStorage(tmp_path)
+    storage.append("schedules_add", {"name": "sched", "kind": "on_off"})
+    storage.append("entries_add", {"schedule": "sched", "hour": 7})
+    storage._file.close()
+
+    storage = JournalStorage(tmp_path)
+    assert storage.tail() == [
+        ("schedules_add", {"name": "sched", "kind": "on_off"}),
+        ("entries_add", {"schedule": "sched", "hour": 7}),
+    ]
+
+    storage.write({"sched": SCHEDULE}, None)
+    storage.append("groups_add", {"name": "lights"})
+    storage.compact(seq=2)
+    storage._file.close()
+
+    storage = JournalStorage(tmp_path)
+    assert storage.load_schedules() == [SCHEDULE]
+    assert storage.tail() == [("groups_add", {"name": "lights"})]
+    assert storage.seq == 3
+    storage.close()
+
+
+def test_journal_skips_lines_in_snapshot(tmp_path):
+    storage = JournalStorage(tmp_path)
+    storage.append("schedules_add", {"name": "sched", "kind": "on_off"})
+    storage.write({"sched": SCHEDULE}, None)
+    journal = tmp_path.joinpath("journal.jsonl").read_text()
+    storage.close()
+
+    # Interrupted compaction: the snapshot was written, the journal was not truncated
+    tmp_path.joinpath("journal.jsonl").write_text(journal + '{"seq": 2, "op"')
+
+    storage = JournalStorage(tmp_path)
+    assert storage.tail() == []
+    assert storage.load_schedules() == [SCHEDULE]
+
+    storage.append("groups_add", {"name": "lights"})
+    storage._file.close()
+    assert JournalStorage(tmp_path).tail() == [("groups_add", {"name": "lights"})]
+
+
+def test_json_reads_many_schedules(tmp_path):
+    storage = JsonStorage(tmp_path, workers=4)
+    storage.write({f"s{i}": dict(SCHEDULE, name=f"s{i}") for i in range(20)}, None)
+
+    loaded = storage.load_schedules()
+
+    assert sorted(s["name"] for s in loaded) == sorted(f"s{i}" for i in range(20))
+
+
+def test_sqlite_only_writes_changed_entries(tmp_path):
+    storage = SQLiteStorage(tmp_path.joinpath("scheduler.db"))
+    storage.write({"sched": SCHEDULE}, None)
+    first, second = SCHEDULE["entries"]
+    changes = storage._conn.total_changes
+
+    third = dict(second, hour=23, value="on")
+    storage.write({"sched": dict(SCHEDULE, entries=[first, third])}, None)
+
+    # The second entry is deleted and the third inserted, the first is not touched
+    assert storage._conn.total_changes - changes == 2
+    assert storage.load_schedules() == [dict(SCHEDULE, entries=[first, third])]
+    storage.close()
+
+
+def test_sqlite_migrates_entries_keyed_by_position(tmp_path):
+    path = tmp_path.joinpath("scheduler.db")
+    conn = sqlite3.connect(str(path))
+    conn.executescript(
+        """
+        CREATE TABLE schedules (name TEXT PRIMARY KEY, kind TEXT NOT NULL);
+        CREATE TABLE entries (
+            schedule TEXT NOT NULL REFERENCES schedules(name) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            minute INTEGER NOT NULL,
+            day_mask INTEGER NOT NULL,
+            value TEXT NOT NULL,
+            attrs TEXT NOT NULL,
+            is_service INTEGER NOT NULL,
+            entity_identifier TEXT NOT NULL,
+            PRIMARY KEY (schedule, position)
+        );
+        INSERT INTO schedules VALUES ('sched', 'on_off');
+        INSERT INTO entries VALUES
+            ('sched', 0, 7, 30, 21, '"on"', '{"brightness": 100}', 0, 'entity_id'),
+            ('sched', 1, 22, 0, 127, '"off"', '{}', 0, 'entity_id');
+        """
+    )
+    conn.close()
+
+    storage = SQLiteStorage(path)
+    assert storage.load_schedules() == [SCHEDULE]
+    storage.write({"sched": dict(SCHEDULE, entries=SCHEDULE["entries"][1:])}, None)
+    assert storage.load_schedules()[0]["entries"] == SCHEDULE["entries"][1:]
+    storage.close()
@@ -0,0 +1,85 @@
+import pytest
+from pytest_mock import mocker
+
+from ad_scheduler.const import EntityKind
+from ad_scheduler.entities import EntityGroup
+from ad_scheduler.schedule import Entry, Schedule
+from ad_scheduler.scheduler import Scheduler
+from ad_scheduler.sharding import Shard
+from ad_scheduler.transaction import Transaction
+
+
+@pytest.fixture
+def scheduler(mocker):
+    scheduler = mocker.Mock()
+    scheduler.schedules = {}
+    scheduler.groups = {}
+    scheduler.shard = Shard()
+    scheduler.entry_from_request = Scheduler.entry_from_request
+    scheduler.new_schedule = lambda name, kind: Schedule(name, kind, scheduler)
+    scheduler.new_group = lambda name, kind, entities: EntityGroup(
+        name, kind, scheduler, *entities
+    )
+
+    sched = Schedule("existing", EntityKind.ON_OFF, scheduler)
+    sched.entries = [Entry("on", 7, 0)]
+    scheduler.schedules["existing"] = sched
+    scheduler.groups["group"] = EntityGroup("group", EntityKind.THERMO, scheduler)
+    return scheduler
+
+
+@pytest.mark.parametrize(
+    "op,data",
+    [
+        ("schedules_add", {"name": "existing", "kind": EntityKind.ON_OFF}),
+        ("schedules_add", {"name": "new", "kind": "unknown"}),
+        ("entries_add", {"schedule": "missing", "value": 1, "hour": 1, "minute": 0}),
+        ("entries_add", {"schedule": "existing", "value": 1, "hour": 7, "minute": 0}),
+        ("groups_add", {"name": "group", "kind": EntityKind.ON_OFF}),
+        ("groups_assign", {"group": "group", "schedule": "existing"}),
+        ("schedules_delete", {"name": "existing"}),
+    ],
+)
+def test_invalid_operations_raise(scheduler, op, data):
+    with pytest.raises(ValueError):
+        Transaction(scheduler).add(op, data)
+
+
+def test_validates_against_earlier_operations(scheduler):
+    txn = Transaction(scheduler)
+    txn.add("schedules_add", {"name": "new", "kind": EntityKind.THERMO})
+    txn.add("entries_add", {"schedule": "new", "value": 20, "hour": 6, "minute": 0})
+    txn.add("groups_assign", {"group": "group", "schedule": "new"})
+
+    with pytest.raises(ValueError):
+        txn.add(
+            "entries_add",
+            {"schedule": "new", "value": 18, "hour": 6, "minute": 0, "days": ["mon"]},
+        )
+
+    assert "new" not in scheduler.schedules
+    assert scheduler.groups["group"].schedule is None
+
+
+def test_commit_applies_everything_once(mocker, scheduler):
+    txn = Transaction(scheduler)
+    txn.add("schedules_add", {"name": "new", "kind": EntityKind.ON_OFF})
+    for hour in (6, 8, 10):
+        txn.add(
+            "entries_add", {"schedule": "new", "value": "on", "hour": hour, "minute": 0}
+        )
+    txn.add("entries_add", {"schedule": "existing", "value": "off", "hour": 9, "minute": 0})
+    txn.add("groups_add", {"name": "lights", "kind": EntityKind.ON_OFF})
+    txn.add("groups_assign", {"group": "lights", "schedule": "new"})
+
+    add_entries = mocker.spy(Schedule, "add_entries")
+    result = txn.commit()
+
+    assert len(scheduler.schedules["new"].entries) == 3
+    assert len(scheduler.schedules["existing"].entries) == 2
+    assert scheduler.groups["lights"].schedule is scheduler.schedules["new"]
+    assert add_entries.call_count == 2
+    assert [s["name"] for s in result["schedules"]] == ["new", "existing"]
+    assert [g["name"] for g in result["groups"]] == ["lights"]
+    scheduler.store_groups.assert_called_once()
+    assert scheduler.store_schedule.call_count == 2
@@ -0,0 +1,150 @@
+import pytest
+from pytest_mock import mocker
+from datetime import datetime
+
+from ad_scheduler.triggers import TriggerQueue
+
+
+@pytest.fixture
+def app(mocker):
+    app = mocker.Mock()
+    app.run_at.side_effect = lambda cb, when: f"timer-{when}"
+    app.get_now.return_value = datetime(2021, 11, 1)
+    return app
+
+
+@pytest.fixture
+def queue(app) -> TriggerQueue:
+    return TriggerQueue(app)
+
+
+def test_arms_single_timer_for_earliest(app, queue, mocker):
+    queue.run_at(mocker.Mock(), datetime(2021, 11, 1, 12, 0))
+    queue.run_at(mocker.Mock(), datetime(2021, 11, 1, 13, 0))
+    app.run_at.assert_called_once_with(queue._fire, datetime(2021, 11, 1, 12, 0))
+
+    queue.run_at(mocker.Mock(), datetime(2021, 11, 1, 11, 0))
+    app.cancel_timer.assert_called_once_with(f"timer-{datetime(2021, 11, 1, 12, 0)}")
+    app.run_at.assert_called_with(queue._fire, datetime(2021, 11, 1, 11, 0))
+    assert len(queue) == 3
+
+
+def test_cancel_does_not_touch_app_timer(app, queue, mocker):
+    handle = queue.run_at(mocker.Mock(), datetime(2021, 11, 1, 12, 0))
+
+    assert queue.timer_running(handle)
+    queue.cancel_timer(handle)
+    queue.cancel_timer(handle)
+
+    assert not queue.timer_running(handle)
+    assert len(queue) == 0
+    app.cancel_timer.assert_not_called()
+
+
+def test_fire_dispatches_due_triggers_and_rearms(app, queue, mocker):
+    first = mocker.Mock()
+    second = mocker.Mock()
+    cancelled = mocker.Mock()
+    later = mocker.Mock()
+
+    queue.run_at(first, datetime(2021, 11, 1, 12, 0), some="arg")
+    queue.run_at(second, datetime(2021, 11, 1, 12, 0))
+    queue.cancel_timer(queue.run_at(cancelled, datetime(2021, 11, 1, 12, 0)))
+    queue.run_at(later, datetime(2021, 11, 1, 14, 0))
+
+    app.get_now.return_value = datetime(2021, 11, 1, 12, 0, 0, 5)
+    queue._fire({})
+
+    first.assert_called_once_with({"some": "arg"})
+    second.assert_called_once_with({})
+    cancelled.assert_not_called()
+    later.assert_not_called()
+    app.run_at.assert_called_with(queue._fire, datetime(2021, 11, 1, 14, 0))
+    assert len(queue) == 1
+
+
+def test_callbacks_can_requeue_while_firing(app, queue, mocker):
+    when = datetime(2021, 11, 1, 12, 0)
+    calls = []
+
+    def callback(kwargs):
+        calls.append(kwargs)
+        queue.run_at(callback, datetime(2021, 11, 2, 12, 0))
+
+    queue.run_at(callback, when)
+    app.get_now.return_value = when
+    app.run_at.reset_mock()
+
+    queue._fire({})
+
+    assert calls == [{}]
+    app.run_at.assert_called_once_with(queue._fire, datetime(2021, 11, 2, 12, 0))
+    assert queue.next_time() == datetime(2021, 11, 2, 12, 0)
+
+
+def test_failing_callback_does_not_stop_dispatch(app, queue, mocker):
+    when = datetime(2021, 11, 1, 12, 0)
+    failing = mocker.Mock(side_effect=RuntimeError("boom"))
+    other = mocker.Mock()
+    queue.run_at(failing, when)
+    queue.run_at(other, when)
+    app.get_now.return_value = when
+
+    queue._fire({})
+
+    other.assert_called_once()
+    assert queue.next_time() is None
+
+
+def test_due_triggers_run_in_one_batch(app, queue, mocker):
+    when = datetime(2021, 11, 1, 12, 0)
+    events = []
+    batch = mocker.MagicMock()
+    batch.return_value.__enter__.side_effect = lambda: events.append("enter")
+    batch.return_value.__exit__.side_effect = lambda *a: events.append("exit")
+    queue.batch = batch
+
+    queue.run_at(lambda kwargs: events.append("first"), when)
+    queue.run_at(lambda kwargs: events.append("second"), when)
+    app.get_now.return_value = when
+    queue._fire({})
+
+    assert events == ["enter", "first", "second", "exit"]
+
+
+def test_runs_triggers_due_while_dispatching(app, queue, mocker):
+    now = [datetime(2021, 11, 1, 7, 0)]
+    app.get_now.side_effect = lambda: now[0]
+    late = mocker.Mock()
+
+    def slow(kwargs):
+        now[0] = datetime(2021, 11, 1, 7, 0, 2)
+
+    queue.run_at(slow, datetime(2021, 11, 1, 7, 0))
+    queue.run_at(late, datetime(2021, 11, 1, 7, 0, 0, 500000))
+    queue.run_at(mocker.Mock(), datetime(2021, 11, 1, 8, 0))
+    app.run_at.reset_mock()
+
+    queue._fire({})
+
+    late.assert_called_once()
+    app.run_at.assert_called_once_with(queue._fire, datetime(2021, 11, 1, 8, 0))
+
+
+def test_does_not_arm_timer_in_the_past(app, queue, mocker):
+    app.get_now.return_value = datetime(2021, 11, 1, 7, 0, 2)
+
+    queue.run_at(mocker.Mock(), datetime(2021, 11, 1, 7, 0))
+
+    app.run_at.assert_not_called()
+    app.run_in.assert_called_once_with(queue._fire, 0)
+
+
+def test_cancelled_triggers_are_removed(app, queue, mocker):
+    handle = queue.run_at(mocker.Mock(), datetime(2021, 11, 1, 12, 0))
+    for minute in range(1000):
+        queue.cancel_timer(handle)
+        handle = queue.run_at(mocker.Mock(), datetime(2021, 11, 1, 12, minute % 60))
+
+    assert len(queue) == 1
+    assert len(queue._heap) <= 2